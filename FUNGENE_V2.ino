@@ -1,5 +1,7 @@
 #include <Arduino.h>
 #include <ArduinoJson.h>
+#include <SPI.h>
+#include <Preferences.h>
 
 #include <AD9833.h>
 #define FNC_PIN_1 5
@@ -29,12 +31,42 @@ Channel channel1, channel2;
 Modulation modulation;
 
 String inputBuffer;
+// Commands are parsed on the heap: a batch carrying a full data array does not
+// fit the old 1024-byte document, nor the loop task's stack.
+#define COMMAND_DOC_CAPACITY 32768
+#define MAX_BATCH_OPS 16
+#define MAX_DATA_SYMBOLS 1000  // size of pwstate
+long requestId = 0;  // "id" of the command being answered, echoed in replies (0 = none)
+
+// Preset bank (see presets.py): complete channel + modulation states in NVS,
+// one MessagePack blob per slot, recalled with a single short command
+#define MAX_PRESETS 8
+#define PRESET_NAME_LENGTH 24
+Preferences presetStore;
+
+// Binary frames (see framing.py), accepted once the host has seen "hello":
+// 0xA5, type, payload length (u16), request id (u32), payload, CRC-16/CCITT
+#define FRAME_MAGIC 0xA5
+#define FRAME_HEADER 8
+#define FRAME_MAX_PAYLOAD 4608
+#define FRAME_TIMEOUT_US 100000
+#define FRAME_SET_CHANNEL 0x02
+#define FRAME_SET_MODULATION 0x03
+#define FRAME_STREAM_DATA 0x04
+#define FRAME_BATCH 0x05
+#define FRAME_STREAM_END 0x01
+uint8_t frameBuffer[FRAME_HEADER + FRAME_MAX_PAYLOAD + 2];
+uint16_t frameFill = 0;     // bytes of the current frame received so far
+int64_t frameStarted = 0;
 
 #define XOR_PIN 15
 float currentPhase = 0.0;  // in degrees
+// Phase-sync gains; set_pll replaces them with values tuned by pll.py and
+// saves them in NVS, so they survive the reset that opening the port causes
+Preferences pllStore;
 float kp = 0.5;            // Proportional gain
-//float kd = 0.0;            // Derivative gain
-const float PHASE_THRESHOLD = 0.1; // degrees
+float kd = 0.0;            // Derivative gain, per iteration (not per second)
+float phaseThreshold = 0.1; // degrees
 
 float previousPhaseError = 0.0;
 unsigned long previousTime = 0;
@@ -43,9 +75,68 @@ int gen_sel = 1;
 
 int indexd = 0;
 int maxstate;
-int pwstate[1000];
+int pwstate[MAX_DATA_SYMBOLS];
 int change_no = 1;
 
+// Register table compiled on the host by dds.py: FSK()/PSK() write these
+// words straight to the AD9833 instead of converting floats per symbol.
+#define DDS_TABLE_SIZE 256
+#define DDS_SPI_CLOCK 10000000
+uint16_t ddsFreqLow[DDS_TABLE_SIZE];   // FREQ0 write, low 14 bits of the word
+uint16_t ddsFreqHigh[DDS_TABLE_SIZE];  // FREQ0 write, high 14 bits
+uint16_t ddsPhase[DDS_TABLE_SIZE];     // PHASE0 write
+uint8_t ddsIndex[MAX_DATA_SYMBOLS];    // table entry for each data symbol
+int ddsSymbols = 0;
+uint32_t ddsTableId = 0;               // host's tag for the loaded table, 0 = none
+
+// Telemetry: phase-loop samples, rate-limited and batched into
+// {"event": "telemetry"} lines between command replies. Angles are sent in
+// hundredths of a degree and times as microsecond offsets from t0
+// (esp_timer, truncated to 32 bits).
+#define TELEMETRY_BATCH 32
+#define TELEMETRY_MAX_AGE_US 100000  // a partial batch goes out after this long
+#define TELEMETRY_MAX_RATE 10000
+float telemetryRate = 0;             // samples/s, 0 = off
+int64_t telemetryLast = 0;
+int64_t telemetryStart = 0;
+uint32_t telemetryDropped = 0;       // samples lost to a full serial buffer
+int telemetryCount = 0;
+uint32_t telemetryOffset[TELEMETRY_BATCH];
+int16_t telemetryMeasured[TELEMETRY_BATCH];
+int16_t telemetryTarget[TELEMETRY_BATCH];
+uint16_t telemetryPhase[TELEMETRY_BATCH];
+
+// Per-symbol overhead of each modulation loop, subtracted from the symbol
+// period: overhead_us = offset + slope * baud_rate. The defaults are the
+// original hand-tuned constants; set_calibration replaces them with a fit
+// made by calibration.py from this board's calibrate measurements.
+enum LoopKind { LOOP_BSK, LOOP_FSK, LOOP_PSK, LOOP_ASK, LOOP_SWEEP, LOOP_PWM, LOOP_KINDS };
+const char* loopNames[LOOP_KINDS] = {"BSK", "FSK", "PSK", "ASK", "SWEEP", "PWM"};
+float overheadOffset[LOOP_KINDS] = {39, 114, 40, 39, 114, 5};
+float overheadSlope[LOOP_KINDS] = {0, 0, 0, 0, 0, 0};
+#define CALIBRATION_MAX_SYMBOLS 10000
+#define CALIBRATION_MAX_SECONDS 5
+
+// Streaming mode: the host pushes symbols into this ring buffer with
+// stream_data and playStream() plays them at the baud rate. Played symbols
+// are handed back as credits in {"event":"stream_credit"} messages, so the
+// host never has more than STREAM_BUFFER_SIZE symbols outstanding. Stream
+// events carry the "stream" tag from stream_start, so the host can tell a
+// late event from an earlier stream apart from its own.
+#define STREAM_BUFFER_SIZE 4096  // a power of two, so the counters may wrap
+#define STREAM_CREDIT_BATCH 256
+#define STREAM_STALL_US 2000000  // give up after starving this long
+enum StreamMode { STREAM_REGISTER, STREAM_FSK, STREAM_PSK, STREAM_ASK };
+uint8_t streamBuffer[STREAM_BUFFER_SIZE];
+uint32_t streamWritten = 0;   // symbols received since stream_start
+uint32_t streamPlayed = 0;    // symbols played since stream_start
+uint32_t streamCredited = 0;  // played symbols already returned as credits
+uint32_t streamUnderruns = 0; // symbol periods with an empty buffer
+uint32_t streamPrefill = STREAM_BUFFER_SIZE / 2;
+uint32_t streamTag = 0;       // host's tag from stream_start, echoed in the stream's events
+bool streaming = false;       // from stream_start until playback ends
+bool streamEnding = false;    // the host has sent its last chunk
+
 #define PWM_CHANNEL_0 0
 #define PWM_PIN 2
 int pwm_timer = 12;
@@ -65,20 +156,34 @@ void setup() {
   delay(100);
 
 
+  Serial.setTxBufferSize(2048);  // room for a telemetry batch without blocking loop()
   Serial.begin(115200);
-  while (!Serial);
-  delay(2000);
 
   pinMode(XOR_PIN, INPUT);
   //previousTime = esp_timer_get_time();
 
   pinMode(sel_A, OUTPUT);
   pinMode(sel_B, OUTPUT);
+
+  presetStore.begin("presets", false);
+  loadPll();
+
+  // Tell the host that commands are accepted from now on, instead of it sleeping through the reset
+  sendReady();
 }
 
 void communicator() {
   char c = Serial.read();
-  if (c == '\n') {
+  // Drop a frame that stopped arriving, so the parser resyncs on the next message
+  if (frameFill > 0 && esp_timer_get_time() - frameStarted > FRAME_TIMEOUT_US) {
+    frameFill = 0;
+  }
+  if (frameFill > 0 || (inputBuffer.length() == 0 && (uint8_t)c == FRAME_MAGIC)) {
+    if (receiveFrameByte((uint8_t)c)) {
+      indexd = modulation.data.size() - 1;
+      change_no = 1;
+    }
+  } else if (c == '\n') {
     processCommand(inputBuffer);
     indexd = modulation.data.size() - 1;
     inputBuffer = "";
@@ -103,7 +208,9 @@ void loop() {
     communicator();
   }
 
-  if (modulation.enabled)
+  if (streaming)
+    playStream();
+  else if (modulation.enabled)
     setmod();
 
   if (change_no && (channel1.enabled || channel2.enabled)){
@@ -131,7 +238,7 @@ void loop() {
     if (targetPhase < -180.0) targetPhase += 360.0;
 
     if (targetPhase > 173.0) targetPhase = 173.0;
-    if (targetPhase < -173.0) targetPhase = 173.0;
+    if (targetPhase < -173.0) targetPhase = -173.0;
 
     if (targetPhase < 0) {
       gen_sel = 2; 
@@ -142,14 +249,9 @@ void loop() {
 
     float phaseError = measuredPhase - targetPhase;
     
-    // unsigned long currentTime = esp_timer_get_time();
-    // float dt = (currentTime - previousTime) / 1000000.0;
-    // previousTime = currentTime;
-
     // Only adjust if phase error is significant
-    if (fabs(phaseError) >= PHASE_THRESHOLD) {// && dt > 0) {
-      // float derivative = (phaseError - previousPhaseError) / dt;
-      float correction = kp * phaseError;// + kd * derivative;
+    if (fabs(phaseError) >= phaseThreshold) {
+      float correction = kp * phaseError + kd * (phaseError - previousPhaseError);
       currentPhase -= correction;
 
       // Wrap currentPhase between 0–360
@@ -165,19 +267,64 @@ void loop() {
 
     previousPhaseError = phaseError;
 
-    //Debug output
-    // Serial.print("Duty Cycle: ");
-    // Serial.print(dutyCycle, 2);
-    // Serial.print("Target: ");
-    // Serial.print(targetPhase, 2);
-    // Serial.print("°, Measured: ");
-    // Serial.print(measuredPhase, 2);
-    // Serial.print("°, Error: ");
-    // Serial.print(phaseError, 2);
-    // Serial.print("°, Gen1 Phase: ");
-    // Serial.println(currentPhase, 2);
+    // Debug output goes through the telemetry event, never bare prints
+    recordTelemetry(measuredPhase, targetPhase, currentPhase);
+  }
+  flushTelemetry();
+}
+
+void recordTelemetry(float measured, float target, float phase) {
+  if (telemetryRate <= 0) {
+    return;
+  }
+  int64_t now = esp_timer_get_time();
+  if (now - telemetryLast < (int64_t)(1000000 / telemetryRate)) {
+    return;
+  }
+  telemetryLast = now;
+  if (telemetryCount == 0) {
+    telemetryStart = now;
+  }
+  telemetryOffset[telemetryCount] = (uint32_t)(now - telemetryStart);
+  telemetryMeasured[telemetryCount] = (int16_t)lroundf(measured * 100);
+  telemetryTarget[telemetryCount] = (int16_t)lroundf(target * 100);
+  telemetryPhase[telemetryCount] = (uint16_t)lroundf(phase * 100);
+  telemetryCount++;
+  if (telemetryCount == TELEMETRY_BATCH) {
+    sendTelemetry();
+  }
+}
+
+void flushTelemetry() {
+  if (telemetryCount > 0 && esp_timer_get_time() - telemetryStart >= TELEMETRY_MAX_AGE_US) {
+    sendTelemetry();
   }
-  
+}
+
+void sendTelemetry() {
+  StaticJsonDocument<JSON_OBJECT_SIZE(7) + 4 * JSON_ARRAY_SIZE(TELEMETRY_BATCH)> event;
+  event["event"] = "telemetry";
+  event["t0"] = (uint32_t)telemetryStart;
+  JsonArray offsets = event.createNestedArray("dt");
+  JsonArray measured = event.createNestedArray("measured");
+  JsonArray target = event.createNestedArray("target");
+  JsonArray phase = event.createNestedArray("phase");
+  for (int i = 0; i < telemetryCount; i++) {
+    offsets.add(telemetryOffset[i]);
+    measured.add(telemetryMeasured[i]);
+    target.add(telemetryTarget[i]);
+    phase.add(telemetryPhase[i]);
+  }
+  event["dropped"] = telemetryDropped;
+
+  // Never stall the phase loop on a full TX buffer; drop the batch instead
+  if (Serial.availableForWrite() < (int)measureJson(event) + 2) {
+    telemetryDropped += telemetryCount;
+  } else {
+    serializeJson(event, Serial);
+    Serial.println();
+  }
+  telemetryCount = 0;
 }
 
 WaveformType getWaveformTypeFromString(const String& type) {
@@ -194,11 +341,26 @@ void setgen() {
     gen2.ApplySignal(getWaveformTypeFromString(channel2.type), REG0, channel2.frequency, REG0, channel2.phase);
 }
 
-void BSK() {
-  int timerz = (1000000 / modulation.baud_rate) - 39;
+// Microseconds to wait after each symbol of a `kind` loop at `baudRate`
+int symbolDelay(int kind, float baudRate) {
+  int timerz = (1000000 / baudRate) - (overheadOffset[kind] + overheadSlope[kind] * baudRate);
   if (timerz < 0) {
     timerz = 0;
   }
+  return timerz;
+}
+
+int loopKind(const String& name) {
+  for (int kind = 0; kind < LOOP_KINDS; kind++) {
+    if (name == loopNames[kind]) {
+      return kind;
+    }
+  }
+  return -1;
+}
+
+void BSK() {
+  int timerz = symbolDelay(LOOP_BSK, modulation.baud_rate);
   for (int i = 0; i <= indexd; i++) {
     if (modulation.data[i] > maxstate) {
       modulation.data[i] = maxstate;
@@ -221,10 +383,11 @@ void BSK() {
 }
 
 void FSK() {
-  int timerz = (1000000 / modulation.baud_rate) - 114;
-  if (timerz < 0) {
-    timerz = 0;
+  if (ddsTableId != 0) {
+    playTable(true);
+    return;
   }
+  int timerz = symbolDelay(LOOP_FSK, modulation.baud_rate);
   int prevstate = 0;
   for (int i = 0; i <= indexd; i++) {
     if (modulation.data[i] > maxstate) {
@@ -246,10 +409,11 @@ void FSK() {
 }
 
 void PSK() {
-  int timerz = (1000000 / modulation.baud_rate) - 40;
-  if (timerz < 0) {
-    timerz = 0;
+  if (ddsTableId != 0) {
+    playTable(false);
+    return;
   }
+  int timerz = symbolDelay(LOOP_PSK, modulation.baud_rate);
   //int prevstate = 0;
   for (int i = 0; i <= indexd; i++) {
     if (modulation.data[i] > maxstate) {
@@ -275,10 +439,7 @@ void PSK() {
 }
 
 void ASK() {
-  int timerz = (1000000 / modulation.baud_rate) - 39;
-  if (timerz < 0) {
-    timerz = 0;
-  }
+  int timerz = symbolDelay(LOOP_ASK, modulation.baud_rate);
   for (int i = 0; i <= indexd; i++) {
     if (modulation.data[i] > maxstate) {
       modulation.data[i] = maxstate;
@@ -303,10 +464,7 @@ void ASK() {
 }
 
 void PWM() {
-  int timerz = (1000000 / modulation.baud_rate) - 5;
-  if (timerz < 0) {
-    timerz = 0;
-  }
+  int timerz = symbolDelay(LOOP_PWM, modulation.baud_rate);
   long int timer = esp_timer_get_time();
   while (esp_timer_get_time() - timer <= modulation.mod_time * 1000000) {
     for (int i = 0; i <= indexd; i++) {
@@ -321,14 +479,10 @@ void PWM() {
 
 void SWEEP() {
   int parts;
-  int temp_int = (1000000 / modulation.baud_rate);
   parts = modulation.m;
   int bufferfreq = modulation.delta_freq;
   int i = modulation.frequency;
-  int timerz = temp_int - 114;
-  if (timerz < 0) {
-    timerz = 0;
-  }
+  int timerz = symbolDelay(LOOP_SWEEP, modulation.baud_rate);
   //gen1.SetFrequency(REG0, i);
   long int timer = esp_timer_get_time();
   while (esp_timer_get_time() - timer <= modulation.mod_time * 1000000) {
@@ -345,6 +499,140 @@ void SWEEP() {
   gen1.SetFrequency(REG0, modulation.frequency);
 }
 
+// Plays symbols from the stream buffer until the host's last chunk has been
+// played, stream_stop arrives or the host stops feeding it. Deadlines are
+// absolute, so the symbol clock does not drift over long streams.
+void playStream() {
+  // Start once the prefill has arrived (or the whole stream, if shorter)
+  if (streamWritten < streamPrefill && !streamEnding) {
+    return;
+  }
+
+  StreamMode mode;
+  if (modulation.type.equals("ASK")) {
+    mode = STREAM_ASK;
+    maxstate = 1;
+    gen1.ApplySignal(SINE_WAVE, REG0, modulation.frequency, REG0, 0.0);
+  } else if (modulation.m == 2) {
+    mode = STREAM_REGISTER;
+    maxstate = 1;
+    if (modulation.type.equals("MFSK")) {
+      gen1.ApplySignal(SINE_WAVE, REG1, modulation.frequency + modulation.delta_freq, REG1, 0.0);
+    } else {
+      gen1.ApplySignal(SINE_WAVE, REG1, modulation.frequency, REG1, modulation.delta_freq);
+    }
+    gen1.ApplySignal(SINE_WAVE, REG0, modulation.frequency, REG0, 0.0);
+  } else {
+    mode = modulation.type.equals("MFSK") ? STREAM_FSK : STREAM_PSK;
+    maxstate = modulation.m - 1;
+    gen1.ApplySignal(SINE_WAVE, REG0, modulation.frequency, REG0, 0.0);
+  }
+
+  // A stream_start handled while this one plays replaces it; its events keep their own tag
+  uint32_t tag = streamTag;
+  const char* reason = "stopped";
+  int64_t period = (int64_t)(1000000 / modulation.baud_rate);
+  int64_t deadline = esp_timer_get_time();
+  int64_t starvedSince = 0;
+  while (streaming && streamTag == tag) {
+    if (streamPlayed == streamWritten) {
+      if (streamEnding) {
+        reason = "done";
+        break;
+      }
+      // Underrun: hold the current symbol for another period
+      streamUnderruns++;
+      if (starvedSince == 0) {
+        starvedSince = deadline;
+      } else if (deadline - starvedSince > STREAM_STALL_US) {
+        reason = "stalled";
+        break;
+      }
+    } else {
+      starvedSince = 0;
+      int symbol = streamBuffer[streamPlayed % STREAM_BUFFER_SIZE];
+      if (symbol > maxstate) {
+        symbol = maxstate;
+      }
+      if (mode == STREAM_REGISTER) {
+        gen1.SetOutputSource(symbol == 0 ? REG0 : REG1);
+      } else if (mode == STREAM_FSK) {
+        gen1.SetFrequency(REG0, modulation.frequency + symbol * modulation.delta_freq);
+      } else if (mode == STREAM_PSK) {
+        gen1.SetPhase(REG0, (symbol ^ (symbol >> 1)) * modulation.delta_freq);
+      } else {
+        gen1.EnableOutput(symbol != 0);
+      }
+      streamPlayed++;
+    }
+
+    uint32_t uncredited = streamPlayed - streamCredited;
+    if (uncredited >= STREAM_CREDIT_BATCH || (uncredited > 0 && streamPlayed == streamWritten)) {
+      sendStreamCredit(tag);
+    }
+
+    deadline += period;
+    while (esp_timer_get_time() < deadline) {
+      if (Serial.available()) {
+        communicator();
+      }
+    }
+  }
+
+  if (mode == STREAM_ASK) {
+    gen1.EnableOutput(true);
+  }
+  if (streamTag == tag) {
+    streaming = false;
+  }
+  sendStreamEnd(reason, tag);
+}
+
+// Raw AD9833 writes, bypassing the library's float conversions. FSYNC stays
+// low across the words of one update.
+void writeDDS(const uint16_t* words, int count) {
+  SPI.beginTransaction(SPISettings(DDS_SPI_CLOCK, MSBFIRST, SPI_MODE2));
+  digitalWrite(FNC_PIN_1, LOW);
+  for (int i = 0; i < count; i++) {
+    SPI.transfer16(words[i]);
+  }
+  digitalWrite(FNC_PIN_1, HIGH);
+  SPI.endTransaction();
+}
+
+// FSK()/PSK() with a loaded register table: each symbol is one or two
+// precomputed SPI words, paced against absolute deadlines.
+void playTable(bool frequencyMode) {
+  gen1.ApplySignal(SINE_WAVE, REG0, modulation.frequency, REG0, 0.0);
+  uint16_t control = 0x2000;  // B28: FREQ0 takes two consecutive 14-bit writes; sine, FREQ0/PHASE0
+  writeDDS(&control, 1);
+
+  uint32_t tableId = ddsTableId;
+  int64_t period = (int64_t)(1000000 / modulation.baud_rate);
+  int64_t start = esp_timer_get_time();
+  int64_t deadline = start;
+  while (esp_timer_get_time() - start <= modulation.mod_time * 1000000) {
+    for (int i = 0; i < ddsSymbols; i++) {
+      uint8_t entry = ddsIndex[i];
+      if (frequencyMode) {
+        uint16_t words[2] = {ddsFreqLow[entry], ddsFreqHigh[entry]};
+        writeDDS(words, 2);
+      } else {
+        writeDDS(&ddsPhase[entry], 1);
+      }
+      deadline += period;
+      while (esp_timer_get_time() < deadline) {
+        if (Serial.available()) {
+          communicator();
+        }
+      }
+      if (ddsTableId != tableId) {
+        return;  // the modulation or the table changed
+      }
+    }
+  }
+}
+
 void setmod() {
   if (modulation.type.equals("MFSK") && modulation.m == 2) {
     maxstate = 1;
@@ -462,62 +750,915 @@ void setmod() {
   //modulation.data.size()
 }
 
+// Applies a set_channel command to the given channels. Returns "" on success.
+String applyChannel(JsonVariantConst op, Channel& ch1, Channel& ch2) {
+  int ch = op["channel"] | 1;
+  if (ch != 1 && ch != 2) {
+    return "Invalid channel";
+  }
+
+  applyChannelFields(op, (ch == 1) ? ch1 : ch2);
+  return "";
+}
+
+void applyChannelFields(JsonVariantConst op, Channel& target) {
+  target.type = op["type"] | target.type;
+  target.frequency = op["frequency"] | target.frequency;
+  target.phase = op["phase"] | target.phase;
+  target.enabled = op["enabled"] | target.enabled;
+}
+
+// Applies a set_modulation command to the given modulation. Returns "" on success.
+// Sets tableChanged when the op touches what a register table is compiled from;
+// the caller drops the table once it commits `mod`.
+String applyModulation(JsonVariantConst op, Modulation& mod, bool& tableChanged) {
+  if (op["data"].size() > MAX_DATA_SYMBOLS) {
+    return "Too many symbols";
+  }
+  if (!op["type"].isNull() || !op["m"].isNull() || !op["frequency"].isNull() ||
+      !op["delta_freq"].isNull() || !op["data"].isNull()) {
+    tableChanged = true;
+  }
+  mod.type = op["type"] | mod.type;
+  mod.m = op["m"] | mod.m;
+  mod.frequency = op["frequency"] | mod.frequency;
+  mod.delta_freq = op["delta_freq"] | mod.delta_freq;
+  mod.baud_rate = op["baud_rate"] | mod.baud_rate;
+  mod.mod_time = op["mod_time"] | mod.mod_time;
+  mod.enabled = op["enabled"] | mod.enabled;
+
+  // Partial updates leave the data untouched; only an explicit "data" replaces it
+  if (!op["data"].isNull()) {
+    mod.data.clear();
+    if (op["data"].is<JsonArrayConst>()) {
+      for (int val : op["data"].as<JsonArrayConst>()) {
+        mod.data.push_back(val);
+      }
+    }
+  }
+  return "";
+}
+
+// Applies an ordered list of set_channel/set_modulation operations to staged
+// copies of the state and commits them together, so both channels change in
+// the same loop() iteration. Nothing is applied if any operation fails.
+void processBatch(JsonArrayConst ops) {
+  if (ops.size() > MAX_BATCH_OPS) {
+    sendError("Too many operations");
+    return;
+  }
+
+  Channel staged1 = channel1;
+  Channel staged2 = channel2;
+  Modulation stagedMod = modulation;
+
+  StaticJsonDocument<1024> reply;
+  reply["status"] = "ok";
+  addRequestId(reply);
+  JsonArray results = reply.createNestedArray("results");
+
+  bool allOk = true;
+  bool tableChanged = false;
+  for (JsonVariantConst op : ops) {
+    String opCmd = op["cmd"] | "";
+    String error;
+    if (opCmd == "set_channel") {
+      error = applyChannel(op, staged1, staged2);
+    } else if (opCmd == "set_modulation") {
+      error = applyModulation(op, stagedMod, tableChanged);
+    } else {
+      error = "Unsupported batch command";
+    }
+
+    JsonObject result = results.createNestedObject();
+    if (error.length() == 0) {
+      result["status"] = "ok";
+    } else {
+      result["status"] = "error";
+      result["error"] = error;
+      allOk = false;
+    }
+  }
+
+  if (allOk) {
+    channel1 = staged1;
+    channel2 = staged2;
+    modulation = stagedMod;
+    if (tableChanged) {
+      ddsTableId = 0;
+    }
+  } else {
+    reply["status"] = "error";
+    reply["error"] = "Batch rejected";
+  }
+
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
 void processCommand(String jsonStr) {
-  StaticJsonDocument<1024> doc;
+  DynamicJsonDocument doc(COMMAND_DOC_CAPACITY);
   DeserializationError error = deserializeJson(doc, jsonStr);
 
+  requestId = 0;
   if (error) {
     sendError("Invalid JSON");
     return;
   }
+  runCommand(doc);
+}
 
+// Executes a parsed command, whether it arrived as a JSON line or a frame
+void runCommand(JsonDocument& doc) {
+  requestId = doc["id"] | 0;
   String cmd = doc["cmd"] | "";
   if (cmd == "get_settings") {
     sendSettings();
+  } else if (cmd == "hello") {
+    sendHello();
   } else if (cmd == "set_channel") {
-    int ch = doc["channel"] | 1;
-    if (ch != 1 && ch != 2) {
-      sendError("Invalid channel");
+    String err = applyChannel(doc.as<JsonVariantConst>(), channel1, channel2);
+    if (err.length() > 0) {
+      sendError(err);
       return;
     }
 
-    Channel* target = (ch == 1) ? &channel1 : &channel2;
-
-    target->type = doc["type"] | target->type;
-    target->frequency = doc["frequency"] | target->frequency;
-    target->phase = doc["phase"] | target->phase;
-    target->enabled = doc["enabled"] | target->enabled;
-
     // Apply channel settings to hardware here...
 
     sendOK();
   } else if (cmd == "set_modulation") {
-    modulation.type = doc["type"] | modulation.type;
-    modulation.m = doc["m"] | modulation.m;
-    modulation.frequency = doc["frequency"] | modulation.frequency;
-    modulation.delta_freq = doc["delta_freq"] | modulation.delta_freq;
-    modulation.baud_rate = doc["baud_rate"] | modulation.baud_rate;
-    modulation.mod_time = doc["mod_time"] | modulation.mod_time;
-    modulation.enabled = doc["enabled"] | modulation.enabled;
-
-    modulation.data.clear();
-    if (doc["data"].is<JsonArray>()) {
-      for (int val : doc["data"].as<JsonArray>()) {
-        modulation.data.push_back(val);
-      }
+    bool tableChanged = false;
+    String err = applyModulation(doc.as<JsonVariantConst>(), modulation, tableChanged);
+    if (err.length() > 0) {
+      sendError(err);
+      return;
+    }
+    if (tableChanged) {
+      ddsTableId = 0;
     }
 
     // Apply modulation settings to hardware here...
 
     sendOK();
+  } else if (cmd == "calibrate") {
+    calibrate(doc.as<JsonVariantConst>());
+  } else if (cmd == "set_calibration") {
+    setCalibration(doc.as<JsonVariantConst>());
+  } else if (cmd == "set_telemetry") {
+    float rate = doc["rate"] | telemetryRate;
+    if (rate < 0 || rate > TELEMETRY_MAX_RATE) {
+      sendError("Invalid rate");
+      return;
+    }
+    telemetryRate = rate;
+    telemetryCount = 0;
+    telemetryDropped = 0;
+    sendOK();
+  } else if (cmd == "set_pll") {
+    setPll(doc.as<JsonVariantConst>());
+  } else if (cmd == "store_preset") {
+    storePreset(doc.as<JsonVariantConst>());
+  } else if (cmd == "recall_preset") {
+    recallPreset(doc.as<JsonVariantConst>());
+  } else if (cmd == "list_presets") {
+    listPresets();
+  } else if (cmd == "delete_preset") {
+    int slot = doc["slot"] | -1;
+    if (slot < 0 || slot >= MAX_PRESETS) {
+      sendError("Invalid slot");
+      return;
+    }
+    char key[8];
+    presetKey(key, slot);
+    presetStore.remove(key);
+    sendOK();
+  } else if (cmd == "load_table") {
+    loadTable(doc.as<JsonVariantConst>());
+  } else if (cmd == "stream_start") {
+    startStream(doc.as<JsonVariantConst>());
+  } else if (cmd == "stream_data") {
+    pushStream(doc.as<JsonVariantConst>());
+  } else if (cmd == "stream_stop") {
+    streaming = false;
+    sendOK();
+  } else if (cmd == "batch") {
+    if (!doc["ops"].is<JsonArrayConst>()) {
+      sendError("Missing ops");
+      return;
+    }
+    processBatch(doc["ops"].as<JsonArrayConst>());
   } else {
     sendError("Unknown command");
   }
 }
 
+// One symbol of a `kind` loop: the same register writes the loop makes
+void calibrationStep(int kind, int symbol, int previous) {
+  switch (kind) {
+    case LOOP_BSK:
+      gen1.SetOutputSource(symbol == 0 ? REG0 : REG1);
+      break;
+    case LOOP_FSK:
+      gen1.IncrementFrequency(REG0, (symbol - previous) * modulation.delta_freq);
+      break;
+    case LOOP_PSK:
+      gen1.SetPhase(REG0, (symbol ^ (symbol >> 1)) * modulation.delta_freq);
+      break;
+    case LOOP_ASK:
+      gen1.EnableOutput(symbol != 0);
+      break;
+    case LOOP_SWEEP:
+      gen1.SetFrequency(REG0, modulation.frequency + symbol * modulation.delta_freq);
+      break;
+    case LOOP_PWM:
+      ledcWrite(PWM_CHANNEL_0, symbol);
+      break;
+  }
+}
+
+// Runs a modulation loop's symbol step with its current overhead and reports
+// how long each symbol really took. overhead_us is the measured period minus
+// the delay, i.e. what the loop's overhead should have been.
+void calibrate(JsonVariantConst op) {
+  int kind = loopKind(op["loop"] | "");
+  float baudRate = op["baud_rate"] | modulation.baud_rate;
+  long symbols = op["symbols"] | 200L;
+  int m = op["m"] | 4;
+  if (kind < 0) {
+    sendError("Unknown loop");
+    return;
+  }
+  if (baudRate <= 0) {
+    sendError("Invalid baud rate");
+    return;
+  }
+  if (symbols < 1 || symbols > CALIBRATION_MAX_SYMBOLS || symbols / baudRate > CALIBRATION_MAX_SECONDS) {
+    sendError("Invalid symbol count");
+    return;
+  }
+  if (m < 2) {
+    m = 2;
+  }
+
+  int timerz = symbolDelay(kind, baudRate);
+  gen1.ApplySignal(SINE_WAVE, REG0, modulation.frequency, REG0, 0.0);
+  int previous = 0;
+  int64_t total = 0;
+  int64_t totalSq = 0;
+  int64_t shortest = INT64_MAX;
+  int64_t longest = 0;
+  int64_t last = esp_timer_get_time();
+  for (long i = 0; i < symbols; i++) {
+    int symbol = (kind == LOOP_BSK || kind == LOOP_ASK) ? (i & 1) : (i % m);
+    calibrationStep(kind, symbol, previous);
+    previous = symbol;
+    Serial.available();  // the loops poll the port every symbol
+    delayMicroseconds(timerz);
+    int64_t now = esp_timer_get_time();
+    int64_t period = now - last;
+    last = now;
+    total += period;
+    totalSq += period * period;
+    shortest = min(shortest, period);
+    longest = max(longest, period);
+  }
+  gen1.EnableOutput(true);
+  if (!modulation.enabled) {
+    setgen();
+  }
+
+  double mean = (double)total / symbols;
+  double variance = (double)totalSq / symbols - mean * mean;
+  StaticJsonDocument<384> reply;
+  reply["status"] = "ok";
+  addRequestId(reply);
+  reply["loop"] = loopNames[kind];
+  reply["baud_rate"] = baudRate;
+  reply["symbols"] = symbols;
+  reply["delay_us"] = timerz;
+  reply["mean_us"] = mean;
+  reply["std_us"] = variance > 0 ? sqrt(variance) : 0.0;
+  reply["min_us"] = shortest;
+  reply["max_us"] = longest;
+  reply["overhead_us"] = mean - timerz;
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
+// {"cmd": "set_calibration", "overhead": {"FSK": [offset_us, slope_us_per_baud], ...}}
+void setCalibration(JsonVariantConst op) {
+  JsonObjectConst overhead = op["overhead"];
+  if (overhead.isNull()) {
+    sendError("Missing overhead");
+    return;
+  }
+  for (JsonPairConst entry : overhead) {
+    JsonArrayConst fit = entry.value();
+    if (loopKind(entry.key().c_str()) < 0 || fit.size() != 2 || !fit[0].is<float>() || !fit[1].is<float>()) {
+      sendError("Invalid calibration");
+      return;
+    }
+  }
+  for (JsonPairConst entry : overhead) {
+    int kind = loopKind(entry.key().c_str());
+    overheadOffset[kind] = entry.value()[0];
+    overheadSlope[kind] = entry.value()[1];
+  }
+  sendOK();
+}
+
+// {"cmd": "set_pll", "kp": ..., "kd": ..., "threshold": ...}; missing fields keep their value
+void setPll(JsonVariantConst op) {
+  float newKp = op["kp"] | kp;
+  float newKd = op["kd"] | kd;
+  float newThreshold = op["threshold"] | phaseThreshold;
+  if (newKp <= 0 || newKp >= 2 || newKd < 0 || newThreshold < 0) {
+    sendError("Invalid gains");
+    return;
+  }
+  kp = newKp;
+  kd = newKd;
+  phaseThreshold = newThreshold;
+  previousPhaseError = 0.0;
+  // Only rewrite flash when a gain changed, to spare NVS wear
+  bool saved = true;
+  if (pllStore.getFloat("kp", NAN) != kp) saved &= pllStore.putFloat("kp", kp) == sizeof(float);
+  if (pllStore.getFloat("kd", NAN) != kd) saved &= pllStore.putFloat("kd", kd) == sizeof(float);
+  if (pllStore.getFloat("threshold", NAN) != phaseThreshold) {
+    saved &= pllStore.putFloat("threshold", phaseThreshold) == sizeof(float);
+  }
+  if (!saved) {
+    sendError("Gains applied but not saved");
+    return;
+  }
+  sendOK();
+}
+
+// Restores the gains set_pll saved; out-of-range values in flash keep the defaults
+void loadPll() {
+  pllStore.begin("pll", false);
+  float savedKp = pllStore.getFloat("kp", kp);
+  float savedKd = pllStore.getFloat("kd", kd);
+  float savedThreshold = pllStore.getFloat("threshold", phaseThreshold);
+  if (savedKp > 0 && savedKp < 2 && savedKd >= 0 && savedThreshold >= 0) {
+    kp = savedKp;
+    kd = savedKd;
+    phaseThreshold = savedThreshold;
+  }
+}
+
+void presetKey(char* key, int slot) {
+  snprintf(key, 8, "p%d", slot);
+}
+
+// Applies a preset's "channel1", "channel2" and "modulation" objects. Returns "" on success.
+String applyPreset(JsonVariantConst preset, Channel& ch1, Channel& ch2, Modulation& mod, bool& tableChanged) {
+  if (!preset["channel1"].is<JsonObjectConst>() || !preset["channel2"].is<JsonObjectConst>() ||
+      !preset["modulation"].is<JsonObjectConst>()) {
+    return "Invalid preset";
+  }
+  applyChannelFields(preset["channel1"], ch1);
+  applyChannelFields(preset["channel2"], ch2);
+  return applyModulation(preset["modulation"], mod, tableChanged);
+}
+
+// Reads a slot into `preset`; with summaryOnly just its name and checksum
+bool loadPreset(int slot, JsonDocument& preset, bool summaryOnly) {
+  char key[8];
+  presetKey(key, slot);
+  if (!presetStore.isKey(key)) {
+    return false;
+  }
+  size_t size = presetStore.getBytesLength(key);
+  uint8_t* blob = (uint8_t*)malloc(size);
+  if (blob == NULL) {
+    return false;
+  }
+  bool ok = presetStore.getBytes(key, blob, size) == size;
+  if (ok) {
+    // A const pointer makes ArduinoJson copy the strings out of the blob
+    DeserializationError error;
+    if (summaryOnly) {
+      StaticJsonDocument<64> filter;
+      filter["name"] = true;
+      filter["checksum"] = true;
+      error = deserializeMsgPack(preset, (const uint8_t*)blob, size, DeserializationOption::Filter(filter));
+    } else {
+      error = deserializeMsgPack(preset, (const uint8_t*)blob, size);
+    }
+    ok = !error;
+  }
+  free(blob);
+  return ok;
+}
+
+// {"cmd": "store_preset", "slot": n, "name": ..., "checksum": ..., "channel1": {...},
+//  "channel2": {...}, "modulation": {...}}. The checksum is the host's tag for the
+// content; the reply repeats it as read back from flash.
+void storePreset(JsonVariantConst op) {
+  int slot = op["slot"] | -1;
+  const char* name = op["name"] | "";
+  const char* checksum = op["checksum"] | "";
+  if (slot < 0 || slot >= MAX_PRESETS) {
+    sendError("Invalid slot");
+    return;
+  }
+  if (strlen(name) == 0 || strlen(name) > PRESET_NAME_LENGTH || strlen(checksum) == 0) {
+    sendError("Invalid preset");
+    return;
+  }
+  // Validate on scratch copies; nothing is committed
+  Channel staged1 = channel1;
+  Channel staged2 = channel2;
+  Modulation stagedMod = modulation;
+  bool tableChanged = false;
+  String err = applyPreset(op, staged1, staged2, stagedMod, tableChanged);
+  if (err.length() > 0) {
+    sendError(err);
+    return;
+  }
+
+  DynamicJsonDocument preset(op.memoryUsage() + 256);
+  preset["name"] = name;
+  preset["checksum"] = checksum;
+  preset["channel1"] = op["channel1"];
+  preset["channel2"] = op["channel2"];
+  preset["modulation"] = op["modulation"];
+  size_t size = measureMsgPack(preset);
+  uint8_t* blob = (uint8_t*)malloc(size);
+  if (blob == NULL) {
+    sendError("No memory");
+    return;
+  }
+  serializeMsgPack(preset, blob, size);
+  char key[8];
+  presetKey(key, slot);
+  size_t written = presetStore.putBytes(key, blob, size);
+  free(blob);
+
+  StaticJsonDocument<128> stored;
+  if (written != size || !loadPreset(slot, stored, true)) {
+    sendError("Preset write failed");
+    return;
+  }
+  StaticJsonDocument<192> reply;
+  reply["status"] = "ok";
+  addRequestId(reply);
+  reply["slot"] = slot;
+  reply["checksum"] = stored["checksum"].as<String>();
+  reply["bytes"] = size;
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
+// {"cmd": "recall_preset", "slot": n}: applies the whole stored state at once
+void recallPreset(JsonVariantConst op) {
+  int slot = op["slot"] | -1;
+  if (slot < 0 || slot >= MAX_PRESETS) {
+    sendError("Invalid slot");
+    return;
+  }
+  DynamicJsonDocument preset(COMMAND_DOC_CAPACITY);
+  if (!loadPreset(slot, preset, false)) {
+    sendError("Empty slot");
+    return;
+  }
+  Channel staged1 = channel1;
+  Channel staged2 = channel2;
+  Modulation stagedMod = modulation;
+  bool tableChanged = false;
+  String err = applyPreset(preset.as<JsonVariantConst>(), staged1, staged2, stagedMod, tableChanged);
+  if (err.length() > 0) {
+    sendError(err);
+    return;
+  }
+  channel1 = staged1;
+  channel2 = staged2;
+  modulation = stagedMod;
+  if (tableChanged) {
+    ddsTableId = 0;
+  }
+
+  StaticJsonDocument<192> reply;
+  reply["status"] = "ok";
+  addRequestId(reply);
+  reply["slot"] = slot;
+  reply["checksum"] = preset["checksum"].as<String>();
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
+void listPresets() {
+  DynamicJsonDocument reply(2048);
+  reply["status"] = "ok";
+  addRequestId(reply);
+  reply["slots"] = MAX_PRESETS;
+  JsonArray presets = reply.createNestedArray("presets");
+  for (int slot = 0; slot < MAX_PRESETS; slot++) {
+    StaticJsonDocument<128> summary;
+    if (!loadPreset(slot, summary, true)) {
+      continue;
+    }
+    JsonObject entry = presets.createNestedObject();
+    entry["slot"] = slot;
+    entry["name"] = summary["name"].as<String>();
+    entry["checksum"] = summary["checksum"].as<String>();
+  }
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
+// Loads a register table compiled by dds.py for the current modulation data:
+// FREQ (28-bit) and PHASE (12-bit) words per entry and an entry per symbol.
+void loadTable(JsonVariantConst op) {
+  JsonArrayConst freq = op["freq"];
+  JsonArrayConst phase = op["phase"];
+  JsonArrayConst index = op["index"];
+  size_t entries = freq.size();
+  if (entries == 0 || entries > DDS_TABLE_SIZE || phase.size() != entries) {
+    sendError("Invalid table");
+    return;
+  }
+  if (index.size() != modulation.data.size() || index.size() > MAX_DATA_SYMBOLS) {
+    sendError("Table does not match data");
+    return;
+  }
+  for (size_t i = 0; i < entries; i++) {
+    if (freq[i].as<uint32_t>() >= (1UL << 28) || phase[i].as<uint32_t>() >= 4096) {
+      sendError("Invalid table");
+      return;
+    }
+  }
+  for (JsonVariantConst entry : index) {
+    if (entry.as<uint32_t>() >= entries) {
+      sendError("Invalid table");
+      return;
+    }
+  }
+
+  for (size_t i = 0; i < entries; i++) {
+    uint32_t word = freq[i].as<uint32_t>();
+    ddsFreqLow[i] = 0x4000 | (word & 0x3FFF);
+    ddsFreqHigh[i] = 0x4000 | (word >> 14);
+    ddsPhase[i] = 0xC000 | phase[i].as<uint16_t>();
+  }
+  ddsSymbols = 0;
+  for (JsonVariantConst entry : index) {
+    ddsIndex[ddsSymbols++] = entry.as<uint8_t>();
+  }
+  ddsTableId = op["table_id"] | 1UL;
+  if (ddsTableId == 0) {
+    ddsTableId = 1;
+  }
+  sendOK();
+}
+
+// Applies the stream's modulation fields and empties the ring buffer.
+// Playback starts in loop() once the prefill has arrived.
+void startStream(JsonVariantConst op) {
+  Modulation staged = modulation;
+  bool tableChanged = false;
+  String err = applyModulation(op, staged, tableChanged);
+  if (err.length() == 0 && !(staged.type.equals("MFSK") || staged.type.equals("MPSK") || staged.type.equals("ASK"))) {
+    err = "Streaming not supported for " + staged.type;
+  }
+  if (err.length() == 0 && staged.baud_rate <= 0) {
+    err = "Invalid baud rate";
+  }
+  if (err.length() > 0) {
+    sendError(err);
+    return;
+  }
+  modulation = staged;
+  if (tableChanged) {
+    ddsTableId = 0;
+  }
+
+  streamWritten = 0;
+  streamPlayed = 0;
+  streamCredited = 0;
+  streamUnderruns = 0;
+  streamPrefill = op["prefill"] | (STREAM_BUFFER_SIZE / 2);
+  if (streamPrefill > STREAM_BUFFER_SIZE) {
+    streamPrefill = STREAM_BUFFER_SIZE;
+  }
+  streamEnding = false;
+  streamTag = op["stream"] | 0UL;
+  streaming = true;
+
+  StaticJsonDocument<128> reply;
+  reply["status"] = "ok";
+  addRequestId(reply);
+  reply["stream"] = streamTag;
+  reply["capacity"] = STREAM_BUFFER_SIZE;
+  reply["credit_batch"] = STREAM_CREDIT_BATCH;
+  reply["baud_rate"] = modulation.baud_rate;
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
+// Appends a chunk of symbols to the ring buffer. A chunk that does not fit
+// is rejected whole; the host only sends what its credits cover.
+void pushStream(JsonVariantConst op) {
+  JsonArrayConst symbols = op["symbols"];
+  String err = checkStreamRoom(symbols.size());
+  if (err.length() > 0) {
+    sendError(err);
+    return;
+  }
+  // Check the whole chunk first, so a bad symbol rejects it without a partial write
+  int limit = streamSymbolLimit();
+  for (JsonVariantConst symbol : symbols) {
+    if (!symbol.is<int>() || symbol.as<int>() < 0 || symbol.as<int>() > limit) {
+      sendError("Symbol out of range");
+      return;
+    }
+  }
+  for (JsonVariantConst symbol : symbols) {
+    streamBuffer[streamWritten % STREAM_BUFFER_SIZE] = (uint8_t)symbol.as<int>();
+    streamWritten++;
+  }
+  if (op["end"] | false) {
+    streamEnding = true;
+  }
+  sendOK();
+}
+
+// Largest symbol the streamed modulation can play: m - 1, within the uint8_t ring buffer
+int streamSymbolLimit() {
+  return (modulation.m >= 2 && modulation.m <= 256) ? modulation.m - 1 : 255;
+}
+
+String checkStreamRoom(uint32_t count) {
+  if (!streaming) {
+    return "Not streaming";
+  }
+  if (count > STREAM_BUFFER_SIZE - (streamWritten - streamPlayed)) {
+    return "Stream buffer overflow";
+  }
+  return "";
+}
+
+// Collects a binary frame byte by byte. Returns true once a whole frame has
+// been handled.
+bool receiveFrameByte(uint8_t b) {
+  if (frameFill == 0) {
+    frameStarted = esp_timer_get_time();
+  }
+  frameBuffer[frameFill++] = b;
+  if (frameFill < FRAME_HEADER) {
+    return false;
+  }
+  uint16_t length = frameBuffer[2] | (frameBuffer[3] << 8);
+  if (length > FRAME_MAX_PAYLOAD) {
+    frameFill = 0;
+    requestId = 0;
+    sendError("Frame too long");
+    return false;
+  }
+  if (frameFill < FRAME_HEADER + length + 2) {
+    return false;
+  }
+
+  frameFill = 0;
+  requestId = (long)((uint32_t)frameBuffer[4] | ((uint32_t)frameBuffer[5] << 8) |
+                     ((uint32_t)frameBuffer[6] << 16) | ((uint32_t)frameBuffer[7] << 24));
+  uint16_t crc = frameBuffer[FRAME_HEADER + length] | (frameBuffer[FRAME_HEADER + length + 1] << 8);
+  if (crc16(frameBuffer + 1, FRAME_HEADER - 1 + length) != crc) {
+    sendError("Bad CRC");
+    return true;
+  }
+  processFrame(frameBuffer[1], frameBuffer + FRAME_HEADER, length);
+  return true;
+}
+
+// CRC-16/CCITT-FALSE: polynomial 0x1021, initial value 0xFFFF
+uint16_t crc16(const uint8_t* data, size_t length) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < length; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+float readFloat(const uint8_t* p) {
+  float value;
+  memcpy(&value, p, sizeof(value));  // the ESP32 is little endian, like the frame
+  return value;
+}
+
+// Symbol i of an array packed MSB first at 1, 2, 4, 8 or 16 bits per symbol
+uint16_t readSymbol(const uint8_t* packed, uint8_t width, uint16_t i) {
+  if (width == 16) {
+    return packed[2 * i] | (packed[2 * i + 1] << 8);
+  }
+  if (width == 8) {
+    return packed[i];
+  }
+  uint8_t perByte = 8 / width;
+  return (packed[i / perByte] >> (8 - width * (i % perByte + 1))) & ((1 << width) - 1);
+}
+
+// Reads a symbol array header (width u8, count u16) at `offset`. Returns the
+// offset of the packed symbols, or -1 if the array is malformed or truncated.
+int symbolData(const uint8_t* payload, uint16_t length, uint16_t offset, uint8_t& width, uint16_t& count) {
+  if (offset + 3 > length) {
+    return -1;
+  }
+  width = payload[offset];
+  count = payload[offset + 1] | (payload[offset + 2] << 8);
+  if (!(width == 1 || width == 2 || width == 4 || width == 8 || width == 16)) {
+    return -1;
+  }
+  if (offset + 3 + ((uint32_t)width * count + 7) / 8 > length) {
+    return -1;
+  }
+  return offset + 3;
+}
+
+// Expands a set_channel or set_modulation payload into the JSON command it
+// stands for, so frames go through the same applyChannel/applyModulation.
+bool decodeOp(uint8_t type, const uint8_t* p, uint16_t length, JsonObject op) {
+  static const char* signalTypes[] = {"Sine", "Square", "Triangle"};
+  static const char* modulationTypes[] = {"MFSK", "MPSK", "ASK", "SWEEP", "PWM", "AM"};
+  if (type == FRAME_SET_CHANNEL) {
+    // channel, field mask, type, enabled, frequency, phase
+    if (length < 12 || p[2] > 2) {
+      return false;
+    }
+    uint8_t mask = p[1];
+    op["cmd"] = "set_channel";
+    op["channel"] = p[0];
+    if (mask & 0x01) op["type"] = signalTypes[p[2]];
+    if (mask & 0x02) op["frequency"] = readFloat(p + 4);
+    if (mask & 0x04) op["phase"] = readFloat(p + 8);
+    if (mask & 0x08) op["enabled"] = p[3] != 0;
+    return true;
+  }
+  if (type == FRAME_SET_MODULATION) {
+    // field mask, type, enabled, m, frequency, delta_freq, baud_rate, mod_time [, symbols]
+    if (length < 21 || p[1] > 5) {
+      return false;
+    }
+    uint8_t mask = p[0];
+    op["cmd"] = "set_modulation";
+    if (mask & 0x01) op["type"] = modulationTypes[p[1]];
+    if (mask & 0x02) op["m"] = p[3] | (p[4] << 8);
+    if (mask & 0x04) op["frequency"] = readFloat(p + 5);
+    if (mask & 0x08) op["delta_freq"] = readFloat(p + 9);
+    if (mask & 0x10) op["baud_rate"] = readFloat(p + 13);
+    if (mask & 0x20) op["mod_time"] = readFloat(p + 17);
+    if (mask & 0x80) op["enabled"] = p[2] != 0;
+    if (mask & 0x40) {
+      uint8_t width;
+      uint16_t count;
+      int data = symbolData(p, length, 21, width, count);
+      if (data < 0 || count > MAX_DATA_SYMBOLS) {
+        return false;
+      }
+      JsonArray values = op.createNestedArray("data");
+      for (uint16_t i = 0; i < count; i++) {
+        if (!values.add(readSymbol(p + data, width, i))) {
+          return false;
+        }
+      }
+    }
+    return true;
+  }
+  return false;
+}
+
+void processFrame(uint8_t type, const uint8_t* payload, uint16_t length) {
+  if (type == FRAME_STREAM_DATA) {
+    pushStreamFrame(payload, length);
+    return;
+  }
+
+  DynamicJsonDocument doc(COMMAND_DOC_CAPACITY);
+  bool ok = true;
+  if (type == FRAME_BATCH) {
+    // op count, then per op: frame type, payload length (u16), payload
+    doc["cmd"] = "batch";
+    JsonArray ops = doc.createNestedArray("ops");
+    uint16_t offset = 1;
+    for (uint8_t i = 0; ok && length > 0 && i < payload[0]; i++) {
+      if (offset + 3 > length) {
+        ok = false;
+        break;
+      }
+      uint8_t opType = payload[offset];
+      uint16_t opLength = payload[offset + 1] | (payload[offset + 2] << 8);
+      offset += 3;
+      ok = offset + opLength <= length && decodeOp(opType, payload + offset, opLength, ops.createNestedObject());
+      offset += opLength;
+    }
+    ok = ok && length > 0;
+  } else {
+    ok = decodeOp(type, payload, length, doc.to<JsonObject>());
+  }
+  if (!ok || doc.overflowed()) {
+    sendError("Bad frame");
+    return;
+  }
+  doc["id"] = requestId;
+  runCommand(doc);
+}
+
+// stream_data as a frame: flags, then the packed symbols go straight into
+// the ring buffer without building a JSON document
+void pushStreamFrame(const uint8_t* payload, uint16_t length) {
+  uint8_t width;
+  uint16_t count;
+  int data = length > 0 ? symbolData(payload, length, 1, width, count) : -1;
+  if (data < 0) {
+    sendError("Bad frame");
+    return;
+  }
+  String err = checkStreamRoom(count);
+  if (err.length() > 0) {
+    sendError(err);
+    return;
+  }
+  int limit = streamSymbolLimit();
+  for (uint16_t i = 0; i < count; i++) {
+    if (readSymbol(payload + data, width, i) > limit) {
+      sendError("Symbol out of range");
+      return;
+    }
+  }
+  for (uint16_t i = 0; i < count; i++) {
+    streamBuffer[streamWritten % STREAM_BUFFER_SIZE] = (uint8_t)readSymbol(payload + data, width, i);
+    streamWritten++;
+  }
+  if (payload[0] & FRAME_STREAM_END) {
+    streamEnding = true;
+  }
+  sendOK();
+}
+
+void sendHello() {
+  StaticJsonDocument<192> reply;
+  reply["status"] = "ok";
+  addRequestId(reply);
+  JsonArray protocols = reply.createNestedArray("protocols");
+  protocols.add("json");
+  protocols.add("binary1");
+  reply["max_payload"] = FRAME_MAX_PAYLOAD;
+  serializeJson(reply, Serial);
+  Serial.println();
+}
+
+// Unsolicited messages carry "event" instead of "status" and never an "id"
+void sendReady() {
+  StaticJsonDocument<128> event;
+  char board[13];
+  boardId(board, sizeof(board));
+  event["event"] = "ready";
+  event["board"] = board;
+  serializeJson(event, Serial);
+  Serial.println();
+}
+
+void sendStreamCredit(uint32_t tag) {
+  StaticJsonDocument<128> event;
+  event["event"] = "stream_credit";
+  event["stream"] = tag;
+  event["credits"] = streamPlayed - streamCredited;
+  event["underruns"] = streamUnderruns;
+  streamCredited = streamPlayed;
+  serializeJson(event, Serial);
+  Serial.println();
+}
+
+void sendStreamEnd(const char* reason, uint32_t tag) {
+  StaticJsonDocument<128> event;
+  event["event"] = "stream_end";
+  event["stream"] = tag;
+  event["reason"] = reason;
+  event["played"] = streamPlayed;
+  event["underruns"] = streamUnderruns;
+  serializeJson(event, Serial);
+  Serial.println();
+}
+
+void boardId(char* board, size_t size) {
+  uint64_t mac = ESP.getEfuseMac();
+  snprintf(board, size, "%04X%08X", (uint16_t)(mac >> 32), (uint32_t)mac);
+}
+
+void addRequestId(JsonDocument& doc) {
+  if (requestId != 0) {
+    doc["id"] = requestId;
+  }
+}
+
 void sendSettings() {
-  StaticJsonDocument<1024> doc;
+  DynamicJsonDocument doc(COMMAND_DOC_CAPACITY);
   doc["status"] = "ok";
+  addRequestId(doc);
 
   JsonObject ch1 = doc.createNestedObject("channel1");
   ch1["type"] = channel1.type;
@@ -539,23 +1680,48 @@ void sendSettings() {
   mod["baud_rate"] = modulation.baud_rate;
   mod["mod_time"] = modulation.mod_time;
   mod["enabled"] = modulation.enabled;
+  mod["table_id"] = ddsTableId;
 
   JsonArray dataArray = mod.createNestedArray("data");
   for (int val : modulation.data) {
     dataArray.add(val);
   }
 
+  // Per-board identity (the factory MAC) so the host can pick this board's calibration
+  char board[13];
+  boardId(board, sizeof(board));
+  doc["board"] = board;
+  JsonObject pll = doc.createNestedObject("pll");
+  pll["kp"] = kp;
+  pll["kd"] = kd;
+  pll["threshold"] = phaseThreshold;
+
+  JsonObject telemetry = doc.createNestedObject("telemetry");
+  telemetry["rate"] = telemetryRate;
+
+  JsonObject calibration = doc.createNestedObject("calibration");
+  for (int kind = 0; kind < LOOP_KINDS; kind++) {
+    JsonArray fit = calibration.createNestedArray(loopNames[kind]);
+    fit.add(overheadOffset[kind]);
+    fit.add(overheadSlope[kind]);
+  }
+
   serializeJson(doc, Serial);
   Serial.println();
 }
 
 void sendOK() {
-  Serial.println("{\"status\":\"ok\"}");
+  StaticJsonDocument<64> ok;
+  ok["status"] = "ok";
+  addRequestId(ok);
+  serializeJson(ok, Serial);
+  Serial.println();
 }
 
 void sendError(String message) {
   StaticJsonDocument<256> err;
   err["status"] = "error";
+  addRequestId(err);
   err["error"] = message;
   serializeJson(err, Serial);
   Serial.println();
@@ -0,0 +1,271 @@
+"""Host-side protocol benchmark.
+
+Measures command throughput, round-trip latency percentiles, bytes on the
+wire per command and host CPU use against a virtual board (simulator.py,
+run in its own process so its CPU time is not counted) or a real one with
+--port. Where the device negotiates binary frames, the data-heavy
+scenarios run once with JSON lines and once with frames. The startup
+scenarios time a headless `import client` in a fresh interpreter and
+connect() from opening the port to having the settings, with the reset
+and ready banner and without a reset:
+
+    python benchmark.py -n 200 --json results.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from client import READY_TIMEOUT, DeviceClient, batch_command, channel_command, modulation_command, is_ok
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulator.py")
+CONNECT_TARGET = 1.0  # seconds from opening the port to connected
+IMPORT_PROBE = ("import sys, time; started = time.perf_counter(); import client; "
+                "print(time.perf_counter() - started, 'tkinter' in sys.modules)")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Measurement:
+    """Wall time, host CPU time, bytes sent and per-command latencies of one scenario"""
+
+    def __init__(self, name, transport=None):
+        self.name = name
+        self.transport = transport
+        self.latencies = []
+        self.errors = 0
+
+    def __enter__(self):
+        self._bytes = self._bytes_written()
+        self._cpu = self._cpu_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = self._cpu_time() - self._cpu
+        self.bytes = self._bytes_written() - self._bytes
+
+    def _bytes_written(self):
+        # Scenarios that open their own ports have no single transport to count
+        return self.transport.bytes_written if self.transport else float("nan")
+
+    @staticmethod
+    def _cpu_time():
+        times = os.times()
+        return times.user + times.system
+
+    def record(self, started, response):
+        self.latencies.append(time.perf_counter() - started)
+        if not is_ok(response):
+            self.errors += 1
+
+    def result(self):
+        count = len(self.latencies)
+        return {
+            "scenario": self.name,
+            "commands": count,
+            "errors": self.errors,
+            "commands_per_s": count / self.wall if self.wall else float("nan"),
+            "bytes_per_cmd": self.bytes / count if count else float("nan"),
+            "p50_ms": percentile(self.latencies, 0.50) * 1000,
+            "p99_ms": percentile(self.latencies, 0.99) * 1000,
+            "cpu_percent": 100 * self.cpu / self.wall if self.wall else float("nan"),
+        }
+
+
+def bench_round_trips(client, n):
+    """Sequential get_settings, one command in flight"""
+    with Measurement("get_settings", client.transport) as m:
+        for _ in range(n):
+            started = time.perf_counter()
+            m.record(started, client.request({"cmd": "get_settings"}))
+    return m.result()
+
+
+def bench_pipelined(client, n, depth):
+    """get_settings with up to `depth` commands in flight"""
+    transport = client.transport
+    with Measurement(f"get_settings x{depth} in flight", transport) as m:
+        in_flight = []
+        for i in range(n):
+            in_flight.append((time.perf_counter(), transport.send({"cmd": "get_settings"})))
+            if len(in_flight) >= depth or i == n - 1:
+                for started, future in in_flight:
+                    response = transport.wait(future)
+                    m.record(started, response)
+                in_flight = []
+    return m.result()
+
+
+def apply_all_commands(step, data):
+    """The commands apply_all_settings sends, with frequencies varied per step"""
+    return [
+        modulation_command("MFSK", 2, 100000.0, 1000.0, 1000.0, 10.0, data, False),
+        channel_command(1, "Sine", 1000.0 + step, 0.0, True),
+        channel_command(2, "Square", 2000.0 + step, 90.0, True),
+    ]
+
+
+def framing_name(client):
+    return "binary" if client.transport.binary else "json"
+
+
+def bench_apply_all(client, n, data, full):
+    """apply_all_settings: delta sync, or a full resend of every field"""
+    name = f"apply_all {'full' if full else 'delta'} ({len(data)} symbols, {framing_name(client)})"
+    with Measurement(name, client.transport) as m:
+        for step in range(n):
+            commands = apply_all_commands(step, data)
+            started = time.perf_counter()
+            if full:
+                m.record(started, client.request(batch_command(commands)))
+            else:
+                m.record(started, client.apply(commands))
+    return m.result()
+
+
+def bench_large_data(client, n, size):
+    """set_modulation carrying a `size`-symbol data array"""
+    with Measurement(f"set_modulation {size} symbols ({framing_name(client)})", client.transport) as m:
+        for step in range(n):
+            data = [(step + i) % 2 for i in range(size)]
+            started = time.perf_counter()
+            m.record(started, client.request(modulation_command(data=data)))
+    return m.result()
+
+
+def bench_import(n):
+    """`import client` in a fresh interpreter; loading tkinter counts as an error"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with Measurement("import client (headless)") as m:
+        for _ in range(n):
+            output = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=directory, capture_output=True,
+                                    text=True, check=True).stdout.split()
+            m.latencies.append(float(output[0]))
+            if output[1] == "True":
+                m.errors += 1
+    return m.result()
+
+
+def bench_connect(port, n, reset, ready_timeout, binary):
+    """DeviceClient.connect from opening the port until the settings are read"""
+    name = f"connect ({'reset, ready banner' if reset else 'no reset'})"
+    with Measurement(name) as m:
+        for _ in range(n):
+            client = DeviceClient(calibrations={})
+            started = time.perf_counter()
+            try:
+                response = client.connect(port, ready_timeout, binary=binary, reset=reset)
+            except Exception as e:
+                response = {"status": "error", "error": str(e)}
+            m.record(started, response)
+            client.close()
+    return m.result()
+
+
+def run_startup(args, port):
+    results = [bench_import(args.connects)]
+    results.append(bench_connect(port, args.connects, True, args.ready_timeout, not args.json_only))
+    if args.port:
+        results.append(bench_connect(port, args.connects, False, args.ready_timeout, not args.json_only))
+        return results
+
+    # The virtual board reboots on every open unless told not to, as it cannot see DTR
+    simulator, no_reset_port = start_simulator(args, "--no-reset")
+    try:
+        results.append(bench_connect(no_reset_port, args.connects, False, args.ready_timeout, not args.json_only))
+    finally:
+        simulator.terminate()
+        simulator.wait()
+    return results
+
+
+def start_simulator(args, *options):
+    command = [sys.executable, SIMULATOR, "--baud", str(args.baud), "--delay", str(args.delay), *options]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    port = process.stdout.readline().strip()
+    if not port:
+        process.kill()
+        raise RuntimeError("Simulator failed to start")
+    return process, port
+
+
+def run(args):
+    simulator = None
+    port = args.port
+    if port is None:
+        simulator, port = start_simulator(args)
+
+    results = []
+    client = DeviceClient()
+    try:
+        if args.connects:
+            results += run_startup(args, port)
+        client.connect(port, args.ready_timeout, binary=not args.json_only)
+        framings = [False, True] if client.transport.binary else [False]
+        data = [i % 2 for i in range(args.apply_data)]
+        results += [
+            bench_round_trips(client, args.n),
+            bench_pipelined(client, args.n, args.depth),
+        ]
+        for binary in framings:
+            client.transport.binary = binary
+            results.append(bench_apply_all(client, args.n, data, full=True))
+            results.append(bench_apply_all(client, args.n, data, full=False))
+            for size in args.data_sizes:
+                results.append(bench_large_data(client, max(1, args.n // 4), size))
+    finally:
+        client.close()
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait()
+    return results
+
+
+def print_table(results):
+    header = (f"{'scenario':46} {'cmds':>6} {'err':>4} {'cmd/s':>9} {'B/cmd':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'cpu %':>6}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:46} {r['commands']:6d} {r['errors']:4d} {r['commands_per_s']:9.1f} "
+              f"{r['bytes_per_cmd']:8.1f} {r['p50_ms']:8.2f} {r['p99_ms']:8.2f} {r['cpu_percent']:6.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the host/ESP32 protocol")
+    parser.add_argument("--port", help="benchmark a real device instead of the simulator")
+    parser.add_argument("-n", type=int, default=100, help="commands per scenario")
+    parser.add_argument("--depth", type=int, default=8, help="commands in flight for the pipelined scenario")
+    parser.add_argument("--baud", type=float, default=115200, help="simulator baud rate (0 for unlimited)")
+    parser.add_argument("--delay", type=float, default=0.0005, help="simulator processing delay per command (s)")
+    parser.add_argument("--apply-data", type=int, default=64, help="symbols in the apply_all data array")
+    parser.add_argument("--data-sizes", type=int, nargs="*", default=[100, 500], help="data array sizes")
+    parser.add_argument("--ready-timeout", type=float, default=READY_TIMEOUT,
+                        help="seconds to wait for the ready banner after opening the port")
+    parser.add_argument("--connects", type=int, default=5, help="runs of each startup scenario (0 to skip them)")
+    parser.add_argument("--json-only", action="store_true", help="do not negotiate binary frames")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_table(results)
+    for r in results:
+        if r["scenario"].startswith("connect"):
+            verdict = "meets" if r["p50_ms"] < CONNECT_TARGET * 1000 else "misses"
+            print(f"{r['scenario']}: p50 {r['p50_ms']:.0f} ms {verdict} the {CONNECT_TARGET * 1000:.0f} ms target")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import collections
+import hashlib
+import json
+import threading
+
+
+def params_key(*parts):
+    """Stable hash of JSON-like parameters (arrays are hashed by content)"""
+    def encode(value):
+        if hasattr(value, "tobytes"):
+            return {"dtype": str(value.dtype), "shape": list(value.shape),
+                    "sha": hashlib.blake2b(value.tobytes(), digest_size=16).hexdigest()}
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        raise TypeError(f"Cannot hash {type(value).__name__}")
+
+    text = json.dumps(parts, sort_keys=True, default=encode)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a fixed number of entries"""
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, computing and storing it on a miss"""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
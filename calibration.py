@@ -0,0 +1,161 @@
+"""Per-board symbol-timing calibration.
+
+Each modulation loop in FUNGENE_V2.ino waits `1e6 / baud_rate - overhead`
+microseconds after a symbol, where the overhead is what the loop's register
+writes take. The calibrate command runs one loop's symbol step N times
+and reports the measured per-symbol statistics. This module sweeps those
+measurements over baud rates, fits
+
+    overhead_us = offset + slope * baud_rate
+
+for each loop by least squares, caches the fit per board (keyed by the
+"board" id from get_settings) and turns it into the set_calibration
+command that is pushed back on connect. `achieved_baud` predicts the baud
+rate a loop really runs at with a given calibration.
+
+tests/test_calibration.py checks the fit against the simulator (`python -m pytest tests`).
+"""
+import json
+import math
+import os
+import time
+
+LOOPS = ("BSK", "FSK", "PSK", "ASK", "SWEEP", "PWM")
+# The firmware's original hand-tuned overheads (us), used until a board is calibrated
+DEFAULT_OVERHEAD = {"BSK": (39.0, 0.0), "FSK": (114.0, 0.0), "PSK": (40.0, 0.0),
+                    "ASK": (39.0, 0.0), "SWEEP": (114.0, 0.0), "PWM": (5.0, 0.0)}
+CALIBRATION_BAUDS = (100.0, 500.0, 1000.0, 2000.0, 5000.0, 10000.0)
+CALIBRATION_SECONDS = 0.2  # per measurement
+MAX_SYMBOLS = 10000  # CALIBRATION_MAX_SYMBOLS in FUNGENE_V2.ino
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".fungene", "calibration.json")
+
+
+def loop_kind(mod_type, m):
+    """The firmware loop that plays a modulation type, or None for loops without a symbol clock"""
+    if mod_type in ("MFSK", "MPSK") and int(m) == 2:
+        return "BSK"
+    return {"MFSK": "FSK", "MPSK": "PSK", "ASK": "ASK", "SWEEP": "SWEEP", "PWM": "PWM"}.get(mod_type)
+
+
+def calibrate_command(loop, baud_rate, symbols=None, m=4):
+    """A calibrate command measuring about CALIBRATION_SECONDS of symbols"""
+    if symbols is None:
+        symbols = max(20, min(MAX_SYMBOLS, int(baud_rate * CALIBRATION_SECONDS)))
+    return {"cmd": "calibrate", "loop": loop, "baud_rate": float(baud_rate), "symbols": int(symbols), "m": int(m)}
+
+
+def fit_line(points):
+    """Least-squares (offset, slope) through (x, y) points; a flat line for a single x"""
+    n = len(points)
+    if n == 0:
+        raise ValueError("No points to fit")
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    if sxx == 0:
+        return mean_y, 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / sxx
+    return mean_y - slope * mean_x, slope
+
+
+def symbol_delay(overhead, baud_rate):
+    """symbolDelay() in FUNGENE_V2.ino: the whole microseconds waited after each symbol"""
+    offset, slope = overhead
+    return max(int(1000000 / baud_rate - (offset + slope * baud_rate)), 0)
+
+
+class Calibration:
+    """Fitted per-loop overhead for one board"""
+
+    def __init__(self, board, overhead, samples=None, created=None):
+        self.board = board
+        self.overhead = {loop: tuple(fit) for loop, fit in overhead.items()}
+        self.samples = samples or {}  # loop -> [(baud_rate, overhead_us, std_us), ...]
+        self.created = created if created is not None else time.time()
+
+    @classmethod
+    def from_results(cls, board, results):
+        """Fit calibrate replies (each with loop, baud_rate, overhead_us, std_us)"""
+        samples = {}
+        for result in results:
+            samples.setdefault(result["loop"], []).append(
+                (float(result["baud_rate"]), float(result["overhead_us"]), float(result.get("std_us", 0.0))))
+        overhead = {loop: fit_line([(baud, value) for baud, value, _ in points])
+                    for loop, points in samples.items()}
+        return cls(board, overhead, samples)
+
+    def overhead_us(self, loop, baud_rate):
+        offset, slope = _fit(self, loop)
+        return offset + slope * baud_rate
+
+    def residual_us(self, loop):
+        """RMS distance of a loop's measurements from its fit"""
+        points = self.samples.get(loop, [])
+        if not points:
+            return 0.0
+        return math.sqrt(sum((value - self.overhead_us(loop, baud)) ** 2 for baud, value, _ in points) / len(points))
+
+    def command(self):
+        return {"cmd": "set_calibration",
+                "overhead": {loop: [round(offset, 3), round(slope, 6)] for loop, (offset, slope) in self.overhead.items()}}
+
+    def to_dict(self):
+        return {"board": self.board, "created": self.created,
+                "overhead": {loop: list(fit) for loop, fit in self.overhead.items()},
+                "samples": {loop: [list(point) for point in points] for loop, points in self.samples.items()}}
+
+    @classmethod
+    def from_dict(cls, value):
+        samples = {loop: [tuple(point) for point in points] for loop, points in value.get("samples", {}).items()}
+        return cls(value["board"], value["overhead"], samples, value.get("created"))
+
+
+def achieved_baud(baud_rate, loop, applied=None, actual=None):
+    """(achieved baud rate, relative error) of a loop.
+
+    `applied` is the calibration the firmware subtracts (None for the
+    defaults), `actual` the best knowledge of what the loop really takes
+    (defaults to `applied`).
+    """
+    applied_fit = _fit(applied, loop)
+    offset, slope = _fit(actual, loop) if actual else applied_fit
+    period = symbol_delay(applied_fit, baud_rate) + max(offset + slope * baud_rate, 0.0)
+    if period <= 0:
+        return float(baud_rate), 0.0
+    achieved = 1000000.0 / period
+    return achieved, achieved / baud_rate - 1.0
+
+
+def _fit(calibration, loop):
+    return calibration.overhead.get(loop, DEFAULT_OVERHEAD[loop]) if calibration else DEFAULT_OVERHEAD[loop]
+
+
+class CalibrationCache:
+    """Calibrations of every board seen, in a JSON file"""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self._boards = None
+
+    def _load(self):
+        if self._boards is None:
+            try:
+                with open(self.path) as f:
+                    self._boards = {board: Calibration.from_dict(value) for board, value in json.load(f).items()}
+            except (OSError, ValueError, KeyError, TypeError):
+                self._boards = {}
+        return self._boards
+
+    def get(self, board):
+        return self._load().get(board) if board else None
+
+    def put(self, calibration):
+        boards = self._load()
+        boards[calibration.board] = calibration
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({board: value.to_dict() for board, value in boards.items()}, f, indent=2)
+        os.replace(temporary, self.path)
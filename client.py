@@ -0,0 +1,656 @@
+"""Headless control of FUNGENE signal generators.
+
+`DeviceClient` drives one generator with blocking calls and is what the Tk
+GUI is built on. `AsyncDeviceClient` and `Fleet` expose the same JSON
+commands (get_settings, set_channel, set_modulation, batch, streaming) through asyncio,
+so many generators on different serial ports can be configured at once:
+
+    async with Fleet(["/dev/ttyUSB0", "/dev/ttyUSB1"]) as fleet:
+        results = await fleet.run(lambda dev: dev.set_channel(1, frequency=5000.0))
+"""
+import asyncio
+import collections
+import functools
+import time
+
+import framing
+from calibration import CALIBRATION_BAUDS, LOOPS, Calibration, CalibrationCache, calibrate_command
+from device_state import DeviceState
+from presets import store_command
+from streaming import SymbolStream
+from transport import BAUD_RATE, RESPONSE_TIMEOUT, SerialTransport
+
+MAX_FREQUENCY = 3000000  # Hz
+READY_TIMEOUT = 3  # seconds to wait for the ready banner after the port opens and resets the ESP32
+READY_POLL = 0.05  # seconds between cancellation checks while waiting
+MAX_DATA_SYMBOLS = 1000  # MAX_DATA_SYMBOLS in FUNGENE_V2.ino
+TELEMETRY_SAMPLE_BYTES = 23  # JSON bytes per sample across dt, measured, target and phase
+TELEMETRY_LINK_SHARE = 0.5  # fraction of the link telemetry may take, leaving room for replies
+
+
+def channel_command(channel, sig_type=None, frequency=None, phase=None, enabled=None):
+    """Build a set_channel command from the fields that are given"""
+    if frequency is not None and frequency > MAX_FREQUENCY:
+        raise ValueError("Maximum frequency is 3 MHz")
+    command = {"cmd": "set_channel", "channel": channel}
+    for key, value in (("type", sig_type), ("frequency", frequency), ("phase", phase), ("enabled", enabled)):
+        if value is not None:
+            command[key] = value
+    return command
+
+
+def modulation_command(mod_type=None, m=None, frequency=None, delta_freq=None, baud_rate=None,
+                       mod_time=None, data=None, enabled=None):
+    """Build a set_modulation command from the fields that are given.
+
+    `data` may be a datasource.SymbolSource; it is kept as is and streamed
+    from the file when the command is sent.
+    """
+    if data is not None and not hasattr(data, "iter_chunks"):
+        data = list(data)
+    if data is not None and len(data) > MAX_DATA_SYMBOLS:
+        raise ValueError(f"At most {MAX_DATA_SYMBOLS} data symbols fit on the device")
+    command = {"cmd": "set_modulation"}
+    for key, value in (("type", mod_type), ("m", m), ("frequency", frequency), ("delta_freq", delta_freq),
+                       ("baud_rate", baud_rate), ("mod_time", mod_time), ("data", data), ("enabled", enabled)):
+        if value is not None:
+            command[key] = value
+    return command
+
+
+def pll_command(kp=None, kd=None, threshold=None):
+    """Build a set_pll command; fields left as None keep their current value"""
+    command = {"cmd": "set_pll"}
+    for key, value in (("kp", kp), ("kd", kd), ("threshold", threshold)):
+        if value is not None:
+            command[key] = float(value)
+    return command
+
+
+def max_telemetry_rate(baud_rate=BAUD_RATE, share=TELEMETRY_LINK_SHARE):
+    """Highest telemetry rate (samples/s) that uses at most `share` of an 8N1 link"""
+    return int(baud_rate / 10 * share / TELEMETRY_SAMPLE_BYTES)
+
+
+def telemetry_command(rate):
+    """Build a set_telemetry command; a rate of 0 samples/s turns telemetry off"""
+    return {"cmd": "set_telemetry", "rate": float(rate)}
+
+
+def parse_data(text):
+    """Parse a comma-separated symbol string; raises ValueError if malformed"""
+    if not text.strip():
+        return []
+    return [int(x.strip()) for x in text.split(',')]
+
+
+def batch_command(commands):
+    """Wrap set_channel/set_modulation commands in one batch command.
+
+    The firmware applies the operations in order and commits them
+    together, answering with one status per operation under "results".
+    """
+    return {"cmd": "batch", "ops": list(commands)}
+
+
+def hello_command():
+    """Ask which protocols the firmware speaks besides JSON lines"""
+    return {"cmd": "hello", "protocols": [framing.PROTOCOL]}
+
+
+def accept_hello(transport, response):
+    """Turn on binary frames if the hello reply offers them.
+
+    Firmware without the handshake answers "Unknown command" and the
+    transport stays on JSON.
+    """
+    offered = response.get("protocols", []) if is_ok(response) else []
+    transport.binary = framing.PROTOCOL in offered
+    if transport.binary:
+        transport.max_payload = min(int(response.get("max_payload", framing.MAX_PAYLOAD)), framing.MAX_PAYLOAD)
+    return transport.binary
+
+
+def is_ok(response):
+    return bool(response and response.get("status") == "ok")
+
+
+def error_of(response):
+    return response.get("error", "Unknown error") if response else "No response"
+
+
+class ApplyPlan:
+    """The part of a settings apply that differs from the device's state.
+
+    Commands are reduced against the DeviceState mirror; `indices` maps each
+    remaining op back to its position in the original command list.
+    """
+
+    def __init__(self, state, commands):
+        self.state = state
+        self.ops = []
+        self.indices = []
+        for index, command in enumerate(commands):
+            reduced = state.diff(command)
+            if reduced is not None:
+                self.ops.append(reduced)
+                self.indices.append(index)
+
+    @property
+    def empty(self):
+        return not self.ops
+
+    def batch(self):
+        return batch_command(self.ops)
+
+    def record(self, op, response):
+        """Update the mirror with the outcome of one op"""
+        if is_ok(response):
+            self.state.commit(op)
+        else:
+            self.state.forget(op)
+
+    def record_batch(self, response):
+        """Update the mirror from a batch reply and summarise it"""
+        for op in self.ops:
+            self.record(op, response)
+        if is_ok(response):
+            return {"status": "ok", "sent": len(self.ops)}
+
+        results = response.get("results", []) if response else []
+        for index, result in zip(self.indices, results):
+            if not is_ok(result):
+                return {"status": "error", "error": error_of(result), "failed": index}
+        return {"status": "error", "error": error_of(response), "failed": None}
+
+    def forget_all(self):
+        for op in self.ops:
+            self.state.forget(op)
+
+    @staticmethod
+    def unsupported(response):
+        """True if the firmware predates the batch command"""
+        return bool(response and response.get("error") == "Unknown command")
+
+
+class DeviceClient:
+    """Blocking client for one signal generator.
+
+    Methods that talk to the device accept an optional `job` with
+    `request(transport, command, timeout)`, `sleep(seconds)` and `check_cancelled()`
+    so callers such as the GUI can cancel them part-way.
+    """
+
+    def __init__(self, calibrations=None, instruments=None):
+        self.transport = None
+        self.instruments = instruments  # an instrumentation.Instruments handed to every transport
+        self.recorder = None  # recording.SessionRecorder logging the link, see start_recording
+        self.state = DeviceState()
+        self.calibrations = calibrations if calibrations is not None else CalibrationCache()
+        self.board = None  # "board" id from get_settings
+        self.calibration = None  # the Calibration the device is using, None for its defaults
+        self._telemetry = None  # callback receiving telemetry events
+
+    @property
+    def connected(self):
+        return self.transport is not None
+
+    def connect(self, port, ready_timeout=READY_TIMEOUT, job=None, binary=True, reset=True):
+        """Open the port, wait for the ESP32 to be ready and read its settings.
+
+        Opening the port resets the board; connect goes on as soon as the
+        firmware's ready banner arrives, or after `ready_timeout` seconds
+        for firmware that does not send one. With reset=False the port is
+        opened without toggling DTR, so a running board keeps its settings
+        and is used at once. With `binary`, binary frames are negotiated
+        (see framing.py).
+        """
+        self.transport = SerialTransport(port, reset=reset, instruments=self.instruments, recorder=self.recorder)
+        try:
+            if reset:
+                self.wait_ready(ready_timeout, job)
+            if binary:
+                self.negotiate(job)
+            response = self.get_settings(job)
+            self.push_calibration(job)
+            return response
+        except BaseException:
+            self.close()
+            raise
+
+    def wait_ready(self, timeout=READY_TIMEOUT, job=None):
+        """Wait for the ready banner; False if it did not come within `timeout` seconds"""
+        deadline = time.monotonic() + timeout
+        while not self.transport.wait_ready(min(READY_POLL, max(deadline - time.monotonic(), 0))):
+            if job is not None:
+                job.check_cancelled()
+            if time.monotonic() >= deadline:
+                return False
+        return True
+
+    def start_recording(self, recorder):
+        """Log every message of this and later connections to a recording.SessionRecorder"""
+        self.stop_recording()
+        self.recorder = recorder
+        transport = self.transport
+        if transport is not None:
+            recorder.open(port=transport.serial_port.port, baudrate=transport.serial_port.baudrate,
+                          mid_session=True)
+            transport.recorder = recorder
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            if self.transport is not None:
+                self.transport.recorder = None
+            recorder.close()
+        return recorder
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+        self.state.invalidate()
+        self.board = None
+        self.calibration = None
+        self._telemetry = None
+
+    def negotiate(self, job=None):
+        """Use binary frames from now on if the firmware supports them"""
+        return accept_hello(self.transport, self.request(hello_command(), job))
+
+    def request(self, command, job=None, timeout=RESPONSE_TIMEOUT):
+        """Send any command and wait for the matching response"""
+        transport = self.transport
+        if not transport:
+            return None
+        if job is not None:
+            return job.request(transport, command, timeout)
+        return transport.request(command, timeout)
+
+    def get_settings(self, job=None):
+        """Fetch get_settings and refresh the device state mirror"""
+        response = self.request({"cmd": "get_settings"}, job)
+        if is_ok(response):
+            self.state.load(response)
+            self.board = response.get("board")
+        return response
+
+    def set_pll(self, kp=None, kd=None, threshold=None, job=None):
+        """Set the channel phase-sync gains, e.g. the ones pll.recommend found; the board keeps them in NVS"""
+        return self.request(pll_command(kp, kd, threshold), job)
+
+    def start_telemetry(self, buffer, rate, job=None):
+        """Feed phase-loop telemetry into `buffer` (a telemetry.TelemetryBuffer) at up to `rate` samples/s"""
+        if not self.transport:
+            return None
+        self._unsubscribe_telemetry()
+        self._telemetry = buffer.append_event
+        self.transport.subscribe("telemetry", self._telemetry)
+        response = self.request(telemetry_command(rate), job)
+        if not is_ok(response):
+            self._unsubscribe_telemetry()
+        return response
+
+    def stop_telemetry(self, job=None):
+        try:
+            return self.request(telemetry_command(0), job)
+        finally:
+            self._unsubscribe_telemetry()
+
+    def _unsubscribe_telemetry(self):
+        if self._telemetry is not None and self.transport:
+            self.transport.unsubscribe("telemetry", self._telemetry)
+        self._telemetry = None
+
+    def push_calibration(self, job=None):
+        """Send this board's cached symbol-timing calibration, if there is one"""
+        calibration = self.calibrations.get(self.board)
+        if calibration is None:
+            return None
+        self.calibration = calibration if is_ok(self.request(calibration.command(), job)) else None
+        return self.calibration
+
+    def calibrate(self, job=None, progress=None, loops=LOOPS, bauds=CALIBRATION_BAUDS):
+        """Measure every loop's per-symbol overhead, fit it, cache it and push it.
+
+        `progress(fraction, loop, baud_rate)` is called before each
+        measurement. Returns the failing response, or {"status": "ok",
+        "calibration": Calibration}.
+        """
+        steps = [(loop, baud_rate) for loop in loops for baud_rate in bauds]
+        results = []
+        for step, (loop, baud_rate) in enumerate(steps):
+            if progress is not None:
+                progress(step / len(steps), loop, baud_rate)
+            command = calibrate_command(loop, baud_rate)
+            response = self.request(command, job, RESPONSE_TIMEOUT + command["symbols"] / baud_rate)
+            if not is_ok(response):
+                return response
+            results.append(response)
+
+        calibration = Calibration.from_results(self.board, results)
+        response = self.request(calibration.command(), job)
+        if not is_ok(response):
+            return response
+        self.calibration = calibration
+        if self.board:
+            self.calibrations.put(calibration)
+        return {"status": "ok", "calibration": calibration}
+
+    def send_settings_command(self, command, job=None):
+        """Send a set_channel/set_modulation/load_table command and update the mirror.
+
+        Only acknowledged writes are recorded; fields of a failed or
+        timed-out write are forgotten so the next apply resends them.
+        """
+        try:
+            response = self.request(command, job)
+        except BaseException:
+            self.state.forget(command)
+            raise
+        if is_ok(response):
+            self.state.commit(command)
+        else:
+            self.state.forget(command)
+        return response
+
+    def set_channel(self, channel, sig_type=None, frequency=None, phase=None, enabled=None, job=None):
+        return self.send_settings_command(channel_command(channel, sig_type, frequency, phase, enabled), job)
+
+    def set_modulation(self, job=None, **fields):
+        return self.send_settings_command(modulation_command(**fields), job)
+
+    def load_table(self, params, job=None):
+        """Compile MFSK/MPSK `params` into AD9833 register words (see dds.py) and load them.
+
+        The table is skipped if the device already holds it. On success
+        the response carries the dds.DDSTable as "table"; firmware without
+        load_table answers "Unknown command" and keeps computing the
+        registers itself.
+        """
+        from dds import compile_table  # NumPy is only needed for register tables
+        table = compile_table(params)
+        current = (self.state.snapshot() or {}).get("modulation", {})
+        if current.get("table_id") == table.id:
+            return {"status": "ok", "sent": 0, "table": table}
+        command = table.command()
+        response = self.send_settings_command(command, job)
+        if is_ok(response):
+            response = dict(response, sent=1, table=table)
+        return response
+
+    def list_presets(self, job=None):
+        """The slots the device holds presets in, with their names and checksums"""
+        return self.request({"cmd": "list_presets"}, job)
+
+    def store_preset(self, slot, name, settings, checksum=None, job=None):
+        """Write a preset to the device's flash (see presets.py)"""
+        command = store_command(slot, name, settings, checksum)
+        response = self.request(command, job)
+        if is_ok(response) and response.get("checksum") != command["checksum"]:
+            return {"status": "error", "error": "Preset checksum mismatch"}
+        return response
+
+    def delete_preset(self, slot, job=None):
+        return self.request({"cmd": "delete_preset", "slot": slot}, job)
+
+    def recall_preset(self, slot, settings=None, checksum=None, job=None):
+        """Switch the device to a stored preset with one command.
+
+        If the device reports the preset's `checksum`, the mirror takes
+        `settings`; otherwise the mirror is dropped until the next
+        get_settings, as the device's state is not known.
+        """
+        try:
+            response = self.request({"cmd": "recall_preset", "slot": slot}, job)
+        except BaseException:
+            self.state.invalidate()
+            raise
+        if is_ok(response):
+            if settings is not None and response.get("checksum") == checksum:
+                self.state.load(settings)
+            else:
+                self.state.invalidate()
+        elif error_of(response).startswith("Timeout"):
+            self.state.invalidate()
+        return response
+
+    def stream(self, symbols, job=None, progress=None, **fields):
+        """Play `symbols` continuously in streaming mode; see streaming.SymbolStream.
+
+        `symbols` is any iterable of ints (e.g. streaming.prbs()) or a
+        datasource.SymbolSource; `fields` are set_modulation fields applied
+        when the stream starts. Blocks until the device has played them all.
+        """
+        if not self.transport:
+            return None
+        command = modulation_command(**fields)
+        try:
+            return SymbolStream(self.transport).run(symbols, command, job, progress)
+        finally:
+            self.state.forget(command)  # stream_start may have applied them
+
+    def apply(self, commands, job=None, progress=None):
+        """Bring the device in line with `commands` in a single round trip.
+
+        Only changed fields are sent, as one batch. Returns a dict with
+        "status", and on failure "error" and the index of the "failed"
+        command (None if the whole batch failed). "sent" is 0 if the
+        device already had every value.
+        """
+        plan = ApplyPlan(self.state, commands)
+        if plan.empty:
+            return {"status": "ok", "sent": 0}
+
+        try:
+            response = self.request(plan.batch(), job)
+        except BaseException:
+            plan.forget_all()
+            raise
+        if not plan.unsupported(response):
+            return plan.record_batch(response)
+
+        # Firmware without batch support: one round trip per command
+        for step, (index, op) in enumerate(zip(plan.indices, plan.ops)):
+            if progress is not None:
+                progress(step / len(plan.ops), index)
+            response = self.send_settings_command(op, job)
+            if not is_ok(response):
+                return {"status": "error", "error": error_of(response), "failed": index}
+        return {"status": "ok", "sent": len(plan.ops)}
+
+
+class AsyncDeviceClient:
+    """asyncio client for one signal generator.
+
+    The serial reader still runs on its own thread; replies complete
+    concurrent Futures that are awaited here, so any number of devices can
+    be waited on from one event loop.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.transport = None
+        self.state = DeviceState()
+
+    async def open(self, ready_timeout=READY_TIMEOUT, binary=True, reset=True):
+        """Open the port, wait for the ESP32 to be ready and negotiate the framing"""
+        loop = asyncio.get_running_loop()
+        opening = loop.run_in_executor(None, functools.partial(SerialTransport, self.port, reset=reset))
+        try:
+            self.transport = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # The port still opens in the executor; close it as soon as it has
+            opening.add_done_callback(lambda f: f.cancelled() or f.exception() or f.result().close())
+            raise
+        try:
+            if reset:
+                # Poll rather than park an executor thread per port, so many boards can boot at once
+                deadline = loop.time() + ready_timeout
+                while not self.transport.ready.is_set() and loop.time() < deadline:
+                    await asyncio.sleep(READY_POLL)
+            if binary:
+                accept_hello(self.transport, await self.request(hello_command()))
+        except BaseException:
+            # Do not leave the port and its reader thread open behind a failed or cancelled open
+            await asyncio.shield(self.close())
+            raise
+
+    async def close(self):
+        if self.transport:
+            transport, self.transport = self.transport, None
+            await asyncio.get_running_loop().run_in_executor(None, transport.close)
+        self.state.invalidate()
+
+    async def request(self, command, timeout=RESPONSE_TIMEOUT):
+        """Send any command and await the matching response"""
+        transport = self.transport
+        if not transport:
+            return None
+        try:
+            future = transport.send(command)
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            return transport.expire(future)
+        except ConnectionError as e:
+            return {"status": "error", "error": str(e)}
+        finally:
+            transport.discard(future)
+
+    async def get_settings(self):
+        response = await self.request({"cmd": "get_settings"})
+        if is_ok(response):
+            self.state.load(response)
+        return response
+
+    async def send_settings_command(self, command):
+        try:
+            response = await self.request(command)
+        except BaseException:
+            self.state.forget(command)
+            raise
+        if is_ok(response):
+            self.state.commit(command)
+        else:
+            self.state.forget(command)
+        return response
+
+    async def set_channel(self, channel, sig_type=None, frequency=None, phase=None, enabled=None):
+        return await self.send_settings_command(channel_command(channel, sig_type, frequency, phase, enabled))
+
+    async def set_modulation(self, **fields):
+        return await self.send_settings_command(modulation_command(**fields))
+
+    async def stream(self, symbols, **fields):
+        """Same as DeviceClient.stream; the feeding loop runs on an executor thread"""
+        if not self.transport:
+            return None
+        command = modulation_command(**fields)
+        stream = SymbolStream(self.transport)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, stream.run, symbols, command)
+        finally:
+            self.state.forget(command)
+
+    async def apply(self, commands):
+        """Same as DeviceClient.apply"""
+        plan = ApplyPlan(self.state, commands)
+        if plan.empty:
+            return {"status": "ok", "sent": 0}
+
+        try:
+            response = await self.request(plan.batch())
+        except BaseException:
+            plan.forget_all()
+            raise
+        if not plan.unsupported(response):
+            return plan.record_batch(response)
+
+        for index, op in zip(plan.indices, plan.ops):
+            response = await self.send_settings_command(op)
+            if not is_ok(response):
+                return {"status": "error", "error": error_of(response), "failed": index}
+        return {"status": "ok", "sent": len(plan.ops)}
+
+
+class FleetResult(collections.namedtuple("FleetResult", "port value error")):
+    """Outcome of one Fleet operation on one device"""
+
+    @property
+    def ok(self):
+        if self.error is not None:
+            return False
+        return is_ok(self.value) if isinstance(self.value, dict) else True
+
+
+class Fleet:
+    """A set of generators driven concurrently from one event loop.
+
+    Ports are opened together, so the boards reset in parallel rather than
+    once per board. Ports that fail to open are reported in `errors` and
+    left out of later operations.
+    """
+
+    def __init__(self, ports, ready_timeout=READY_TIMEOUT, timeout=RESPONSE_TIMEOUT, reset=True):
+        self.ports = list(ports)
+        self.ready_timeout = ready_timeout
+        self.reset = reset
+        self.timeout = timeout
+        self.devices = {}
+        self.errors = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """Open every port concurrently"""
+        clients = [AsyncDeviceClient(port) for port in self.ports]
+        results = await asyncio.gather(*(client.open(self.ready_timeout, reset=self.reset) for client in clients),
+                                       return_exceptions=True)
+        for client, result in zip(clients, results):
+            if isinstance(result, BaseException):
+                self.errors[client.port] = result
+            else:
+                self.devices[client.port] = client
+        return self
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.devices.values()), return_exceptions=True)
+        self.devices.clear()
+
+    async def run(self, action, timeout=None):
+        """Run `action(client)` on every open device at once.
+
+        Returns {port: FleetResult}; exceptions and timeouts are captured
+        per device rather than raised.
+        """
+        timeout = self.timeout if timeout is None else timeout
+
+        async def run_one(port, client):
+            try:
+                return FleetResult(port, await asyncio.wait_for(action(client), timeout), None)
+            except asyncio.TimeoutError:
+                return FleetResult(port, None, TimeoutError("Timeout waiting for response"))
+            except Exception as e:
+                return FleetResult(port, None, e)
+
+        results = await asyncio.gather(*(run_one(port, client) for port, client in self.devices.items()))
+        return {result.port: result for result in results}
+
+    async def broadcast(self, command, timeout=None):
+        """Send the same command to every device"""
+        return await self.run(lambda client: client.request(command), timeout)
+
+    async def get_settings(self, timeout=None):
+        return await self.run(lambda client: client.get_settings(), timeout)
+
+    async def apply(self, commands, timeout=None):
+        return await self.run(lambda client: client.apply(commands), timeout)
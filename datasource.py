@@ -0,0 +1,167 @@
+"""M-ary symbol sources backed by memory-mapped files.
+
+A SymbolSource unpacks a file into symbols of log2(M) bits each (MSB
+first) on demand, a window at a time, with vectorized bit operations. The
+file is never read into Python lists or strings. Supported formats:
+
+    binary  raw bytes
+    hex     hex digits, e.g. `xxd -p` output; whitespace, ',', ':' and '-' are ignored
+    bits    '0'/'1' characters, with the same separators ignored
+"""
+import mmap
+import os
+
+import numpy as np
+
+FORMATS = ("binary", "hex", "bits")
+INDEX_BLOCK = 1 << 16  # bytes of text per checkpoint in the digit index
+SEPARATORS = b" \t\r\n,:-"
+
+_INVALID = 0xFF
+_SKIP = 0xFE
+
+
+def _digit_table(fmt):
+    table = np.full(256, _INVALID, dtype=np.uint8)
+    table[np.frombuffer(SEPARATORS, dtype=np.uint8)] = _SKIP
+    if fmt == "hex":
+        for value, char in enumerate(b"0123456789abcdef"):
+            table[char] = value
+            table[ord(chr(char).upper())] = value
+    else:
+        table[ord("0")] = 0
+        table[ord("1")] = 1
+    return table
+
+
+def guess_format(path):
+    """Pick a format from the file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".hex", ".txt"):
+        return "hex"
+    if ext in (".bits", ".bit"):
+        return "bits"
+    return "binary"
+
+
+def bits_per_symbol(m):
+    k = int(m).bit_length() - 1
+    if m < 2 or (1 << k) != m:
+        raise ValueError("M must be a power of two to unpack symbols from a file")
+    return k
+
+
+class SymbolSource:
+    """Lazily unpacked M-ary symbols from a file"""
+
+    def __init__(self, path, m, fmt=None):
+        self.path = path
+        self.m = int(m)
+        self.format = fmt or guess_format(path)
+        if self.format not in FORMATS:
+            raise ValueError(f"Unknown format: {self.format}")
+        self.bits = bits_per_symbol(self.m)
+
+        stat = os.stat(path)
+        self.token = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}:{self.m}:{self.format}"
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else None
+        self._bytes = np.frombuffer(self._map, dtype=np.uint8) if self._map else np.empty(0, dtype=np.uint8)
+
+        if self.format == "binary":
+            self._digit_bits = 8
+            total_bits = len(self._bytes) * 8
+        else:
+            self._digit_bits = 4 if self.format == "hex" else 1
+            self._table = _digit_table(self.format)
+            self._build_index()
+            total_bits = int(self._digits_before[-1]) * self._digit_bits
+        self.length = total_bits // self.bits
+
+    def __len__(self):
+        return self.length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __eq__(self, other):
+        return isinstance(other, SymbolSource) and other.token == self.token
+
+    def __hash__(self):
+        return hash(self.token)
+
+    def __copy__(self):
+        return self  # read-only view; the device state mirror keeps it as is
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f"<SymbolSource {os.path.basename(self.path)}: {self.length} symbols, M={self.m}>"
+
+    def close(self):
+        self._bytes = np.empty(0, dtype=np.uint8)
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # a window is still being read elsewhere; the map is freed with it
+            self._map = None
+        self._file.close()
+
+    def window(self, start, count):
+        """Symbols [start, start + count) as a uint32 array"""
+        start = max(0, start)
+        count = max(0, min(count, self.length - start))
+        if count == 0:
+            return np.empty(0, dtype=np.uint32)
+
+        first_bit = start * self.bits
+        last_bit = (start + count) * self.bits
+        first_digit = first_bit // self._digit_bits
+        last_digit = -(-last_bit // self._digit_bits)
+        digits = self._digits(first_digit, last_digit)
+
+        bits = np.unpackbits(digits[:, None], axis=1)[:, 8 - self._digit_bits:].ravel()
+        offset = first_bit - first_digit * self._digit_bits
+        bits = bits[offset:offset + count * self.bits].reshape(count, self.bits)
+        weights = (1 << np.arange(self.bits - 1, -1, -1)).astype(np.uint32)
+        return bits.astype(np.uint32) @ weights
+
+    def iter_chunks(self, chunk_size=4096, start=0, stop=None):
+        """Yield consecutive windows of at most chunk_size symbols"""
+        stop = self.length if stop is None else min(stop, self.length)
+        for offset in range(start, stop, chunk_size):
+            yield self.window(offset, min(chunk_size, stop - offset))
+
+    def _digits(self, first, last):
+        """Digit values [first, last) of the file"""
+        if self.format == "binary":
+            return self._bytes[first:last]
+
+        # Start at the checkpoint block holding `first`, map bytes forward
+        block = int(np.searchsorted(self._digits_before, first, side="right")) - 1
+        end_block = int(np.searchsorted(self._digits_before, last, side="left"))
+        raw = self._bytes[block * INDEX_BLOCK:end_block * INDEX_BLOCK]
+        values = self._table[raw]
+        values = values[values < 16]
+        skip = first - int(self._digits_before[block])
+        return values[skip:skip + (last - first)]
+
+    def _build_index(self):
+        """Count the digits in every INDEX_BLOCK bytes, a few blocks at a time"""
+        blocks = -(-len(self._bytes) // INDEX_BLOCK)
+        counts = np.zeros(blocks, dtype=np.int64)
+        step = 64 * INDEX_BLOCK
+        for offset in range(0, len(self._bytes), step):
+            values = self._table[self._bytes[offset:offset + step]]
+            bad = np.flatnonzero(values == _INVALID)
+            if len(bad):
+                raise ValueError(f"Invalid {self.format} character at byte {offset + int(bad[0])}")
+            digits = (values < 16).astype(np.int64)
+            edges = np.arange(0, len(values), INDEX_BLOCK)
+            counts[offset // INDEX_BLOCK:offset // INDEX_BLOCK + len(edges)] = np.add.reduceat(digits, edges)
+        self._digits_before = np.concatenate(([0], np.cumsum(counts)))
@@ -0,0 +1,115 @@
+"""Compile M-FSK/M-PSK symbol streams into AD9833 register words.
+
+The AD9833 output frequency is FREQ * MCLK / 2^28 for a 28-bit FREQ word,
+and the phase offset is PHASE * 360 / 4096 degrees for a 12-bit PHASE word.
+Instead of the firmware converting floats for every symbol, the host works
+out the exact words once. It rounds to the nearest word. It keeps one
+table entry per distinct (FREQ, PHASE) pair and turns the data into
+indices into that table, reporting how far each entry lands from the
+requested value. The firmware's load_table command takes the result and
+FSK()/PSK() then write the precomputed words over SPI.
+
+Tables are cached by configuration, so applying the same setup again costs
+a dictionary lookup.
+"""
+import numpy as np
+
+from cache import LRUCache, params_key
+
+MCLK = 25000000  # Hz, the AD9833 library's default reference clock
+FREQ_BITS = 28
+PHASE_BITS = 12
+MAX_TABLE_ENTRIES = 256  # DDS_TABLE_SIZE in FUNGENE_V2.ino
+TABLE_TYPES = ("MFSK", "MPSK")
+
+_table_cache = LRUCache(maxsize=32)
+
+
+def frequency_word(frequency, mclk=MCLK):
+    """Nearest FREQ word(s) for frequencies in Hz"""
+    words = np.rint(np.asarray(frequency, dtype=np.float64) * (1 << FREQ_BITS) / mclk)
+    if np.any(words < 0) or np.any(words >= 1 << FREQ_BITS):
+        raise ValueError(f"Frequency outside 0..{mclk / 2 ** FREQ_BITS * ((1 << FREQ_BITS) - 1):.0f} Hz")
+    return words.astype(np.uint32)
+
+
+def phase_word(degrees):
+    """Nearest PHASE word(s) for phases in degrees, wrapped to one turn"""
+    return (np.rint(np.asarray(degrees, dtype=np.float64) * (1 << PHASE_BITS) / 360.0).astype(np.int64)
+            % (1 << PHASE_BITS)).astype(np.uint16)
+
+
+def symbol_targets(params):
+    """Requested (frequency Hz, phase degrees) for each data symbol, as FSK()/PSK() compute them"""
+    mod_type, m = params["type"], int(params["m"])
+    if mod_type not in TABLE_TYPES:
+        raise ValueError(f"No register table for {mod_type}")
+    data = np.asarray(params.get("data") or [0], dtype=np.int64)
+    top = 1 if m == 2 else m - 1
+    symbols = np.clip(data, 0, top)
+    carrier, delta = float(params["frequency"]), float(params["delta_freq"])
+    if mod_type == "MFSK":
+        return carrier + symbols * delta, np.zeros(len(symbols))
+    gray = symbols ^ (symbols >> 1)
+    return np.full(len(symbols), carrier), gray * delta
+
+
+def uses_table(params):
+    """True if FSK()/PSK() would play `params` from a register table (M > 2, some data)"""
+    return params["type"] in TABLE_TYPES and int(params["m"]) > 2 and bool(len(params.get("data") or []))
+
+
+class DDSTable:
+    """Deduplicated register words plus one table index per data symbol"""
+
+    def __init__(self, table_id, freq_words, phase_words, index, requested_hz, requested_deg, mclk):
+        self.id = table_id
+        self.freq_words = freq_words
+        self.phase_words = phase_words
+        self.index = index
+        self.mclk = mclk
+        self.frequencies_hz = freq_words * (mclk / float(1 << FREQ_BITS))
+        self.phases_deg = phase_words * (360.0 / (1 << PHASE_BITS))
+        self.freq_error_hz = self.frequencies_hz - requested_hz
+        self.phase_error_deg = (self.phases_deg - requested_deg + 180.0) % 360.0 - 180.0
+
+    def __len__(self):
+        return len(self.freq_words)
+
+    @property
+    def max_freq_error_hz(self):
+        return float(np.max(np.abs(self.freq_error_hz))) if len(self) else 0.0
+
+    @property
+    def max_phase_error_deg(self):
+        return float(np.max(np.abs(self.phase_error_deg))) if len(self) else 0.0
+
+    def command(self):
+        """The load_table command for this table"""
+        return {"cmd": "load_table", "table_id": self.id, "freq": self.freq_words.tolist(),
+                "phase": self.phase_words.tolist(), "index": self.index.tolist()}
+
+    def summary(self):
+        return (f"{len(self)} register entries for {len(self.index)} symbols, "
+                f"max error {self.max_freq_error_hz:.4f} Hz / {self.max_phase_error_deg:.4f} deg")
+
+
+def compile_table(params, mclk=MCLK):
+    """Compile a modulation setup into a DDSTable (cached by configuration)"""
+    key = params_key("dds", params["type"], int(params["m"]), float(params["frequency"]),
+                     float(params["delta_freq"]), np.asarray(params.get("data") or [], dtype=np.int64), mclk)
+
+    def compute():
+        requested_hz, requested_deg = symbol_targets(params)
+        freq = frequency_word(requested_hz, mclk)
+        phase = phase_word(requested_deg)
+        combined = (freq.astype(np.uint64) << np.uint64(PHASE_BITS)) | phase
+        entries, first, index = np.unique(combined, return_index=True, return_inverse=True)
+        if len(entries) > MAX_TABLE_ENTRIES:
+            raise ValueError(f"More than {MAX_TABLE_ENTRIES} distinct register settings")
+        # A nonzero 32-bit tag the firmware echoes in get_settings while the table is loaded
+        table_id = int(key[:8], 16) or 1
+        return DDSTable(table_id, freq[first], phase[first], index.astype(np.uint8).ravel(),
+                        requested_hz[first], requested_deg[first], mclk)
+
+    return _table_cache.get_or_compute(key, compute)
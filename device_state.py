@@ -0,0 +1,99 @@
+import copy
+import threading
+
+# Fields each command can change, and where they live in get_settings
+CHANNEL_FIELDS = ("type", "frequency", "phase", "enabled")
+MODULATION_FIELDS = ("type", "m", "frequency", "delta_freq", "baud_rate", "mod_time", "data", "enabled")
+# Modulation fields a loaded register table (load_table) is compiled from
+TABLE_INPUTS = ("type", "m", "frequency", "delta_freq", "data")
+
+
+class DeviceState:
+    """Host-side mirror of the ESP32's last acknowledged settings.
+
+    The mirror is filled from a get_settings reply and then only updated
+    when the device acknowledges a write, so `diff` can reduce a command
+    to the fields the device does not already have. The firmware keeps
+    the current value for any field a command leaves out.
+    """
+
+    def __init__(self):
+        self._settings = None
+        self._lock = threading.Lock()
+
+    @property
+    def known(self):
+        return self._settings is not None
+
+    def snapshot(self):
+        """Return a copy of the mirrored settings, or None if unknown"""
+        with self._lock:
+            return copy.deepcopy(self._settings)
+
+    def load(self, settings):
+        """Replace the mirror with a get_settings reply"""
+        with self._lock:
+            self._settings = {
+                section: copy.deepcopy(settings.get(section, {}))
+                for section in ("channel1", "channel2", "modulation")
+            }
+
+    def invalidate(self):
+        """Forget the mirror, e.g. after a disconnect or a failed write"""
+        with self._lock:
+            self._settings = None
+
+    def diff(self, command):
+        """Reduce a set_channel/set_modulation command to its changed fields.
+
+        Returns None when the device already has every value, so the
+        command can be skipped entirely.
+        """
+        section, fields = self._section(command)
+        with self._lock:
+            current = self._settings.get(section, {}) if self._settings else {}
+            changed = {key: command[key] for key in fields
+                       if key in command and (key not in current or current[key] != command[key])}
+        if not changed:
+            return None
+
+        reduced = {"cmd": command["cmd"]}
+        if command["cmd"] == "set_channel":
+            reduced["channel"] = command["channel"]
+        reduced.update(changed)
+        return reduced
+
+    def commit(self, command):
+        """Record an acknowledged set_channel/set_modulation/load_table command"""
+        section, fields = self._section(command)
+        with self._lock:
+            if self._settings is None:
+                return
+            current = self._settings.setdefault(section, {})
+            for key in fields:
+                if key in command:
+                    current[key] = copy.copy(command[key])
+            if command["cmd"] == "set_modulation" and any(key in command for key in TABLE_INPUTS):
+                current["table_id"] = 0
+
+    def forget(self, command):
+        """Drop the fields of a command whose outcome is unknown (e.g. timed out)"""
+        section, fields = self._section(command)
+        with self._lock:
+            if self._settings is None:
+                return
+            current = self._settings.setdefault(section, {})
+            for key in fields:
+                if key in command:
+                    current.pop(key, None)
+            if command["cmd"] == "set_modulation" and any(key in command for key in TABLE_INPUTS):
+                current.pop("table_id", None)
+
+    def _section(self, command):
+        if command["cmd"] == "set_channel":
+            return f"channel{command['channel']}", CHANNEL_FIELDS
+        if command["cmd"] == "set_modulation":
+            return "modulation", MODULATION_FIELDS
+        if command["cmd"] == "load_table":
+            return "modulation", ("table_id",)
+        raise ValueError(f"Not a settings command: {command['cmd']}")
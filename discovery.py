@@ -0,0 +1,207 @@
+"""Finding FUNGENE generators among the host's serial ports.
+
+`Discovery.scan` opens every USB serial port at once and asks each for
+its identity: the firmware's {"event": "ready"} banner after the reset
+that opening causes, then a get_settings reply. Ports that stay silent
+are other USB-serial gear. The probes run concurrently on one asyncio
+loop, so a dozen ports cost about one timeout rather than a dozen.
+
+Confirmed generators are remembered in ~/.fungene/devices.json, keyed by
+the adapter's USB VID:PID and serial number (or its USB location when
+the adapter has no serial number). `Discovery.known` matches the current
+ports against that cache without opening them, which is how the GUI
+pre-selects the right board at launch. Entries expire after CACHE_TTL.
+
+    python discovery.py            # probe every USB serial port
+    python discovery.py --cached   # only list the remembered boards that are plugged in
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+
+from client import READY_TIMEOUT, AsyncDeviceClient, is_ok
+
+PROBE_TIMEOUT = 1.0  # seconds for the get_settings reply once the board is up
+CACHE_TTL = 7 * 24 * 3600  # seconds a confirmed port stays trusted without a re-probe
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".fungene", "devices.json")
+SETTINGS_KEYS = ("channel1", "channel2", "modulation")  # what makes a get_settings reply ours
+
+
+class DiscoveredDevice(collections.namedtuple("DiscoveredDevice", "port board key description settings cached")):
+    """A generator found on `port`.
+
+    board:    the firmware's "board" id (factory MAC), if it reported one
+    key:      USB identity used for the cache, None for ports without one
+    settings: its get_settings reply, None when it came from the cache
+    cached:   True if it was taken from the cache without probing
+    """
+
+
+def port_key(port):
+    """'VID:PID:serial' identity of a list_ports entry, or None for non-USB ports"""
+    if getattr(port, "vid", None) is None:
+        return None
+    unique = port.serial_number or port.location
+    if not unique:
+        return None
+    return f"{port.vid:04X}:{port.pid:04X}:{unique}"
+
+
+def list_candidates(usb_only=True):
+    """The serial ports worth probing; plain UARTs (no USB ids) are skipped by default"""
+    import serial.tools.list_ports
+
+    ports = sorted(serial.tools.list_ports.comports(), key=lambda port: port.device)
+    return [port for port in ports if not usb_only or port.vid is not None]
+
+
+def _port_info(port):
+    if isinstance(port, str):
+        from serial.tools.list_ports_common import ListPortInfo
+        return ListPortInfo(port, skip_link_detection=True)
+    return port
+
+
+class DeviceCache:
+    """Confirmed generators by USB identity, in a JSON file"""
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = {key: dict(value) for key, value in json.load(f).items()}
+            except (OSError, ValueError, TypeError, AttributeError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, key, now=None):
+        """The entry for `key` (board, port, description, confirmed), or None if unknown or expired"""
+        entry = self._load().get(key) if key else None
+        if entry is None:
+            return None
+        now = time.time() if now is None else now
+        return entry if now - entry.get("confirmed", 0) <= self.ttl else None
+
+    def put(self, key, board, port, description=None):
+        if not key:
+            return
+        self._load()[key] = {"board": board, "port": port, "description": description, "confirmed": time.time()}
+        self._save()
+
+    def remove(self, key):
+        if self._load().pop(key, None) is not None:
+            self._save()
+
+    def _save(self):
+        now = time.time()
+        entries = {key: entry for key, entry in self._load().items() if now - entry.get("confirmed", 0) <= self.ttl}
+        self._entries = entries
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(temporary, self.path)
+
+
+class Discovery:
+    """Probes serial ports for generators and remembers the ones it finds.
+
+    With reset=False ports are opened without toggling DTR, so boards that
+    are already running are not rebooted and answer get_settings at once;
+    the ready banner is then not waited for.
+    """
+
+    def __init__(self, cache=None, timeout=PROBE_TIMEOUT, ready_timeout=READY_TIMEOUT, reset=True):
+        self.cache = cache if cache is not None else DeviceCache()
+        self.timeout = timeout
+        self.ready_timeout = ready_timeout
+        self.reset = reset
+
+    def known(self, ports=None):
+        """Cached generators among `ports` (default: the current USB ports), without opening any"""
+        ports = list_candidates() if ports is None else [_port_info(port) for port in ports]
+        found = []
+        for port in ports:
+            entry = self.cache.get(port_key(port))
+            if entry is not None:
+                found.append(DiscoveredDevice(port.device, entry.get("board"), port_key(port),
+                                              port.description, None, True))
+        return found
+
+    def remember(self, port, board):
+        """Record a port the caller connected to by hand (a device path or list_ports entry)"""
+        if isinstance(port, str):
+            matches = [info for info in list_candidates() if info.device == port]
+            if not matches:
+                return
+            port = matches[0]
+        self.cache.put(port_key(port), board, port.device, port.description)
+
+    def scan(self, ports=None):
+        """Probe `ports` (default: every USB serial port) concurrently; returns the generators found"""
+        return asyncio.run(self.scan_async(ports))
+
+    async def scan_async(self, ports=None):
+        ports = list_candidates() if ports is None else [_port_info(port) for port in ports]
+        results = await asyncio.gather(*(self.probe(port) for port in ports), return_exceptions=True)
+        found = []
+        for port, result in zip(ports, results):
+            if isinstance(result, DiscoveredDevice):
+                self.cache.put(result.key, result.board, result.port, result.description)
+                found.append(result)
+            elif port_key(port) is not None and not isinstance(result, OSError):
+                # It answered nothing we recognise; a port that failed to open may just be busy
+                self.cache.remove(port_key(port))
+        return found
+
+    async def probe(self, port):
+        """Open one port and identify it; a DiscoveredDevice, or None if it is not a generator"""
+        port = _port_info(port)
+        client = AsyncDeviceClient(port.device)
+        try:
+            await client.open(self.ready_timeout, binary=False, reset=self.reset)
+            banner = client.transport.banner
+            response = await client.request({"cmd": "get_settings"}, self.timeout)
+        finally:
+            await client.close()
+        if not is_ok(response) or not all(key in response for key in SETTINGS_KEYS):
+            return None
+        board = response.get("board") or (banner or {}).get("board")
+        return DiscoveredDevice(port.device, board, port_key(port), port.description, response, False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find FUNGENE generators on the serial ports")
+    parser.add_argument("ports", nargs="*", help="probe these ports instead of every USB serial port")
+    parser.add_argument("--cached", action="store_true", help="only list remembered boards, without probing")
+    parser.add_argument("--no-reset", action="store_true", help="open ports without toggling DTR")
+    parser.add_argument("--timeout", type=float, default=PROBE_TIMEOUT, help="get_settings timeout (s)")
+    args = parser.parse_args()
+
+    discovery = Discovery(timeout=args.timeout, reset=not args.no_reset)
+    ports = args.ports or None
+    started = time.perf_counter()
+    devices = discovery.known(ports) if args.cached else discovery.scan(ports)
+    elapsed = time.perf_counter() - started
+    for device in devices:
+        detail = "cached" if device.cached else (
+            f"ch1 {device.settings['channel1'].get('frequency')} Hz, "
+            f"ch2 {device.settings['channel2'].get('frequency')} Hz, "
+            f"modulation {device.settings['modulation'].get('type')}"
+            f"{' on' if device.settings['modulation'].get('enabled') else ' off'}")
+        print(f"{device.port:20} board {device.board or '?':14} {detail}")
+    print(f"{len(devices)} generator(s) in {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Compact binary frames for the host-to-ESP32 direction.
+
+After a {"cmd": "hello"} handshake shows the firmware understands them,
+set_channel, set_modulation, stream_data and batch commands are sent as
+length-prefixed frames instead of JSON lines. Replies stay JSON lines.
+
+    0      magic 0xA5 (never the first byte of a JSON line)
+    1      frame type
+    2..3   payload length, little endian
+    4..7   request id, echoed in the JSON reply
+    8..    payload
+    end    CRC-16/CCITT-FALSE of bytes 1..end of payload, little endian
+
+Payloads use fixed-width little-endian fields. A field mask marks which
+optional fields are present, as with partial JSON commands. Symbol arrays
+are bit-packed MSB first at 1, 2, 4, 8 or 16 bits per symbol. Commands
+that cannot be expressed this way (unknown types, out-of-range values)
+return None from `encode` and go out as JSON.
+
+tests/test_framing.py checks the codec round trip (`python -m pytest tests`).
+"""
+import binascii
+import struct
+
+MAGIC = 0xA5
+HEADER = struct.Struct("<BBHI")  # magic, type, payload length, request id
+CRC = struct.Struct("<H")
+MAX_PAYLOAD = 4608  # FRAME_MAX_PAYLOAD in FUNGENE_V2.ino
+PROTOCOL = "binary1"
+
+FRAME_SET_CHANNEL = 0x02
+FRAME_SET_MODULATION = 0x03
+FRAME_STREAM_DATA = 0x04
+FRAME_BATCH = 0x05
+
+SIGNAL_TYPES = ("Sine", "Square", "Triangle")
+MODULATION_TYPES = ("MFSK", "MPSK", "ASK", "SWEEP", "PWM", "AM")
+SYMBOL_WIDTHS = (1, 2, 4, 8, 16)
+
+# channel, field mask, type, enabled, frequency, phase
+CHANNEL = struct.Struct("<BBBBff")
+CHANNEL_MASK = ("type", "frequency", "phase", "enabled")
+# field mask, type, enabled, m, frequency, delta_freq, baud_rate, mod_time [, symbols]
+MODULATION = struct.Struct("<BBBHffff")
+MODULATION_MASK = ("type", "m", "frequency", "delta_freq", "baud_rate", "mod_time", "data", "enabled")
+# width, count; followed by the packed symbols
+SYMBOLS = struct.Struct("<BH")
+STREAM_END = 0x01
+OP = struct.Struct("<BH")  # batch op: frame type, payload length
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF)"""
+    return binascii.crc_hqx(data, crc)
+
+
+def symbol_width(top):
+    """Narrowest supported width for symbols up to `top`, or None"""
+    for width in SYMBOL_WIDTHS:
+        if top < 1 << width:
+            return width
+    return None
+
+
+def pack_symbols(symbols, width):
+    """Pack a list of ints MSB first at `width` bits each"""
+    if width == 16:
+        return struct.pack(f"<{len(symbols)}H", *symbols)
+    if width == 8:
+        return bytes(symbols)
+    per_byte = 8 // width
+    padded = list(symbols) + [0] * (-len(symbols) % per_byte)
+    shifts = [8 - width * (j + 1) for j in range(per_byte)]
+    return bytes(sum(padded[i + j] << shift for j, shift in enumerate(shifts))
+                 for i in range(0, len(padded), per_byte))
+
+
+def unpack_symbols(data, width, count):
+    if width == 16:
+        return list(struct.unpack_from(f"<{count}H", data))
+    if width == 8:
+        return list(data[:count])
+    per_byte = 8 // width
+    mask = (1 << width) - 1
+    return [(data[i // per_byte] >> (8 - width * (i % per_byte + 1))) & mask for i in range(count)]
+
+
+def packed_size(width, count):
+    return (width * count + 7) // 8
+
+
+def _symbol_chunks(symbols):
+    if hasattr(symbols, "iter_chunks"):  # datasource.SymbolSource: never one big list
+        for chunk in symbols.iter_chunks(4096):
+            yield chunk.tolist()
+    else:
+        yield list(symbols)
+
+
+def encode_symbols(symbols):
+    """SYMBOLS header plus packed data, or None if a value does not fit 16 bits"""
+    count = 0
+    top = 0
+    for chunk in _symbol_chunks(symbols):
+        if not all(isinstance(value, int) and not isinstance(value, bool) for value in chunk):
+            return None
+        if chunk:
+            if min(chunk) < 0:
+                return None
+            top = max(top, max(chunk))
+        count += len(chunk)
+    width = symbol_width(top)
+    if width is None or count > 0xFFFF:
+        return None
+    return SYMBOLS.pack(width, count) + b"".join(pack_symbols(chunk, width) for chunk in _symbol_chunks(symbols))
+
+
+def decode_symbols(payload, offset=0):
+    """(symbols, offset after them) from a SYMBOLS header at `offset`"""
+    width, count = SYMBOLS.unpack_from(payload, offset)
+    if width not in SYMBOL_WIDTHS:
+        raise ValueError("Bad symbol width")
+    offset += SYMBOLS.size
+    end = offset + packed_size(width, count)
+    if end > len(payload):
+        raise ValueError("Truncated symbols")
+    return unpack_symbols(payload[offset:end], width, count), end
+
+
+def _number(value, integer=False):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if integer and not isinstance(value, int):
+        return None
+    return value
+
+
+def _mask(command, fields):
+    return sum(1 << bit for bit, key in enumerate(fields) if key in command)
+
+
+def encode_payload(command):
+    """(frame type, payload) for a command, or None if it has no binary form"""
+    cmd = command.get("cmd")
+    if cmd == "set_channel":
+        if command.get("channel") not in (1, 2):
+            return None
+        sig_type = command.get("type", SIGNAL_TYPES[0])
+        frequency, phase = _number(command.get("frequency", 0.0)), _number(command.get("phase", 0.0))
+        if sig_type not in SIGNAL_TYPES or frequency is None or phase is None:
+            return None
+        return FRAME_SET_CHANNEL, CHANNEL.pack(command["channel"], _mask(command, CHANNEL_MASK),
+                                               SIGNAL_TYPES.index(sig_type), bool(command.get("enabled")),
+                                               frequency, phase)
+    if cmd == "set_modulation":
+        mod_type = command.get("type", MODULATION_TYPES[0])
+        m = _number(command.get("m", 0), integer=True)
+        floats = [_number(command.get(key, 0.0)) for key in ("frequency", "delta_freq", "baud_rate", "mod_time")]
+        if mod_type not in MODULATION_TYPES or m is None or not 0 <= m <= 0xFFFF or None in floats:
+            return None
+        payload = MODULATION.pack(_mask(command, MODULATION_MASK), MODULATION_TYPES.index(mod_type),
+                                  bool(command.get("enabled")), m, *floats)
+        if "data" in command:
+            symbols = encode_symbols(command["data"])
+            if symbols is None:
+                return None
+            payload += symbols
+        return FRAME_SET_MODULATION, payload
+    if cmd == "stream_data":
+        symbols = encode_symbols(command.get("symbols", []))
+        if symbols is None:
+            return None
+        return FRAME_STREAM_DATA, bytes([STREAM_END if command.get("end") else 0]) + symbols
+    if cmd == "batch":
+        ops = command.get("ops", [])
+        if len(ops) > 0xFF:
+            return None
+        payload = bytearray([len(ops)])
+        for op in ops:
+            encoded = encode_payload(op) if isinstance(op, dict) else None
+            if encoded is None or encoded[0] == FRAME_BATCH:
+                return None
+            payload += OP.pack(encoded[0], len(encoded[1])) + encoded[1]
+        return FRAME_BATCH, bytes(payload)
+    return None
+
+
+def encode(command, request_id=0, max_payload=MAX_PAYLOAD):
+    """The frame for a command, or None if it must be sent as JSON"""
+    encoded = encode_payload(command)
+    if encoded is None or len(encoded[1]) > max_payload:
+        return None
+    frame_type, payload = encoded
+    body = HEADER.pack(MAGIC, frame_type, len(payload), request_id) + payload
+    return body + CRC.pack(crc16(body[1:]))
+
+
+def decode_payload(frame_type, payload):
+    """The JSON command a payload stands for; raises ValueError if malformed"""
+    try:
+        if frame_type == FRAME_SET_CHANNEL:
+            channel, mask, sig_type, enabled, frequency, phase = CHANNEL.unpack_from(payload)
+            values = {"type": SIGNAL_TYPES[sig_type], "frequency": frequency, "phase": phase,
+                      "enabled": bool(enabled)}
+            command = {"cmd": "set_channel", "channel": channel}
+            command.update((key, values[key]) for bit, key in enumerate(CHANNEL_MASK) if mask & 1 << bit)
+            return command
+        if frame_type == FRAME_SET_MODULATION:
+            mask, mod_type, enabled, m, *floats = MODULATION.unpack_from(payload)
+            values = dict(zip(("frequency", "delta_freq", "baud_rate", "mod_time"), floats),
+                          type=MODULATION_TYPES[mod_type], m=m, enabled=bool(enabled))
+            if mask & 1 << MODULATION_MASK.index("data"):
+                values["data"], _ = decode_symbols(payload, MODULATION.size)
+            command = {"cmd": "set_modulation"}
+            command.update((key, values[key]) for bit, key in enumerate(MODULATION_MASK) if mask & 1 << bit)
+            return command
+        if frame_type == FRAME_STREAM_DATA:
+            symbols, _ = decode_symbols(payload, 1)
+            command = {"cmd": "stream_data", "symbols": symbols}
+            if payload[0] & STREAM_END:
+                command["end"] = True
+            return command
+        if frame_type == FRAME_BATCH:
+            ops = []
+            offset = 1
+            for _ in range(payload[0]):
+                op_type, length = OP.unpack_from(payload, offset)
+                offset += OP.size
+                if op_type == FRAME_BATCH or offset + length > len(payload):
+                    raise ValueError("Bad batch op")
+                ops.append(decode_payload(op_type, payload[offset:offset + length]))
+                offset += length
+            return {"cmd": "batch", "ops": ops}
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed frame: {e}") from None
+    raise ValueError(f"Unknown frame type: {frame_type}")
+
+
+def split_message(buffer):
+    """Take one message off the front of a receive buffer.
+
+    Returns (frame bytes or None, JSON line or None, rest), or None if the
+    buffer does not yet hold a whole message.
+    """
+    if buffer[:1] == bytes([MAGIC]):
+        if len(buffer) < HEADER.size:
+            return None
+        _, _, length, _ = HEADER.unpack_from(buffer)
+        end = HEADER.size + length + CRC.size
+        if len(buffer) < end:
+            return None
+        return bytes(buffer[:end]), None, buffer[end:]
+    if b"\n" not in buffer:
+        return None
+    line, rest = buffer.split(b"\n", 1)
+    return None, line, rest
+
+
+def decode(frame):
+    """(request id, command) from a whole frame; raises ValueError if bad"""
+    if len(frame) < HEADER.size + CRC.size or frame[0] != MAGIC:
+        raise ValueError("Not a frame")
+    _, frame_type, length, request_id = HEADER.unpack_from(frame)
+    if len(frame) != HEADER.size + length + CRC.size:
+        raise ValueError("Bad frame length")
+    (crc,) = CRC.unpack_from(frame, HEADER.size + length)
+    if crc16(frame[1:HEADER.size + length]) != crc:
+        raise ValueError("Bad CRC")
+    return request_id, decode_payload(frame_type, frame[HEADER.size:HEADER.size + length])
@@ -1,22 +1,188 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
-import serial
-import serial.tools.list_ports
+from tkinter import ttk, messagebox, filedialog, simpledialog
+import os
+import queue
 import threading
 import time
-import json
+from concurrent.futures import ThreadPoolExecutor
+
+from calibration import achieved_baud, loop_kind
+from client import (MAX_DATA_SYMBOLS, DeviceClient, channel_command, max_telemetry_rate, modulation_command,
+                    parse_data)
+from discovery import Discovery
+from instrumentation import SUMMARY_COLUMNS, Instruments
+from live import DEFAULT_RATE, LiveStreamer
+from presets import PresetBank
+from recording import SessionRecorder
+from transport import RESPONSE_TIMEOUT
+
+PREVIEW_SYMBOLS = 32  # symbol periods shown in the waveform preview
+DATA_VIEW_SYMBOLS = 32  # symbols shown at a time from a data file
+TELEMETRY_RATE = 200  # samples/s, about 40% of a 115200 baud link
+TELEMETRY_WINDOW = 5.0  # seconds shown in the telemetry strip charts
+TELEMETRY_REFRESH_MS = 50
+STATS_REFRESH_MS = 500
+
+
+def draw_trace(canvas, samples, low, high, tag="trace", color="blue"):
+    """Plot samples on a canvas as one min/max envelope line per pixel column"""
+    import numpy as np
+    from preview import minmax_decimate
+
+    canvas.delete(tag)
+    width = max(canvas.winfo_width(), 2)
+    height = max(canvas.winfo_height(), 2)
+    if len(samples) == 0:
+        return
+    mins, maxs = minmax_decimate(samples, width)
+    scale = (height - 4) / ((high - low) or 1.0)
+    # Zig-zag through each column's max and min so spikes stay visible
+    ys = (height - 2) - (np.stack((maxs, mins), axis=1).ravel() - low) * scale
+    xs = np.repeat(np.arange(len(mins)) * (width / len(mins)), 2)
+    coords = np.column_stack((xs, ys)).ravel().tolist()
+    if len(coords) >= 4:
+        canvas.create_line(*coords, tag=tag, fill=color)
+
+class JobCancelled(Exception):
+    """Raised inside a background job once it has been cancelled"""
+
+
+class Job:
+    """A background operation that can report progress and be cancelled"""
+
+    def __init__(self, worker, name):
+        self.name = name
+        self.cancelled = threading.Event()
+        self._worker = worker
+        self._futures = set()
+
+    def cancel(self):
+        """Request cancellation and abandon any in-flight requests"""
+        self.cancelled.set()
+        for future in list(self._futures):
+            future.cancel()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def progress(self, fraction, text):
+        """Report progress (0.0 - 1.0) to the Tk thread"""
+        self._worker.post(self._worker.on_progress, self, fraction, text)
+
+    def sleep(self, seconds):
+        """Sleep unless cancelled; returns False if the job was cancelled"""
+        return not self.cancelled.wait(seconds)
+
+    def request(self, transport, command, timeout=RESPONSE_TIMEOUT):
+        """Send a command and wait for its reply, aborting on cancellation"""
+        self.check_cancelled()
+        try:
+            future = transport.send(command)
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+        self._futures.add(future)
+        try:
+            if self.cancelled.is_set():
+                future.cancel()
+            response = transport.wait(future, timeout)
+        finally:
+            self._futures.discard(future)
+        self.check_cancelled()
+        return response
+
+
+class BackgroundWorker:
+    """Runs jobs one at a time off the Tk thread.
+
+    Progress and completion callbacks are queued by the worker thread and
+    run on the Tk thread from a `root.after` poll, so jobs never touch
+    widgets directly.
+    """
+
+    POLL_INTERVAL = 20  # ms
+
+    def __init__(self, root, on_progress):
+        self.root = root
+        self.on_progress = on_progress
+        self.current = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gui-worker")
+        self._callbacks = queue.Queue()
+        self.root.after(self.POLL_INTERVAL, self._drain)
+
+    @property
+    def busy(self):
+        return self.current is not None
+
+    def submit(self, name, fn, on_done=None, on_error=None):
+        """Run fn(job) in the background; on_done(result) runs on the Tk thread"""
+        job = Job(self, name)
+        self.current = job
+        self.on_progress(job, 0.0, f"{name}...")
+        future = self._executor.submit(fn, job)
+        future.add_done_callback(lambda f: self.post(self._finish, job, f, on_done, on_error))
+        return job
+
+    def cancel(self):
+        """Cancel the running job, if any"""
+        if self.current is not None:
+            self.current.cancel()
+
+    def post(self, callback, *args):
+        """Queue a callback to run on the Tk thread"""
+        self._callbacks.put((callback, args))
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _drain(self):
+        while True:
+            try:
+                callback, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        self.root.after(self.POLL_INTERVAL, self._drain)
+
+    def _finish(self, job, future, on_done, on_error):
+        if self.current is job:
+            self.current = None
+            self.on_progress(None, 0.0, "")
+
+        try:
+            result = future.result()
+        except JobCancelled:
+            return
+        except Exception as e:
+            if on_error is not None:
+                on_error(e)
+            else:
+                messagebox.showerror("Error", f"{job.name} failed: {str(e)}")
+            return
+        if on_done is not None:
+            on_done(result)
+
 
 class SignalGeneratorGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("ESP32 Signal Generator Control")
-        self.root.geometry("800x600")
+        self.root.geometry("800x720")
         self.root.resizable(True, True)
         
         # Serial connection
-        self.serial_port = None
+        self.instruments = Instruments(enabled=False)  # switched on from the Stats tab
+        self.client = DeviceClient(instruments=self.instruments)
+        self.discovery = Discovery()
+        self.presets = PresetBank()
         self.connected = False
         self.connect_lock = threading.Lock()
+        self.worker = BackgroundWorker(self.root, self.show_progress)
+        self.live_streamer = LiveStreamer(self.send_live_command)
+        self.live_streamer.start()
+        self.data_source = None  # datasource.SymbolSource replacing the typed data
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # Signal parameters
         self.signal_types = ["Sine", "Square", "Triangle"]
@@ -25,8 +191,8 @@ class SignalGeneratorGUI:
         # Create GUI
         self.create_widgets()
         
-        # Update port list on startup
-        self.update_port_list()
+        # List the ports once the window is up; enumerating them can take seconds on some systems
+        self.root.after_idle(self.update_port_list)
         
     def validate_float(self, P):
         """Validation function for float entries"""
@@ -70,6 +236,35 @@ class SignalGeneratorGUI:
         # Status label
         self.status_label = ttk.Label(conn_frame, text="Status: Disconnected", foreground="red")
         self.status_label.grid(row=0, column=4, sticky=tk.W, padx=5, pady=5)
+
+        # Open without toggling DTR, so a board that is already running keeps its output
+        self.keep_running = tk.BooleanVar(value=False)
+        ttk.Checkbutton(conn_frame, text="No Reset", variable=self.keep_running).grid(row=0, column=5, sticky=tk.W, padx=5, pady=5)
+        ttk.Button(conn_frame, text="Discover", command=self.discover_devices).grid(row=1, column=5, padx=5, pady=5)
+        self.record_button = ttk.Button(conn_frame, text="Record Session...", command=self.toggle_recording)
+        self.record_button.grid(row=0, column=6, padx=5, pady=5)
+        
+        # Live update: stream frequency/phase slider moves straight to the device
+        self.live_enabled = tk.BooleanVar(value=False)
+        ttk.Checkbutton(conn_frame, text="Live Update", variable=self.live_enabled).grid(row=1, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        ttk.Label(conn_frame, text="Max Rate (Hz):").grid(row=1, column=2, sticky=tk.E, padx=5, pady=5)
+        self.live_rate = tk.DoubleVar(value=DEFAULT_RATE)
+        vcmd = (self.root.register(self.validate_float), '%P')
+        ttk.Spinbox(conn_frame, from_=1, to=100, textvariable=self.live_rate, width=6,
+                    validate='key', validatecommand=vcmd).grid(row=1, column=3, sticky=tk.W, padx=5, pady=5)
+        self.live_stats_label = ttk.Label(conn_frame, text="")
+        self.live_stats_label.grid(row=1, column=4, sticky=tk.W, padx=5, pady=5)
+        self.root.after(500, self.update_live_stats)
+
+        # Presets stored on the ESP32 and switched with a single command
+        preset_frame = ttk.LabelFrame(main_frame, text="Presets", padding="10")
+        preset_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(preset_frame, text="Preset:").grid(row=0, column=0, sticky=tk.W, padx=5, pady=5)
+        self.preset_combobox = ttk.Combobox(preset_frame, width=30, state="readonly", values=self.presets.names())
+        self.preset_combobox.grid(row=0, column=1, sticky=tk.W, padx=5, pady=5)
+        ttk.Button(preset_frame, text="Recall", command=self.recall_preset).grid(row=0, column=2, padx=5, pady=5)
+        ttk.Button(preset_frame, text="Save Current As...", command=self.save_preset).grid(row=0, column=3, padx=5, pady=5)
+        ttk.Button(preset_frame, text="Delete", command=self.delete_preset).grid(row=0, column=4, padx=5, pady=5)
         
         # Channels Frame
         self.notebook = ttk.Notebook(main_frame)
@@ -79,6 +274,8 @@ class SignalGeneratorGUI:
         self.create_channel_tab(1)
         self.create_channel_tab(2)
         self.create_modulation_tab()
+        self.create_telemetry_tab()
+        self.create_stats_tab()
         
         # Track the active tab for enabling/disabling channels
         self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_change)
@@ -89,6 +286,17 @@ class SignalGeneratorGUI:
         
         # Apply settings button
         ttk.Button(bottom_frame, text="Apply All Settings", command=self.apply_all_settings).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(bottom_frame, text="Read Settings", command=self.request_current_settings).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(bottom_frame, text="Calibrate Timing", command=self.calibrate_timing).pack(side=tk.RIGHT, padx=5)
+        
+        # Background operation progress
+        self.progress_bar = ttk.Progressbar(bottom_frame, length=150, maximum=100)
+        self.progress_bar.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(bottom_frame, text="Cancel", command=self.cancel_operation)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button.state(['disabled'])
+        self.progress_label = ttk.Label(bottom_frame, text="")
+        self.progress_label.pack(side=tk.LEFT, padx=5)
         
     def create_channel_tab(self, channel_num):
         channel_frame = ttk.Frame(self.notebook, padding="10")
@@ -135,6 +343,10 @@ class SignalGeneratorGUI:
         #     channel_num, signal_type.get(), frequency.get(), phase.get(), enabled.get()
         # )).grid(row=3, column=2, sticky=tk.E, padx=5, pady=5)
         
+        # Stream slider/entry changes when live update is on
+        frequency.trace_add("write", lambda *args: self.on_live_change(channel_num))
+        phase.trace_add("write", lambda *args: self.on_live_change(channel_num))
+        
         # Store the variables for this channel
         setattr(self, f"channel_{channel_num}_type", signal_type)
         setattr(self, f"channel_{channel_num}_freq", frequency)
@@ -181,6 +393,8 @@ class SignalGeneratorGUI:
         baud_rate = tk.DoubleVar(value=1000.0)  # Changed from IntVar to DoubleVar
         baud_rate_entry = ttk.Entry(param_frame, textvariable=baud_rate, width=15, validate='key', validatecommand=vcmd)
         baud_rate_entry.grid(row=4, column=1, sticky=tk.W, padx=5, pady=5)
+        self.achieved_baud_label = ttk.Label(param_frame, text="")
+        self.achieved_baud_label.grid(row=4, column=2, sticky=tk.W, padx=5, pady=5)
         
         # Modulation Time (for SWEEP)
         ttk.Label(param_frame, text="Modulation Time (s):").grid(row=5, column=0, sticky=tk.W, padx=5, pady=5)
@@ -194,16 +408,47 @@ class SignalGeneratorGUI:
         data_entry = ttk.Entry(param_frame, textvariable=data_string, width=40)
         data_entry.grid(row=6, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
         
+        # Data file (binary, hex dump or bit text) shown a window at a time
+        ttk.Label(param_frame, text="Data File:").grid(row=7, column=0, sticky=tk.W, padx=5, pady=5)
+        file_frame = ttk.Frame(param_frame)
+        file_frame.grid(row=7, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        ttk.Button(file_frame, text="Load File...", command=self.load_data_file).pack(side=tk.LEFT)
+        ttk.Button(file_frame, text="Clear", command=self.clear_data_file).pack(side=tk.LEFT, padx=5)
+        ttk.Button(file_frame, text="Stream", command=self.stream_data).pack(side=tk.LEFT)
+        self.data_file_label = ttk.Label(file_frame, text="None")
+        self.data_file_label.pack(side=tk.LEFT, padx=5)
+
+        view_frame = ttk.Frame(param_frame)
+        view_frame.grid(row=8, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        ttk.Label(view_frame, text="Offset:").pack(side=tk.LEFT)
+        self.data_view_offset = tk.IntVar(value=0)
+        self.data_view_spinbox = ttk.Spinbox(view_frame, from_=0, to=0, increment=DATA_VIEW_SYMBOLS, width=10,
+                                             textvariable=self.data_view_offset, command=self.update_data_view)
+        self.data_view_spinbox.pack(side=tk.LEFT, padx=5)
+        self.data_view_spinbox.bind("<Return>", lambda event: self.update_data_view())
+        self.data_view_label = ttk.Label(view_frame, text="", font=("Courier", 9))
+        self.data_view_label.pack(side=tk.LEFT, padx=5)
+        
         # Enable/Disable modulation
         mod_enabled = tk.BooleanVar(value=False)
         ttk.Checkbutton(param_frame, text="Enable Modulation", variable=mod_enabled, 
-                      command=lambda: self.toggle_modulation(mod_enabled.get())).grid(row=7, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+                      command=lambda: self.toggle_modulation(mod_enabled.get())).grid(row=9, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
         
         # Apply button for modulation
         # ttk.Button(param_frame, text="Apply Modulation", command=lambda: self.apply_modulation_settings(
         #     mod_type.get(), mod_m.get(), mod_freq.get(), delta_freq.get(), baud_rate.get(), mod_time.get(), data_string.get(), mod_enabled.get()
         # )).grid(row=7, column=2, sticky=tk.E, padx=5, pady=5)
         
+        # Waveform preview of what the firmware will output
+        preview_frame = ttk.LabelFrame(mod_frame, text="Preview", padding="10")
+        preview_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.preview_canvas = tk.Canvas(preview_frame, height=140, background="white")
+        self.preview_canvas.pack(fill=tk.BOTH, expand=True)
+        ttk.Button(preview_frame, text="Preview", command=self.show_preview).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(preview_frame, text="Spectrum", command=self.show_spectrum).pack(side=tk.LEFT, padx=5, pady=5)
+        self.preview_label = ttk.Label(preview_frame, text="")
+        self.preview_label.pack(side=tk.LEFT, padx=5, pady=5)
+        
         # Store modulation variables
         self.modulation_type = mod_type
         self.modulation_m = mod_m
@@ -212,8 +457,445 @@ class SignalGeneratorGUI:
         self.modulation_baud_rate = baud_rate
         self.modulation_time = mod_time
         self.modulation_data = data_string
+        self.modulation_data_entry = data_entry
         self.modulation_enabled = mod_enabled
+        for variable in (mod_type, mod_m, baud_rate):
+            variable.trace_add("write", lambda *args: self.update_achieved_baud())
+        self.update_achieved_baud()
     
+    def create_telemetry_tab(self):
+        tel_frame = ttk.Frame(self.notebook, padding="10")
+        self.notebook.add(tel_frame, text="Telemetry")
+
+        controls = ttk.Frame(tel_frame)
+        controls.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(controls, text="Rate (samples/s):").pack(side=tk.LEFT)
+        self.telemetry_rate = tk.IntVar(value=TELEMETRY_RATE)
+        self.telemetry_rate_spinbox = ttk.Spinbox(controls, from_=10, to=max_telemetry_rate(), increment=10, width=8,
+                                                  textvariable=self.telemetry_rate)
+        self.telemetry_rate_spinbox.pack(side=tk.LEFT, padx=5)
+        self.telemetry_button = ttk.Button(controls, text="Start", command=self.toggle_telemetry)
+        self.telemetry_button.pack(side=tk.LEFT, padx=5)
+        ttk.Button(controls, text="Export...", command=self.export_telemetry).pack(side=tk.LEFT, padx=5)
+        self.telemetry_label = ttk.Label(controls, text="")
+        self.telemetry_label.pack(side=tk.LEFT, padx=5)
+
+        # Strip charts of the phase loop, min/max decimated per pixel column
+        phase_frame = ttk.LabelFrame(tel_frame, text="Measured (blue) / Target (green) Phase, 0-180 deg", padding="5")
+        phase_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.telemetry_phase_canvas = tk.Canvas(phase_frame, height=140, background="white")
+        self.telemetry_phase_canvas.pack(fill=tk.BOTH, expand=True)
+        error_frame = ttk.LabelFrame(tel_frame, text="Phase Error (deg)", padding="5")
+        error_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.telemetry_error_canvas = tk.Canvas(error_frame, height=140, background="white")
+        self.telemetry_error_canvas.pack(fill=tk.BOTH, expand=True)
+
+        self.telemetry = None  # TelemetryBuffer, created on the first start
+        self.telemetry_running = False
+
+    def create_stats_tab(self):
+        stats_frame = ttk.Frame(self.notebook, padding="10")
+        self.notebook.add(stats_frame, text="Stats")
+
+        controls = ttk.Frame(stats_frame)
+        controls.pack(fill=tk.X, padx=5, pady=5)
+        self.stats_enabled = tk.BooleanVar(value=self.instruments.enabled)
+        ttk.Checkbutton(controls, text="Record", variable=self.stats_enabled,
+                        command=self.toggle_stats).pack(side=tk.LEFT)
+        ttk.Button(controls, text="Reset", command=self.reset_stats).pack(side=tk.LEFT, padx=5)
+        ttk.Button(controls, text="Export...", command=self.export_stats).pack(side=tk.LEFT, padx=5)
+        self.stats_label = ttk.Label(controls, text="")
+        self.stats_label.pack(side=tk.LEFT, padx=5)
+
+        # One row per command type, latencies in milliseconds
+        table_frame = ttk.Frame(stats_frame)
+        table_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.stats_table = ttk.Treeview(table_frame, columns=SUMMARY_COLUMNS, show="headings")
+        for column in SUMMARY_COLUMNS:
+            self.stats_table.heading(column, text=column)
+            self.stats_table.column(column, width=110 if column == "cmd" else 60,
+                                    anchor=tk.W if column == "cmd" else tk.E)
+        scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.stats_table.yview)
+        self.stats_table.configure(yscrollcommand=scrollbar.set)
+        self.stats_table.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.stats_after = None  # pending refresh_stats timer
+
+    def toggle_stats(self):
+        """Start or pause recording link statistics"""
+        self.instruments.enabled = self.stats_enabled.get()
+        if self.instruments.enabled:
+            self.refresh_stats()
+
+    def reset_stats(self):
+        self.instruments.reset()
+        self.refresh_stats(once=True)
+
+    def refresh_stats(self, once=False):
+        """Redraw the stats table from a snapshot while recording"""
+        if self.stats_after is not None and not once:
+            self.root.after_cancel(self.stats_after)
+            self.stats_after = None
+        snapshot = self.instruments.snapshot()
+        self.stats_table.delete(*self.stats_table.get_children())
+        for row in self.instruments.summary_rows(snapshot):
+            self.stats_table.insert("", tk.END, values=[
+                "-" if value is None else f"{value:.2f}" if isinstance(value, float) else value for value in row])
+        self.stats_label.config(
+            text=f"sent {snapshot['bytes_sent']} B | received {snapshot['bytes_received']} B | "
+                 f"timeouts {snapshot['timeouts']} | retries {snapshot['retries']} | "
+                 f"bad lines {snapshot['decode_errors']}")
+        if not once and self.instruments.enabled:
+            self.stats_after = self.root.after(STATS_REFRESH_MS, self.refresh_stats)
+
+    def export_stats(self):
+        """Save the recorded link statistics"""
+        path = filedialog.asksaveasfilename(defaultextension=".json",
+                                            filetypes=[("JSON files", "*.json"), ("CSV files", "*.csv")])
+        if path:
+            self.instruments.save(path)
+
+    def toggle_telemetry(self):
+        """Start or stop the phase-loop telemetry stream"""
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
+            return
+        try:
+            import telemetry  # NumPy is only needed for telemetry
+        except ImportError:
+            messagebox.showerror("Telemetry", "NumPy is required for telemetry")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        if self.telemetry_running:
+            def stopped(response):
+                self.telemetry_running = False
+                self.telemetry_button.config(text="Start")
+
+            self.worker.submit("Stop telemetry", self.client.stop_telemetry, stopped)
+            return
+
+        try:
+            rate = self.telemetry_rate.get()
+        except tk.TclError:
+            rate = 0
+        if rate <= 0:
+            messagebox.showwarning("Invalid Rate", "Enter a telemetry rate in samples/s")
+            return
+        # Leave the port's baud rate room for command replies
+        limit = max_telemetry_rate(self.client.transport.serial_port.baudrate)
+        self.telemetry_rate_spinbox.config(to=limit)
+        if rate > limit:
+            messagebox.showwarning("Invalid Rate", f"At most {limit} samples/s fit on this link beside the replies")
+            self.telemetry_rate.set(limit)
+            return
+        if self.telemetry is None:
+            self.telemetry = telemetry.TelemetryBuffer()
+        self.telemetry.clear()
+        buffer = self.telemetry
+
+        def started(response):
+            if response and response.get("status") == "ok":
+                self.telemetry_running = True
+                self.telemetry_button.config(text="Stop")
+                self.refresh_telemetry()
+            else:
+                error_msg = response.get("error", "Unknown error") if response else "No response"
+                messagebox.showerror("Telemetry", f"Failed to start telemetry: {error_msg}")
+
+        self.worker.submit("Start telemetry", lambda job: self.client.start_telemetry(buffer, rate, job), started)
+
+    def refresh_telemetry(self):
+        """Redraw the strip charts from the newest samples while telemetry runs"""
+        if not self.telemetry_running:
+            return
+        import telemetry
+
+        samples = self.telemetry.window(TELEMETRY_WINDOW)
+        if len(samples["time"]):
+            draw_trace(self.telemetry_phase_canvas, samples["measured"], 0.0, 180.0, tag="measured")
+            draw_trace(self.telemetry_phase_canvas, samples["target"], 0.0, 180.0, tag="target", color="green")
+            span = max(1.0, float(abs(samples["error"]).max()))
+            draw_trace(self.telemetry_error_canvas, samples["error"], -span, span, tag="error", color="red")
+            quality = telemetry.lock_quality(samples)
+            self.telemetry_label.config(
+                text=f"{quality['rate']:.0f} samples/s | rms error {quality['rms_error']:.2f} deg | "
+                     f"p99 {quality['p99_error']:.2f} deg | locked {quality['locked_for']:.1f} s | "
+                     f"dropped {self.telemetry.dropped}")
+        self.root.after(TELEMETRY_REFRESH_MS, self.refresh_telemetry)
+
+    def export_telemetry(self):
+        """Save the recorded telemetry for offline lock-quality analysis"""
+        if self.telemetry is None or not len(self.telemetry):
+            messagebox.showwarning("Telemetry", "No telemetry has been recorded")
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".csv",
+                                            filetypes=[("CSV files", "*.csv"), ("NumPy archives", "*.npz")])
+        if path:
+            self.telemetry.save(path)
+
+    def update_achieved_baud(self):
+        """Show the symbol rate the firmware's loop really runs at for the requested baud rate"""
+        try:
+            loop = loop_kind(self.modulation_type.get(), self.modulation_m.get())
+            baud_rate = self.modulation_baud_rate.get()
+        except (tk.TclError, ValueError):
+            loop = None
+        if loop is None or baud_rate <= 0:
+            self.achieved_baud_label.config(text="")
+            return
+        calibration = self.client.calibration
+        achieved, error = achieved_baud(baud_rate, loop, calibration)
+        note = "" if calibration else ", uncalibrated"
+        self.achieved_baud_label.config(text=f"Achieved: {achieved:.1f} Bd ({error:+.2%}{note})")
+
+    def calibrate_timing(self):
+        """Measure the board's symbol-loop overheads and push the fit back to it"""
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        def calibrate(job):
+            return self.client.calibrate(
+                job, progress=lambda fraction, loop, baud: job.progress(fraction, f"Timing {loop} at {baud:g} Bd...")
+            )
+
+        def done(response):
+            self.update_achieved_baud()
+            if response and response.get("status") == "ok":
+                calibration = response["calibration"]
+                lines = [f"{loop}: {offset:.1f} us + {slope * 1000:.3f} us/kBd "
+                         f"(residual {calibration.residual_us(loop):.2f} us)"
+                         for loop, (offset, slope) in calibration.overhead.items()]
+                messagebox.showinfo("Calibration", "Symbol loop overhead:\n" + "\n".join(lines))
+            else:
+                error_msg = response.get("error", "Unknown error") if response else "No response"
+                messagebox.showerror("Calibration", f"Calibration failed: {error_msg}")
+
+        self.worker.submit("Calibrate", calibrate, done)
+
+    def load_data_file(self):
+        """Pick a symbol file and open it for the current M in the background"""
+        path = filedialog.askopenfilename(
+            title="Load Data File",
+            filetypes=[("All files", "*.*"), ("Binary", "*.bin"), ("Hex dump", "*.hex *.txt"), ("Bit text", "*.bits")])
+        if not path:
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+        try:
+            import datasource  # NumPy is only needed for data files
+        except ImportError:
+            messagebox.showerror("Data File", "NumPy is required for data files")
+            return
+        m = self.modulation_m.get()
+
+        def load(job):
+            job.progress(0.0, "Indexing data file...")
+            return datasource.SymbolSource(path, m)
+
+        def failed(e):
+            messagebox.showerror("Data File", f"Could not load {os.path.basename(path)}: {e}")
+
+        self.worker.submit("Load data file", load, self.set_data_source, failed)
+
+    def set_data_source(self, source):
+        """Use `source` instead of the typed data (None to go back to it)"""
+        if self.data_source is not None and self.data_source is not source:
+            self.data_source.close()
+        self.data_source = source
+        self.data_view_offset.set(0)
+        if source is None:
+            self.modulation_data_entry.state(['!disabled'])
+            self.data_file_label.config(text="None")
+            self.data_view_spinbox.config(to=0)
+        else:
+            self.modulation_data_entry.state(['disabled'])
+            self.data_file_label.config(
+                text=f"{os.path.basename(source.path)}: {len(source)} symbols ({source.format}, M={source.m})")
+            self.data_view_spinbox.config(to=max(0, len(source) - 1))
+            if len(source) > MAX_DATA_SYMBOLS:
+                messagebox.showwarning("Data File", f"The device holds at most {MAX_DATA_SYMBOLS} symbols; "
+                                                    f"this file has {len(source)}. Use Stream to play it.")
+        self.update_data_view()
+
+    def clear_data_file(self):
+        self.set_data_source(None)
+
+    def update_data_view(self):
+        """Show DATA_VIEW_SYMBOLS symbols of the data file from the chosen offset"""
+        if self.data_source is None:
+            self.data_view_label.config(text="")
+            return
+        try:
+            offset = self.data_view_offset.get()
+        except tk.TclError:
+            return
+        symbols = self.data_source.window(offset, DATA_VIEW_SYMBOLS)
+        self.data_view_label.config(text=" ".join(map(str, symbols.tolist())))
+
+    def current_data(self):
+        """The data file if one is loaded (reopened if M changed), else the data string"""
+        source = self.data_source
+        if source is None:
+            return self.modulation_data.get()
+        m = self.modulation_m.get()
+        if source.m != m:
+            import datasource
+            try:
+                source = datasource.SymbolSource(source.path, m, source.format)
+            except ValueError:
+                return None
+            self.set_data_source(source)
+        return source
+
+    def stream_data(self):
+        """Play the data file (or the typed data) once in streaming mode"""
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+        data = self.current_data()
+        try:
+            symbols = data if hasattr(data, "iter_chunks") else parse_data(data or "")
+        except ValueError:
+            symbols = None
+        if not symbols:
+            messagebox.showwarning("Invalid Data", "Load a data file or enter comma-separated integers")
+            return
+        fields = {
+            "mod_type": self.modulation_type.get(),
+            "m": self.modulation_m.get(),
+            "frequency": self.modulation_freq.get(),
+            "delta_freq": self.modulation_delta_freq.get(),
+            "baud_rate": self.modulation_baud_rate.get(),
+        }
+        total = len(symbols)
+
+        def stream(job):
+            job.progress(0.0, "Streaming...")
+            return self.client.stream(
+                symbols, job,
+                progress=lambda sent, underruns: job.progress(
+                    sent / total, f"Streaming: {sent}/{total} symbols sent, {underruns} underruns"),
+                **fields)
+
+        def done(result):
+            if result and result.get("status") == "ok":
+                messagebox.showinfo("Stream", f"Played {result['played']} symbols "
+                                              f"with {result['underruns']} underruns")
+            else:
+                error_msg = result.get("error", "Unknown error") if result else "No response"
+                messagebox.showerror("Error", f"Stream failed: {error_msg}")
+
+        self.worker.submit("Stream", stream, done)
+
+    def modulation_params(self):
+        """Current modulation fields as a dict, or None if the data is invalid"""
+        data = self.current_data()
+        if data is None:
+            return None
+        if hasattr(data, "window"):
+            data = data.window(0, MAX_DATA_SYMBOLS)  # what the device can hold
+        else:
+            try:
+                data = parse_data(data)
+            except ValueError:
+                return None
+        return {
+            "type": self.modulation_type.get(),
+            "m": self.modulation_m.get(),
+            "frequency": self.modulation_freq.get(),
+            "delta_freq": self.modulation_delta_freq.get(),
+            "baud_rate": self.modulation_baud_rate.get(),
+            "mod_time": self.modulation_time.get(),
+            "data": data
+        }
+
+    def show_preview(self):
+        """Render the configured modulation and plot it in the preview pane"""
+        try:
+            import preview  # NumPy is only needed for previews
+        except ImportError:
+            messagebox.showerror("Preview", "NumPy is required for waveform previews")
+            return
+
+        try:
+            params = self.modulation_params()
+        except tk.TclError:
+            params = None
+        if params is None or params["baud_rate"] <= 0:
+            messagebox.showwarning("Invalid Settings", "Check the modulation parameters and data")
+            return
+
+        duration = min(params["mod_time"], PREVIEW_SYMBOLS / params["baud_rate"])
+        started = time.perf_counter()
+        _, samples = preview.render(params, duration=duration)
+        elapsed = (time.perf_counter() - started) * 1000
+        draw_trace(self.preview_canvas, samples, -1.05, 1.05)
+        self.preview_label.config(text=f"{len(samples)} samples over {duration * 1000:.2f} ms, rendered in {elapsed:.1f} ms")
+
+    def show_spectrum(self):
+        """Compute the PSD and occupancy of the configured modulation in the background"""
+        try:
+            import spectrum  # NumPy is only needed for analysis
+        except ImportError:
+            messagebox.showerror("Spectrum", "NumPy is required for spectrum analysis")
+            return
+
+        try:
+            params = self.modulation_params()
+        except tk.TclError:
+            params = None
+        if params is None or params["baud_rate"] <= 0:
+            messagebox.showwarning("Invalid Settings", "Check the modulation parameters and data")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        def analyze(job):
+            job.progress(0.0, "Analyzing spectrum...")
+            result = spectrum.analyze(params, cancelled=job.cancelled)
+            job.check_cancelled()
+            return result
+
+        self.worker.submit("Spectrum", analyze, lambda result: self.show_spectrum_window(result, spectrum))
+
+    def show_spectrum_window(self, result, spectrum):
+        """Plot a spectrum analysis result with its summary and CSV export"""
+        window = tk.Toplevel(self.root)
+        window.title("Spectrum")
+        window.geometry("700x400")
+
+        canvas = tk.Canvas(window, background="white")
+        canvas.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        canvas.bind("<Configure>", lambda event: draw_trace(
+            canvas, result["psd_db"], result["peak_db"] - 100, result["peak_db"] + 5))
+
+        low, high = result["occupied_band_hz"]
+        spurs = ", ".join(f"{f:.0f} Hz {level:.1f} dBc" for f, level in result["spurs_dbc"][:3]) or "none"
+        summary = (f"Peak {result['peak_hz']:.0f} Hz | 99% occupied bandwidth {result['occupied_bandwidth_hz']:.0f} Hz "
+                   f"({low:.0f} - {high:.0f} Hz) | main lobe {result['main_lobe_width_hz']:.0f} Hz | "
+                   f"RBW {result['resolution_hz']:.0f} Hz\nSpurs: {spurs}")
+        ttk.Label(window, text=summary).pack(side=tk.LEFT, padx=5, pady=5)
+
+        def export():
+            path = filedialog.asksaveasfilename(parent=window, defaultextension=".csv",
+                                                filetypes=[("CSV files", "*.csv")])
+            if path:
+                spectrum.export_csv(result, path)
+
+        ttk.Button(window, text="Export CSV", command=export).pack(side=tk.RIGHT, padx=5, pady=5)
+
     def toggle_modulation(self, enabled):
         """Enable or disable regular channels based on modulation state"""
         if enabled:
@@ -238,67 +920,242 @@ class SignalGeneratorGUI:
                 self.channel_2_enabled_check.state(['disabled'])
     
     def update_port_list(self):
-        """Update the list of available serial ports"""
-        ports = [port.device for port in serial.tools.list_ports.comports()]
+        """Update the list of available serial ports from a background thread"""
+        def scan():
+            import serial.tools.list_ports
+            try:
+                infos = serial.tools.list_ports.comports()
+                # Generators confirmed on an earlier run, recognised by USB identity without opening them
+                known = self.discovery.known([info for info in infos if info.vid is not None])
+            except Exception:
+                infos, known = [], []
+            self.worker.post(self.show_ports, [info.device for info in infos], [device.port for device in known])
+
+        threading.Thread(target=scan, name="port-scan", daemon=True).start()
+
+    def show_ports(self, ports, generators=()):
+        """List the ports with known generators first, selecting one unless the user already picked a port"""
+        selected = self.port_combobox.get()
+        ports = list(generators) + [port for port in ports if port not in generators]
         self.port_combobox['values'] = ports
-        if ports:
+        if generators and selected not in generators and not self.connected:
+            self.port_combobox.set(generators[0])
+        elif ports and selected not in ports:
             self.port_combobox.current(0)
+
+    def discover_devices(self):
+        """Probe every USB serial port at once for generators"""
+        if self.connected:
+            messagebox.showwarning("Connected", "Disconnect before discovering devices")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        reset = not self.keep_running.get()
+
+        def discover(job):
+            job.progress(0.1, "Probing serial ports for generators...")
+            self.discovery.reset = reset
+            return self.discovery.scan()
+
+        def done(devices):
+            self.show_ports(list(self.port_combobox['values']), [device.port for device in devices])
+            if not devices:
+                messagebox.showinfo("Discover", "No generators found")
+                return
+            lines = [f"{device.port}: board {device.board or '?'}, "
+                     f"CH1 {device.settings['channel1'].get('frequency')} Hz, "
+                     f"CH2 {device.settings['channel2'].get('frequency')} Hz" for device in devices]
+            messagebox.showinfo("Discover", "Found:\n" + "\n".join(lines))
+
+        self.worker.submit("Discover", discover, done)
     
+    def toggle_recording(self):
+        """Start or stop logging the serial traffic to a session file for recording.py to replay"""
+        if self.client.recorder is not None:
+            recorder = self.client.stop_recording()
+            self.record_button.config(text="Record Session...")
+            messagebox.showinfo("Recording", f"Saved {recorder.records} messages to {recorder.path}")
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".fgs",
+                                            filetypes=[("Session recordings", "*.fgs"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            recorder = SessionRecorder(path)
+        except OSError as e:
+            messagebox.showerror("Recording", f"Cannot record to {path}: {e}")
+            return
+        self.client.start_recording(recorder)
+        self.record_button.config(text="Stop Recording")
+
+    def recall_preset(self):
+        """Switch the ESP32 to the selected preset with one recall_preset command"""
+        name = self.preset_combobox.get()
+        if not name:
+            messagebox.showwarning("Presets", "Select a preset first")
+            return
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        def recall(job):
+            response = self.presets.recall(self.client, name, job)
+            if response and response.get("status") == "ok" and self.presets.get(name)["settings"] is None:
+                # Saved from another host; only the board knows its settings
+                response = self.client.get_settings(job)
+            return response
+
+        def done(response):
+            if response and response.get("status") == "ok":
+                self.update_gui_with_settings(self.presets.get(name)["settings"] or response)
+                self.update_achieved_baud()
+            else:
+                messagebox.showerror("Error", f"Failed to recall {name}: {response.get('error', 'Unknown error') if response else 'No response'}")
+
+        self.worker.submit("Recall Preset", recall, done)
+
+    def save_preset(self):
+        """Store the ESP32's current settings as a named preset"""
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+        name = simpledialog.askstring("Save Preset", "Preset name (the applied settings are saved):",
+                                      initialvalue=self.preset_combobox.get(), parent=self.root)
+        if not name:
+            return
+
+        def save(job):
+            # Capture what the device really runs, not unapplied edits in the form
+            response = self.client.get_settings(job)
+            if not response or response.get("status") != "ok":
+                return response
+            self.presets.put(name, response)
+            return self.presets.sync(self.client, job)
+
+        def done(response):
+            self.preset_combobox['values'] = self.presets.names()
+            if response and response.get("status") == "ok":
+                self.preset_combobox.set(name)
+            else:
+                messagebox.showerror("Error", f"Failed to save {name}: {response.get('error', 'Unknown error') if response else 'No response'}")
+
+        self.worker.submit("Save Preset", save, done)
+
+    def delete_preset(self):
+        """Remove the selected preset from the index and, if connected, from the ESP32"""
+        name = self.preset_combobox.get()
+        if not name or not messagebox.askyesno("Delete Preset", f"Delete preset {name}?"):
+            return
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+        self.presets.remove(name)
+        self.preset_combobox.set("")
+        self.preset_combobox['values'] = self.presets.names()
+        if self.connected:
+            self.worker.submit("Delete Preset", lambda job: self.presets.sync(self.client, job))
+
     def toggle_connection(self):
         """Connect or disconnect from the ESP32"""
         if not self.connected:
             self.connect_to_esp()
         else:
             self.disconnect_from_esp()
-    
+
     def connect_to_esp(self):
-        """Establish serial connection to ESP32"""
+        """Establish serial connection to ESP32 in the background"""
         selected_port = self.port_combobox.get()
         if not selected_port:
             messagebox.showerror("Error", "No port selected")
             return
-        
-        with self.connect_lock:
-            try:
-                self.serial_port = serial.Serial(selected_port, 115200, timeout=1)
-                time.sleep(2)  # Wait for ESP32 to reset
-                self.connected = True
-                self.status_label.config(text="Status: Connected", foreground="green")
-                self.connect_button.config(text="Disconnect")
-                
-                # Request current settings from ESP32
-                self.request_current_settings()
-                # Read response and update GUI
-                response = self.read_response()
-                if response and response.get("status") == "ok":
-                    self.update_gui_with_settings(response)
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        reset = not self.keep_running.get()
+
+        def connect(job):
+            with self.connect_lock:
+                if reset:
+                    job.progress(0.1, f"Opening {selected_port} and waiting for ESP32 to be ready...")
                 else:
-                    messagebox.showerror("Error", "Failed to retrieve settings from ESP32")
-            except Exception as e:
-                messagebox.showerror("Connection Error", f"Failed to connect: {str(e)}")
-                self.serial_port = None
-    
+                    job.progress(0.1, f"Opening {selected_port}...")
+                response = self.client.connect(selected_port, job=job, reset=reset)
+                if self.client.board:
+                    try:
+                        self.discovery.remember(selected_port, self.client.board)
+                    except OSError:
+                        pass  # only the pre-selection on the next launch is lost
+                # Upload presets saved here that the board is missing and list the ones it has;
+                # firmware without presets just declines
+                self.presets.select(self.client.board)
+                self.presets.sync(self.client, job)
+                return response
+
+        def done(response):
+            self.connected = True
+            self.status_label.config(text="Status: Connected", foreground="green")
+            self.connect_button.config(text="Disconnect")
+            self.preset_combobox['values'] = self.presets.names()
+            self.update_achieved_baud()
+            if response and response.get("status") == "ok":
+                self.update_gui_with_settings(response)
+            else:
+                messagebox.showerror("Error", "Failed to retrieve settings from ESP32")
+
+        def failed(e):
+            messagebox.showerror("Connection Error", f"Failed to connect: {str(e)}")
+
+        self.worker.submit("Connect", connect, done, failed)
+
     def disconnect_from_esp(self):
-        """Close the serial connection"""
-        with self.connect_lock:
-            if self.serial_port:
-                self.serial_port.close()
-                self.serial_port = None
+        """Close the serial connection, cancelling any running operation"""
+        self.worker.cancel()
+
+        def disconnect(job):
+            with self.connect_lock:
+                self.client.close()
+
+        def done(result):
             self.connected = False
+            self.telemetry_running = False
+            self.telemetry_button.config(text="Start")
             self.status_label.config(text="Status: Disconnected", foreground="red")
             self.connect_button.config(text="Connect")
-    
+            self.update_achieved_baud()
+
+        self.worker.submit("Disconnect", disconnect, done)
+
     def request_current_settings(self):
-        """Request the current signal generator settings from ESP32"""
-        if not self.serial_port:
+        """Read the current signal generator settings from ESP32 in the background"""
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
             return
-        
-        try:
-            command = {"cmd": "get_settings"}
-            self.serial_port.write((json.dumps(command) + "\n").encode())
-        except Exception as e:
-            messagebox.showerror("Communication Error", f"Failed to request settings: {str(e)}")
-    
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
+        def get_settings(job):
+            job.progress(0.0, "Reading settings...")
+            return self.client.get_settings(job)
+
+        def done(response):
+            if response and response.get("status") == "ok":
+                self.update_gui_with_settings(response)
+            else:
+                error_msg = response.get("error", "Unknown error") if response else "No response"
+                messagebox.showerror("Error", f"Failed to retrieve settings: {error_msg}")
+
+        self.worker.submit("Get settings", get_settings, done)
+
     def update_gui_with_settings(self, settings):
         """Update GUI elements with received settings"""
         # Update Channel 1
@@ -324,245 +1181,271 @@ class SignalGeneratorGUI:
         self.modulation_baud_rate.set(mod.get("baud_rate", 1000.0))
         self.modulation_time.set(mod.get("mod_time", 10.0))
         data = mod.get("data", [])
+        source = self.data_source
+        if source is not None and source.window(0, len(data) + 1).tolist() != data:
+            self.set_data_source(None)  # the device is playing something else
         self.modulation_data.set(",".join(map(str, data)))
         self.modulation_enabled.set(mod.get("enabled", False))
         
         # Update channel checkbuttons based on modulation state
         self.toggle_modulation(self.modulation_enabled.get())
     
+    def build_channel_command(self, channel, sig_type, freq, phase, enabled):
+        """Build a set_channel command, or None if the frequency is out of range"""
+        try:
+            return channel_command(channel, sig_type, freq, phase, enabled)
+        except ValueError:
+            return None
+
+    def build_modulation_command(self, mod_type, m, freq, delta_freq, baud_rate, mod_time, data, enabled):
+        """Build a set_modulation command, or None if the data is invalid or too long.
+
+        `data` is a data string or a SymbolSource, which is streamed from
+        its file when the command is sent.
+        """
+        try:
+            # Parse data string if provided
+            data_values = data if hasattr(data, "iter_chunks") else parse_data(data)
+            return modulation_command(mod_type, m, freq, delta_freq, baud_rate, mod_time, data_values, enabled)
+        except (TypeError, ValueError):
+            return None
+
     def apply_channel_settings(self, channel, sig_type, freq, phase, enabled):
         """Send settings for a specific channel to ESP32"""
         if not self.connected:
             messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
             return
-        
+
         # Validate frequency
-        if freq > 3000000:
+        command = self.build_channel_command(channel, sig_type, freq, phase, enabled)
+        if command is None:
             messagebox.showwarning("Invalid Frequency", "Maximum frequency is 3 MHz")
             return
-            
-        try:
-            command = {
-                "cmd": "set_channel",
-                "channel": channel,
-                "type": sig_type,
-                "frequency": freq,
-                "phase": phase,
-                "enabled": enabled
-            }
-            
-            self.serial_port.write((json.dumps(command) + "\n").encode())
-            response = self.read_response()
-            
+
+        def done(response):
             if response and response.get("status") == "ok":
                 messagebox.showinfo("Success", f"Channel {channel} settings applied")
             else:
                 error_msg = response.get("error", "Unknown error") if response else "No response"
                 messagebox.showerror("Error", f"Failed to apply settings: {error_msg}")
-        except Exception as e:
-            messagebox.showerror("Communication Error", f"Failed to send settings: {str(e)}")
-    
+
+        self.worker.submit(f"Apply channel {channel}", lambda job: self.send_settings_command(command, job), done)
+
     def apply_modulation_settings(self, mod_type, m, freq, delta_freq, baud_rate, mod_time, data, enabled):
         """Send modulation settings to ESP32"""
         if not self.connected:
             messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
             return
-        
-        # Parse data string if provided
-        data_values = []
-        if data:
-            try:
-                data_values = [int(x.strip()) for x in data.split(',')]
-            except ValueError:
-                messagebox.showwarning("Invalid Data", "Data must be comma-separated integers")
-                return
-        
-        try:
-            command = {
-                "cmd": "set_modulation",
-                "type": mod_type,
-                "m": m,  # Add M parameter
-                "frequency": freq,
-                "delta_freq": delta_freq,
-                "baud_rate": baud_rate,
-                "mod_time": mod_time,
-                "data": data_values,
-                "enabled": enabled
-            }
-            
-            self.serial_port.write((json.dumps(command) + "\n").encode())
-            response = self.read_response()
-
-            
+
+        command = self.build_modulation_command(mod_type, m, freq, delta_freq, baud_rate, mod_time, data, enabled)
+        if command is None:
+            messagebox.showwarning("Invalid Data", "Data must be comma-separated integers")
+            return
+
+        def done(response):
             if response and response.get("status") == "ok":
                 messagebox.showinfo("Success", "Modulation settings applied")
-                
                 # Update channel checkbuttons based on modulation state
-                if enabled:
-                    self.channel_1_enabled.set(False)
-                    self.channel_2_enabled.set(False)
-                    self.channel_1_enabled_check.state(['disabled'])
-                    self.channel_2_enabled_check.state(['disabled'])
-                else:
-                    self.channel_1_enabled_check.state(['!disabled'])
-                    self.channel_2_enabled_check.state(['!disabled'])
+                self.toggle_modulation(enabled)
             else:
                 error_msg = response.get("error", "Unknown error") if response else "No response"
                 messagebox.showerror("Error", f"Failed to apply modulation settings: {error_msg}")
-        except Exception as e:
-            messagebox.showerror("Communication Error", f"Failed to send settings: {str(e)}")
 
-    def apply_channel_settings_silent(self, channel, sig_type, freq, phase, enabled):
+        self.worker.submit("Apply modulation", lambda job: self.send_settings_command(command, job), done)
+
+    def apply_channel_settings_silent(self, channel, sig_type, freq, phase, enabled, job=None):
         """Send settings for a specific channel to ESP32 without showing messages"""
         if not self.connected:
             return False
-        
-        # Validate frequency
-        if freq > 3000000:
-            return False
-            
-        try:
-            command = {
-                "cmd": "set_channel",
-                "channel": channel,
-                "type": sig_type,
-                "frequency": freq,
-                "phase": phase,
-                "enabled": enabled
-            }
-            
-            self.serial_port.write((json.dumps(command) + "\n").encode())
-            response = self.read_response()
-            
-            if response and response.get("status") == "ok":
-                return True
-            return False
-        except Exception:
+
+        command = self.build_channel_command(channel, sig_type, freq, phase, enabled)
+        if command is None:
             return False
 
-    def apply_modulation_settings_silent(self, mod_type, m, freq, delta_freq, baud_rate, mod_time, data, enabled):
+        response = self.send_settings_command(command, job)
+        return bool(response and response.get("status") == "ok")
+
+    def apply_modulation_settings_silent(self, mod_type, m, freq, delta_freq, baud_rate, mod_time, data, enabled, job=None):
         """Send modulation settings to ESP32 without showing messages"""
         if not self.connected:
             return False
-        
-        # Parse data string if provided
-        data_values = []
-        if data:
-            try:
-                data_values = [int(x.strip()) for x in data.split(',')]
-            except ValueError:
-                return False
-        
-        try:
-            command = {
-                "cmd": "set_modulation",
-                "type": mod_type,
-                "m": m,
-                "frequency": freq,
-                "delta_freq": delta_freq,
-                "baud_rate": baud_rate,
-                "mod_time": mod_time,
-                "data": data_values,
-                "enabled": enabled
-            }
-            
-            self.serial_port.write((json.dumps(command) + "\n").encode())
-            response = self.read_response()
-            
-            if response and response.get("status") == "ok":
-                # Update channel checkbuttons based on modulation state
-                if enabled:
-                    self.channel_1_enabled.set(False)
-                    self.channel_2_enabled.set(False)
-                    self.channel_1_enabled_check.state(['disabled'])
-                    self.channel_2_enabled_check.state(['disabled'])
-                else:
-                    self.channel_1_enabled_check.state(['!disabled'])
-                    self.channel_2_enabled_check.state(['!disabled'])
-                return True
-            return False
-        except Exception:
+
+        command = self.build_modulation_command(mod_type, m, freq, delta_freq, baud_rate, mod_time, data, enabled)
+        if command is None:
             return False
-    
+
+        response = self.send_settings_command(command, job)
+        return bool(response and response.get("status") == "ok")
+
     def apply_all_settings(self):
-        """Apply settings for all channels and modulation"""
+        """Apply settings for all channels and modulation in the background"""
         if not self.connected:
             messagebox.showwarning("Not Connected", "Please connect to ESP32 first")
             return
-        
-        # Track success status
-        success = True
-        error_message = ""
-        
+        if self.worker.busy:
+            messagebox.showwarning("Busy", "Please wait for the current operation to finish")
+            return
+
         # Check if modulation is enabled
         modulation_enabled = self.modulation_enabled.get()
-        
-        # Apply modulation settings first
-        if not self.apply_modulation_settings_silent(
+        data = self.current_data()
+        if data is None:
+            messagebox.showerror("Error", "M must be a power of two to use a data file")
+            return
+
+        # Snapshot the Tk variables here; the job must not touch widgets
+        modulation = (
             self.modulation_type.get(),
             self.modulation_m.get(),
             self.modulation_freq.get(),
             self.modulation_delta_freq.get(),
             self.modulation_baud_rate.get(),
             self.modulation_time.get(),
-            self.modulation_data.get(),
+            data,
             modulation_enabled
-        ):
-            success = False
-            error_message = "Failed to apply Modulation settings"
-            
+        )
+        channels = [
+            (1, self.channel_1_type.get(), self.channel_1_freq.get(),
+             self.channel_1_phase.get(), self.channel_1_enabled.get()),
+            (2, self.channel_2_type.get(), self.channel_2_freq.get(),
+             self.channel_2_phase.get(), self.channel_2_enabled.get()),
+        ]
+
+        # Encode everything up front so the job is a single round trip
+        mod_command = self.build_modulation_command(*modulation)
+        if mod_command is None:
+            messagebox.showerror("Error", "Failed to apply Modulation settings")
+            return
+        commands = [("Modulation", mod_command)]
+        table_params = self.modulation_params()
+
         # Only apply channel settings if modulation is disabled
-        if success and not modulation_enabled:
-            # Apply settings for channel 1
-            if not self.apply_channel_settings_silent(
-                1, 
-                self.channel_1_type.get(),
-                self.channel_1_freq.get(),
-                self.channel_1_phase.get(),
-                self.channel_1_enabled.get()
-            ):
-                success = False
-                error_message = "Failed to apply Channel 1 settings"
-            
-            # Apply settings for channel 2
-            if success and not self.apply_channel_settings_silent(
-                2, 
-                self.channel_2_type.get(),
-                self.channel_2_freq.get(),
-                self.channel_2_phase.get(),
-                self.channel_2_enabled.get()
-            ):
-                success = False
-                error_message = "Failed to apply Channel 2 settings"
-        
-        # Show single message based on result
-        if success:
-            messagebox.showinfo("Success", "Settings Applied!")
-        else:
-            messagebox.showerror("Error", error_message)
-    
-    def read_response(self):
-        """Read response from ESP32"""
-        if not self.serial_port:
+        if not modulation_enabled:
+            for channel in channels:
+                command = self.build_channel_command(*channel)
+                if command is None:
+                    messagebox.showerror("Error", f"Failed to apply Channel {channel[0]} settings")
+                    return
+                commands.append((f"Channel {channel[0]}", command))
+
+        def apply(job):
+            # Only the fields the device does not already have are sent, in one batch
+            job.progress(0.0, "Applying settings...")
+            result = self.client.apply(
+                [command for _, command in commands], job,
+                progress=lambda fraction, index: job.progress(fraction, f"Applying {commands[index][0]}...")
+            )
+            if result["status"] != "ok":
+                if result["failed"] is None:
+                    return f"Failed to apply settings: {result['error']}", None
+                return f"Failed to apply {commands[result['failed']][0]} settings: {result['error']}", None
+            return None, load_table(job)
+
+        def load_table(job):
+            # Precomputed AD9833 words for M-FSK/M-PSK; the firmware falls back to floats without them
+            try:
+                import dds  # NumPy is only needed for register tables
+            except ImportError:
+                return None
+            if table_params is None or not dds.uses_table(table_params):
+                return None
+            job.progress(0.9, "Loading register table...")
+            try:
+                response = self.client.load_table(table_params, job)
+            except ValueError:
+                return None
+            if response and response.get("status") == "ok":
+                return response["table"].summary()
             return None
-        
+
+        def done(result):
+            error_message, table_summary = result
+            # Update channel checkbuttons based on modulation state
+            self.toggle_modulation(modulation_enabled)
+
+            # Show single message based on result
+            if error_message is None:
+                message = "Settings Applied!"
+                if table_summary:
+                    message += f"\n\nRegister table: {table_summary}"
+                messagebox.showinfo("Success", message)
+            else:
+                messagebox.showerror("Error", error_message)
+
+        self.worker.submit("Apply settings", apply, done)
+
+    def on_live_change(self, channel):
+        """Offer the channel's current frequency/phase to the live streamer"""
+        if not self.live_enabled.get() or not self.connected:
+            return
         try:
-            # Wait for response - increased timeout to 10 seconds
-            start_time = time.time()
-            while (time.time() - start_time) < 10:  # 10 second timeout (increased from 2)
-                if self.serial_port.in_waiting:
-                    response = self.serial_port.readline().decode().strip()
-                    try:
-                        return json.loads(response)
-                    except json.JSONDecodeError:
-                        return {"status": "error", "error": "Invalid response format"}
-                # time.sleep(0.1)
-            
-            return {"status": "error", "error": "Timeout waiting for response"}
-        except Exception as e:
-            return {"status": "error", "error": str(e)}
+            freq = getattr(self, f"channel_{channel}_freq").get()
+            phase = getattr(self, f"channel_{channel}_phase").get()
+            self.live_streamer.rate = self.live_rate.get()
+        except tk.TclError:
+            return  # entry is mid-edit, e.g. empty or "-"
+        if freq > 3000000:
+            return
+        self.live_streamer.update(channel, {
+            "cmd": "set_channel",
+            "channel": channel,
+            "frequency": freq,
+            "phase": phase
+        })
+
+    def send_live_command(self, command):
+        """Send a live update (streamer thread), skipping values the device already has"""
+        reduced = self.client.state.diff(command)
+        if reduced is None or not self.client.connected:
+            return None
+        return self.send_settings_command(reduced)
+
+    def update_live_stats(self):
+        """Show the achieved live update rate and latency"""
+        if self.live_enabled.get():
+            stats = self.live_streamer.stats()
+            latency = "-" if stats["latency_ms"] is None else f"{stats['latency_ms']:.0f} ms"
+            self.live_stats_label.config(text=f"{stats['rate']:.1f} upd/s, latency {latency}")
+        else:
+            self.live_stats_label.config(text="")
+        self.root.after(500, self.update_live_stats)
+
+    def cancel_operation(self):
+        """Cancel the running background operation"""
+        self.worker.cancel()
+
+    def show_progress(self, job, fraction, text):
+        """Reflect background job progress in the bottom bar"""
+        if job is not None and job is not self.worker.current:
+            return  # late update from a finished job
+        if job is None:
+            self.progress_bar['value'] = 0
+            self.progress_label.config(text="")
+            self.cancel_button.state(['disabled'])
+        else:
+            self.progress_bar['value'] = fraction * 100
+            self.progress_label.config(text=text)
+            self.cancel_button.state(['!disabled'])
+
+    def on_close(self):
+        """Cancel background work and release the port before exiting"""
+        self.live_streamer.stop()
+        self.worker.shutdown()
+        self.client.close()
+        self.client.stop_recording()
+        if self.data_source is not None:
+            self.data_source.close()
+        self.root.destroy()
+
+    def send_settings_command(self, command, job=None):
+        """Send a set_channel/set_modulation command, keeping the device state mirror current"""
+        return self.client.send_settings_command(command, job)
+
+    def send_command(self, command, job=None):
+        """Send a command to ESP32 and wait for the matching response"""
+        return self.client.request(command, job)
 
 if __name__ == "__main__":
     root = tk.Tk()
     app = SignalGeneratorGUI(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
@@ -0,0 +1,229 @@
+"""Counters and latency histograms for the serial link.
+
+Attach an `Instruments` to SerialTransport (DeviceClient(instruments=...))
+and it records, per command type ("cmd"):
+
+    count, errors      replies received, and how many had "status": "error"
+    timeouts           requests nobody got a reply for in time
+    retries            commands re-sent unchanged (but for the id) after timing out
+    latency            histogram from the write to the matched reply
+    bytes_sent/received  wire bytes of the commands and of their replies
+
+plus link-wide totals: bytes and lines received, undecodable lines and
+unsolicited events by type. Probes added with `add_probe(callback)` see
+every record as `callback(kind, info)` on the thread that made it. They
+can feed custom dashboards or assertions.
+
+Without instruments the transport only checks one attribute per
+message. `enabled = False` pauses recording without detaching.
+"""
+import csv
+import json
+import math
+import threading
+import time
+import zlib
+
+HISTOGRAM_MIN = 1e-5  # seconds, lower edge of the first latency bucket
+BUCKETS_PER_DECADE = 8
+HISTOGRAM_DECADES = 7  # up to 100 s
+RETRY_MEMORY = 64  # timed-out commands remembered to recognise a retry
+SUMMARY_COLUMNS = ("cmd", "count", "errors", "timeouts", "retries", "mean_ms", "p50_ms", "p90_ms", "p99_ms",
+                   "max_ms", "bytes_sent", "bytes_received")
+
+
+def command_key(command):
+    """CRC-32 of a command without its request id, so a re-sent command has the same key"""
+    fields = {key: value for key, value in command.items() if key != "id"}
+    return zlib.crc32(json.dumps(fields, sort_keys=True, default=repr).encode())
+
+
+class Histogram:
+    """Log-bucketed latency histogram with exact count, sum, min and max"""
+
+    def __init__(self):
+        self.buckets = [0] * (BUCKETS_PER_DECADE * HISTOGRAM_DECADES + 1)  # last bucket is overflow
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    @staticmethod
+    def upper_edge(index):
+        return HISTOGRAM_MIN * 10 ** ((index + 1) / BUCKETS_PER_DECADE)
+
+    def add(self, seconds):
+        if seconds <= HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = min(int(math.log10(seconds / HISTOGRAM_MIN) * BUCKETS_PER_DECADE), len(self.buckets) - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Latency below which `fraction` of the samples fall (bucket upper edge, capped at max)"""
+        if not self.count:
+            return math.nan
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(self.upper_edge(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        """Summary in milliseconds; None where there are no samples, so the result stays valid JSON"""
+        def ms(seconds):
+            return seconds * 1000 if self.count else None
+
+        return {"count": self.count, "mean_ms": ms(self.total / max(self.count, 1)), "min_ms": ms(self.min),
+                "max_ms": ms(self.max), "p50_ms": ms(self.percentile(0.5)), "p90_ms": ms(self.percentile(0.9)),
+                "p99_ms": ms(self.percentile(0.99)),
+                "buckets": [[round(self.upper_edge(i) * 1000, 4), count]
+                            for i, count in enumerate(self.buckets) if count]}
+
+
+class CommandStats:
+    """Everything recorded for one command type"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.sent = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class Instruments:
+    """Thread-safe link statistics fed by SerialTransport"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._probes = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.commands = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.lines_received = 0
+            self.decode_errors = 0
+            self.events = {}
+            self._timed_out = {}  # command_key of a timed-out command -> cmd, oldest first
+
+    def add_probe(self, callback):
+        """Call `callback(kind, info)` for every record; kinds: sent, reply, timeout, retry, decode_error, event"""
+        with self._lock:
+            self._probes.append(callback)
+
+    def remove_probe(self, callback):
+        with self._lock:
+            if callback in self._probes:
+                self._probes.remove(callback)
+
+    def _command(self, cmd):
+        stats = self.commands.get(cmd)
+        if stats is None:
+            stats = self.commands[cmd] = CommandStats()
+        return stats
+
+    def sent(self, cmd, size, key=None):
+        """A command of `size` bytes was written; `key` is its command_key, if known"""
+        retry = False
+        with self._lock:
+            stats = self._command(cmd)
+            stats.sent += 1
+            stats.bytes_sent += size
+            self.bytes_sent += size
+            if self._timed_out and key is not None:
+                retry = self._timed_out.pop(key, None) is not None
+                if retry:
+                    stats.retries += 1
+        self._notify("sent", {"cmd": cmd, "bytes": size})
+        if retry:
+            self._notify("retry", {"cmd": cmd})
+
+    def received(self, size):
+        """A line arrived (before it is decoded)"""
+        with self._lock:
+            self.bytes_received += size
+            self.lines_received += 1
+
+    def reply(self, cmd, latency, response, size):
+        with self._lock:
+            stats = self._command(cmd)
+            stats.latency.add(latency)
+            stats.bytes_received += size
+            ok = response.get("status") == "ok"
+            if not ok:
+                stats.errors += 1
+        self._notify("reply", {"cmd": cmd, "latency": latency, "ok": ok, "bytes": size})
+
+    def timeout(self, cmd, key, elapsed):
+        with self._lock:
+            self._command(cmd).timeouts += 1
+            if key is not None:
+                self._timed_out[key] = cmd
+                while len(self._timed_out) > RETRY_MEMORY:
+                    del self._timed_out[next(iter(self._timed_out))]
+        self._notify("timeout", {"cmd": cmd, "elapsed": elapsed})
+
+    def decode_error(self, line):
+        with self._lock:
+            self.decode_errors += 1
+        self._notify("decode_error", {"line": line})
+
+    def event(self, name):
+        with self._lock:
+            self.events[name] = self.events.get(name, 0) + 1
+        self._notify("event", {"event": name})
+
+    def _notify(self, kind, info):
+        for probe in self._probes:
+            try:
+                probe(kind, info)
+            except Exception:
+                pass  # a faulty probe must not break the link
+
+    def snapshot(self):
+        """Everything recorded so far as a JSON-ready dict"""
+        with self._lock:
+            commands = {}
+            for cmd, stats in sorted(self.commands.items()):
+                entry = stats.latency.to_dict()
+                entry.update(sent=stats.sent, errors=stats.errors, timeouts=stats.timeouts, retries=stats.retries,
+                             bytes_sent=stats.bytes_sent, bytes_received=stats.bytes_received)
+                commands[cmd] = entry
+            timeouts = sum(stats.timeouts for stats in self.commands.values())
+            retries = sum(stats.retries for stats in self.commands.values())
+            return {"started": self.started, "elapsed": time.time() - self.started,
+                    "bytes_sent": self.bytes_sent, "bytes_received": self.bytes_received,
+                    "lines_received": self.lines_received, "decode_errors": self.decode_errors,
+                    "timeouts": timeouts, "retries": retries, "events": dict(self.events), "commands": commands}
+
+    def summary_rows(self, snapshot=None):
+        """One row per command type, in SUMMARY_COLUMNS order"""
+        snapshot = snapshot or self.snapshot()
+        return [[cmd] + [entry[column] for column in SUMMARY_COLUMNS[1:]]
+                for cmd, entry in snapshot["commands"].items()]
+
+    def save(self, path):
+        """Write the snapshot as JSON, or the per-command summary as CSV for any other extension"""
+        snapshot = self.snapshot()
+        with open(path, "w", newline="") as f:
+            if path.lower().endswith(".json"):
+                json.dump(snapshot, f, indent=2)
+                return
+            writer = csv.writer(f)
+            writer.writerow(SUMMARY_COLUMNS)
+            for row in self.summary_rows(snapshot):
+                writer.writerow([f"{value:.3f}" if isinstance(value, float) else value for value in row])
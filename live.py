@@ -0,0 +1,108 @@
+import collections
+import threading
+import time
+
+DEFAULT_RATE = 20.0  # updates per second
+STATS_WINDOW = 2.0  # seconds of history used for the achieved rate
+
+
+class LiveStreamer:
+    """Streams control changes to the device at a bounded rate.
+
+    Each key (e.g. a channel number) has a single slot that always holds the
+    newest command, so a fast slider drag overwrites stale values instead of
+    queueing them behind the serial link. One command is in flight at a
+    time and sends are spaced at least 1 / rate apart.
+
+    `send(command)` is called on the streamer thread and must block until
+    the device answers, returning the response dict (or None to skip).
+    """
+
+    def __init__(self, send, rate=DEFAULT_RATE):
+        self.send = send
+        self.rate = rate
+
+        self._slots = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+        self._sent_times = collections.deque()
+        self._latency = None
+        self.sent = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def start(self):
+        with self._cond:
+            self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="live-streamer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._slots.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def update(self, key, command):
+        """Offer a new command for `key`, replacing any unsent one"""
+        with self._cond:
+            if key in self._slots:
+                self.coalesced += 1
+            self._slots[key] = (command, time.monotonic())
+            self._cond.notify()
+
+    def stats(self):
+        """Achieved update rate (Hz) and last end-to-end latency (ms)"""
+        now = time.monotonic()
+        with self._cond:
+            while self._sent_times and now - self._sent_times[0] > STATS_WINDOW:
+                self._sent_times.popleft()
+            achieved = len(self._sent_times) / STATS_WINDOW
+            latency = self._latency
+        return {
+            "rate": achieved,
+            "latency_ms": None if latency is None else latency * 1000,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        next_send = 0.0
+        while True:
+            with self._cond:
+                while not self._slots and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                # Hold off until the rate limit allows another send; newer
+                # values keep landing in the slot meanwhile
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, (command, changed_at) = self._slots.popitem(last=False)
+
+            started = time.monotonic()
+            try:
+                response = self.send(command)
+            except Exception:
+                response = {"status": "error"}
+            finished = time.monotonic()
+            next_send = started + 1.0 / max(self.rate, 0.1)
+
+            if response is None:
+                continue
+            with self._cond:
+                self.sent += 1
+                self._sent_times.append(finished)
+                if response.get("status") == "ok":
+                    # From the value being produced to the device acknowledging it
+                    self._latency = finished - changed_at
+                else:
+                    self.errors += 1
@@ -0,0 +1,220 @@
+"""Simulation of the channel phase-sync loop and a gain autotuner.
+
+When both channels run at the same frequency, loop() in FUNGENE_V2.ino
+XORs the two square waves and measures the XOR output's high and low
+times with pulseIn (whole microseconds). It turns the duty cycle into a
+phase difference of 0..180 degrees, and whenever the error is at least
+the threshold it moves one generator's 12-bit PHASE register by
+
+    kp * error + kd * (error - previous error)
+
+`simulate` runs that loop for a whole grid of (kp, kd, threshold,
+frequency) settings and random starting offsets between the two AD9833s
+at once, as NumPy arrays. It models the XOR detector's missing sign, the
+pulseIn quantization and edge jitter, the phase register resolution and
+a configurable measurement latency. For every setting it reports lock
+time, overshoot, steady-state error and jitter. `recommend` picks the
+setting that locks fastest everywhere without overshooting.
+DeviceClient.set_pll pushes it to the board.
+
+    python pll.py                  # sweep the default grid and print the best gains
+    python pll.py --port COM5      # ... and send them with set_pll
+"""
+import argparse
+
+import numpy as np
+
+PHASE_BITS = 12
+TARGET_CLAMP = 173.0  # degrees, loop() keeps the target away from the detector's ends
+ITERATION_XOR_PERIODS = 2.5  # pulseIn(HIGH) + pulseIn(LOW) wait for and measure about this many
+LOOP_OVERHEAD_US = 60.0  # SPI write and loop bookkeeping per iteration (estimate)
+EDGE_JITTER_US = 0.05  # rms timing noise on each pulseIn measurement
+LOCK_TOLERANCE = 1.0  # degrees, or the detector resolution if coarser
+DEFAULT_GAINS = {"kp": 0.5, "kd": 0.0, "threshold": 0.1}  # the firmware's defaults
+KP_GRID = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, 1.2, 1.5)
+KD_GRID = (0.0, 0.05, 0.1, 0.2, 0.3)
+THRESHOLD_GRID = (0.1, 0.25, 0.5, 1.0)
+FREQUENCY_GRID = (100.0, 1000.0, 10000.0, 50000.0)
+
+
+def wrap(degrees):
+    """Phase(s) wrapped to [-180, 180)"""
+    return (np.asarray(degrees) + 180.0) % 360.0 - 180.0
+
+
+def target_phase(phase1, phase2):
+    """(target magnitude, sign of the adjusted generator) as loop() derives them from the channel phases"""
+    target = float(np.clip(wrap(phase1 - phase2), -TARGET_CLAMP, TARGET_CLAMP))
+    return abs(target), (1.0 if target >= 0 else -1.0)  # gen1 for positive targets, gen2 otherwise
+
+
+def quantize_phase(degrees):
+    """The phase a 12-bit PHASE register really holds for a requested one"""
+    step = 360.0 / (1 << PHASE_BITS)
+    return np.rint(np.asarray(degrees) / step) % (1 << PHASE_BITS) * step
+
+
+def detector_resolution(frequency):
+    """Degrees per microsecond of XOR high time at `frequency`"""
+    return 180.0 / (500000.0 / np.asarray(frequency, dtype=np.float64))
+
+
+def iteration_time(frequency):
+    """Seconds per loop() phase-correction iteration at `frequency`"""
+    xor_period_us = 500000.0 / np.asarray(frequency, dtype=np.float64)
+    return (ITERATION_XOR_PERIODS * xor_period_us + LOOP_OVERHEAD_US) * 1e-6
+
+
+class Sweep:
+    """Per-setting results of `simulate`, one array element per grid point.
+
+    kp, kd, threshold, frequency  the grid (flattened)
+    locked        fraction of trials that locked
+    lock_iters    worst lock time over the trials, in iterations (inf if any did not lock)
+    lock_time     the same in seconds
+    overshoot     worst overshoot past the target, in degrees
+    steady_error  mean |error| over the last quarter of the run, in degrees
+    jitter        mean standard deviation of the phase over the last quarter
+    """
+
+    def __init__(self, **columns):
+        self.columns = columns
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.kp)
+
+    def rows(self):
+        names = list(self.columns)
+        return [dict(zip(names, (float(self.columns[name][i]) for name in names))) for i in range(len(self))]
+
+    def gains(self):
+        """Distinct (kp, kd, threshold) settings in the grid"""
+        return sorted(set(zip(self.kp.tolist(), self.kd.tolist(), self.threshold.tolist())))
+
+    def select(self, kp, kd, threshold):
+        """Mask of the grid points using one setting (at every frequency)"""
+        return (self.kp == kp) & (self.kd == kd) & (self.threshold == threshold)
+
+
+def simulate(kp=KP_GRID, kd=KD_GRID, threshold=THRESHOLD_GRID, frequency=FREQUENCY_GRID, target=90.0,
+             trials=16, iterations=400, latency=0, jitter_us=EDGE_JITTER_US, seed=0):
+    """Run the phase loop for every combination of the given gains and frequencies.
+
+    `target` is channel1.phase - channel2.phase in degrees. `latency` is
+    how many iterations old the phase is when pulseIn measures it.
+    Returns a Sweep.
+    """
+    grids = np.meshgrid(*(np.atleast_1d(np.asarray(values, dtype=np.float64))
+                          for values in (kp, kd, threshold, frequency)), indexing="ij")
+    kp, kd, threshold, frequency = (grid.ravel() for grid in grids)
+    magnitude, sign = target_phase(target, 0.0)
+
+    rng = np.random.default_rng(seed)
+    shape = (len(kp), trials)
+    gain_p, gain_d, limit = kp[:, None], kd[:, None], threshold[:, None]
+    xor_period = (500000.0 / frequency)[:, None]
+    offset = rng.uniform(-180.0, 180.0, shape)  # unknown phase between the two generators at power-up
+
+    current = np.zeros(shape)  # currentPhase
+    previous_error = np.zeros(shape)
+    registers = [quantize_phase(current)] * (latency + 1)  # oldest first
+    errors = np.empty((iterations,) + shape)
+    for step in range(iterations):
+        # XOR of the two square waves is high for |difference| / 180 of each half period
+        difference = np.abs(wrap(offset + sign * registers[0]))
+        errors[step] = difference - magnitude
+        high_time = np.floor(difference / 180.0 * xor_period + rng.normal(0.0, jitter_us, shape))
+        low_time = np.floor(xor_period - difference / 180.0 * xor_period + rng.normal(0.0, jitter_us, shape))
+        high_time, low_time = np.maximum(high_time, 0.0), np.maximum(low_time, 0.0)
+        period = high_time + low_time
+        measured = np.where(period > 0, high_time / np.maximum(period, 1.0), 0.0) * 180.0
+
+        error = measured - magnitude
+        correction = gain_p * error + gain_d * (error - previous_error)
+        current = np.where(np.abs(error) >= limit, (current - correction) % 360.0, current)
+        previous_error = error
+        registers = registers[1:] + [quantize_phase(current)]
+
+    tolerance = np.maximum(LOCK_TOLERANCE, detector_resolution(frequency))[:, None]
+    outside = np.abs(errors) > tolerance
+    # Locked from the iteration after the last one outside the tolerance
+    last_outside = iterations - 1 - np.argmax(outside[::-1], axis=0)
+    lock_iters = np.where(outside.any(axis=0), last_outside + 1, 0).astype(np.float64)
+    lock_iters[outside[-1]] = np.inf
+    # Overshoot is judged on the approach; after lock the error is detector noise
+    initial_side = np.sign(errors[0])
+    approaching = np.arange(iterations)[:, None, None] < lock_iters
+    overshoot = np.maximum(np.max(np.where(approaching, -errors * initial_side, 0.0), axis=0), 0.0)
+    tail = errors[-max(iterations // 4, 1):]
+
+    worst_iters = lock_iters.max(axis=1)
+    return Sweep(kp=kp, kd=kd, threshold=threshold, frequency=frequency,
+                 locked=np.isfinite(lock_iters).mean(axis=1), lock_iters=worst_iters,
+                 lock_time=worst_iters * iteration_time(frequency), overshoot=overshoot.max(axis=1),
+                 steady_error=np.abs(tail).mean(axis=(0, 2)), jitter=tail.std(axis=0).mean(axis=1))
+
+
+def recommend(sweep, max_overshoot=5.0):
+    """The gains that lock in every trial at every frequency with the fewest iterations.
+
+    Settings that overshoot by more than `max_overshoot` degrees are
+    skipped; ties go to the lower steady-state error. Returns a dict with
+    kp, kd, threshold and the setting's worst lock_iters, lock_time,
+    overshoot and steady_error, or None if nothing qualifies.
+    """
+    best = None
+    for kp, kd, threshold in sweep.gains():
+        mask = sweep.select(kp, kd, threshold)
+        if sweep.locked[mask].min() < 1.0 or sweep.overshoot[mask].max() > max_overshoot:
+            continue
+        score = (float(sweep.lock_iters[mask].max()), float(sweep.steady_error[mask].mean()))
+        if best is None or score < best[0]:
+            best = (score, {"kp": kp, "kd": kd, "threshold": threshold,
+                            "lock_iters": score[0], "lock_time": float(sweep.lock_time[mask].max()),
+                            "overshoot": float(sweep.overshoot[mask].max()), "steady_error": score[1]})
+    return best[1] if best else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the channel phase-sync loop gains in simulation")
+    parser.add_argument("--target", type=float, default=90.0, help="channel phase difference (degrees)")
+    parser.add_argument("--frequency", type=float, nargs="+", default=FREQUENCY_GRID)
+    parser.add_argument("--trials", type=int, default=16, help="random start offsets per setting")
+    parser.add_argument("--iterations", type=int, default=400)
+    parser.add_argument("--latency", type=int, default=0, help="iterations between a write and its measurement")
+    parser.add_argument("--max-overshoot", type=float, default=5.0, help="degrees")
+    parser.add_argument("--port", help="send the recommended gains to this board with set_pll")
+    args = parser.parse_args()
+
+    sweep = simulate(frequency=args.frequency, target=args.target, trials=args.trials,
+                     iterations=args.iterations, latency=args.latency)
+    print(f"{'frequency':>10} {'setting':>24} {'lock':>9} {'overshoot':>9} {'error':>7} {'jitter':>7}")
+    best = recommend(sweep, args.max_overshoot)
+    shown = [DEFAULT_GAINS] + ([best] if best else [])
+    for gains in shown:
+        mask = sweep.select(gains["kp"], gains["kd"], gains["threshold"])
+        for i in np.flatnonzero(mask):
+            setting = f"kp={sweep.kp[i]:g} kd={sweep.kd[i]:g} thr={sweep.threshold[i]:g}"
+            print(f"{sweep.frequency[i]:>10g} {setting:>24} {sweep.lock_time[i] * 1000:>7.1f}ms "
+                  f"{sweep.overshoot[i]:>8.2f}d {sweep.steady_error[i]:>6.2f}d {sweep.jitter[i]:>6.2f}d")
+    if best is None:
+        print("No setting locked everywhere; widen the grid or relax --max-overshoot")
+        return
+    print(f"Recommended: kp={best['kp']:g} kd={best['kd']:g} threshold={best['threshold']:g} "
+          f"(lock within {best['lock_iters']:.0f} iterations)")
+
+    if args.port:
+        from client import DeviceClient
+        client = DeviceClient()
+        try:
+            client.connect(args.port)
+            response = client.set_pll(best["kp"], best["kd"], best["threshold"])
+            print("set_pll:", response)
+        finally:
+            client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Named presets of the complete channel + modulation state, stored on the ESP32.
+
+The firmware keeps up to PRESET_SLOTS presets in NVS, so they survive a
+reset. A preset is recalled with one short {"cmd": "recall_preset",
+"slot": n} that the firmware applies locally. This replaces three
+set_* round trips that resend the whole data array.
+
+`PresetBank` is the host-side index, kept per board (the firmware's
+"board" id) in ~/.fungene/presets.json: preset names, their slots, their
+settings and a CRC-32 checksum of each. `sync` asks the board for the
+checksums it holds (list_presets) and only uploads the presets saved on
+this host that it does not have yet. Presets the index does not know,
+saved from another host or account, are pulled into the index by name
+and checksum, never overwritten or deleted. A slot is only deleted on
+the board after `remove` on this host, and only if it still holds the
+preset that was removed. The firmware repeats the checksum it read back
+from flash when storing, so a write that did not land shows up as an
+error.
+"""
+import copy
+import json
+import os
+import zlib
+
+from device_state import CHANNEL_FIELDS, MODULATION_FIELDS
+
+PRESET_SLOTS = 8  # MAX_PRESETS in FUNGENE_V2.ino
+NAME_LENGTH = 24  # PRESET_NAME_LENGTH in FUNGENE_V2.ino
+INDEX_PATH = os.path.join(os.path.expanduser("~"), ".fungene", "presets.json")
+
+
+def preset_settings(settings):
+    """The channel1/channel2/modulation fields a preset holds, from a get_settings-shaped dict"""
+    try:
+        result = {"channel1": {key: settings["channel1"][key] for key in CHANNEL_FIELDS},
+                  "channel2": {key: settings["channel2"][key] for key in CHANNEL_FIELDS},
+                  "modulation": {key: settings["modulation"][key] for key in MODULATION_FIELDS}}
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Incomplete settings for a preset: missing {e}") from None
+    return copy.deepcopy(result)
+
+
+def preset_checksum(name, settings):
+    """CRC-32 (8 hex digits) of a preset's name and settings in canonical JSON"""
+    canonical = json.dumps({"name": name, **settings}, sort_keys=True, separators=(",", ":"))
+    return f"{zlib.crc32(canonical.encode()):08x}"
+
+
+def store_command(slot, name, settings, checksum=None):
+    """A store_preset command"""
+    if not 0 <= slot < PRESET_SLOTS:
+        raise ValueError(f"Preset slot must be 0..{PRESET_SLOTS - 1}")
+    if not name or len(name) > NAME_LENGTH:
+        raise ValueError(f"Preset names are 1..{NAME_LENGTH} characters")
+    settings = preset_settings(settings)
+    return {"cmd": "store_preset", "slot": slot, "name": name,
+            "checksum": checksum or preset_checksum(name, settings), **settings}
+
+
+class PresetBank:
+    """Host-side index of presets per board: name -> slot, checksum and settings, in a JSON file.
+
+    Call `select(board)` once the board id is known; the other methods
+    work on that board's presets. An entry's settings are None for a
+    preset pulled from the board, which only reports names and checksums.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.board = None
+        self._boards = None
+
+    def _load(self):
+        if self._boards is None:
+            try:
+                with open(self.path) as f:
+                    self._boards = {board: {"presets": {name: dict(entry) for name, entry in bank["presets"].items()},
+                                            "deleted": {int(slot): checksum
+                                                        for slot, checksum in bank.get("deleted", {}).items()}}
+                                    for board, bank in json.load(f).items()}
+            except (OSError, ValueError, TypeError, AttributeError, KeyError):
+                self._boards = {}
+        return self._boards
+
+    def _bank(self):
+        return self._load().setdefault(self.board or "", {"presets": {}, "deleted": {}})
+
+    def _presets(self):
+        return self._bank()["presets"]
+
+    def select(self, board):
+        """Work on the presets of `board` (a "board" id, None for boards that report none)"""
+        self.board = board
+
+    def names(self):
+        """Preset names in slot order"""
+        presets = self._presets()
+        return sorted(presets, key=lambda name: presets[name]["slot"])
+
+    def get(self, name):
+        return self._presets().get(name)
+
+    def put(self, name, settings):
+        """Add or replace a preset (in memory and in the index file); returns its entry"""
+        presets = self._presets()
+        deleted = self._bank()["deleted"]
+        entry = presets.get(name)
+        if entry is None:
+            used = {other["slot"] for other in presets.values()}
+            free = [slot for slot in range(PRESET_SLOTS) if slot not in used]
+            if not free:
+                raise ValueError(f"All {PRESET_SLOTS} preset slots are in use")
+            # Reuse a slot with a pending deletion last; storing to it replaces the deletion
+            free.sort(key=lambda slot: slot in deleted)
+            slot = free[0]
+        else:
+            slot = entry["slot"]
+        command = store_command(slot, name, settings)  # validates the name and settings
+        deleted.pop(slot, None)
+        presets[name] = {"slot": slot, "checksum": command["checksum"], "stored": False,
+                         "settings": {key: command[key] for key in ("channel1", "channel2", "modulation")}}
+        self._save()
+        return presets[name]
+
+    def remove(self, name):
+        """Drop a preset; the next sync deletes it from the board if the board still holds it"""
+        entry = self._presets().pop(name, None)
+        if entry is not None:
+            self._bank()["deleted"][entry["slot"]] = entry["checksum"]
+            self._save()
+
+    def sync(self, client, job=None):
+        """Reconcile the board and this index without losing presets on either side.
+
+        Uploads presets saved here that the board lacks, pulls presets the
+        index does not know, and deletes only the slots removed here.
+        Returns {"stored": [...], "pulled": [...], "deleted": [...],
+        "unchanged": n}, or the error response of the first command that
+        failed.
+        """
+        response = client.list_presets(job)
+        if not response or response.get("status") != "ok":
+            return response
+        on_device = {entry["slot"]: entry for entry in response.get("presets", [])}
+        presets = self._presets()
+        deleted = self._bank()["deleted"]
+        stored, pulled, removed, unchanged = [], [], [], 0
+
+        for slot, checksum in sorted(deleted.items()):
+            held = on_device.get(slot)
+            if held is not None and held.get("checksum") == checksum:
+                response = client.delete_preset(slot, job)
+                if not response or response.get("status") != "ok":
+                    return response
+                del on_device[slot]
+                removed.append(slot)
+            del deleted[slot]  # anything else in the slot was put there since, by someone else
+            self._save()
+
+        for name in self.names():
+            entry = presets[name]
+            held = on_device.pop(entry["slot"], None)
+            if held is not None and held.get("checksum") == entry["checksum"]:
+                if not entry.get("stored", True):
+                    entry["stored"] = True
+                    self._save()
+                unchanged += 1
+                continue
+            if held is not None and entry.get("stored", True):
+                # Replaced on the board since this host last saw it; the board's copy wins
+                del presets[name]
+                on_device[entry["slot"]] = held
+                self._save()
+                continue
+            if entry["settings"] is None:
+                del presets[name]  # pulled earlier and since deleted on the board
+                self._save()
+                continue
+            response = client.store_preset(entry["slot"], name, entry["settings"], entry["checksum"], job)
+            if not response or response.get("status") != "ok":
+                return response
+            entry["stored"] = True
+            self._save()
+            stored.append(name)
+
+        for slot, held in sorted(on_device.items()):
+            name = held.get("name") or f"Preset {slot}"
+            if name in presets:
+                name = f"{name} ({slot})"
+            presets[name] = {"slot": slot, "checksum": held.get("checksum"), "stored": True, "settings": None}
+            pulled.append(name)
+        if pulled:
+            self._save()
+        return {"status": "ok", "stored": stored, "pulled": pulled, "deleted": removed, "unchanged": unchanged}
+
+    def recall(self, client, name, job=None):
+        """Switch the board to a preset with one recall_preset command"""
+        entry = self.get(name)
+        if entry is None:
+            raise KeyError(f"No preset named {name!r}")
+        return client.recall_preset(entry["slot"], entry["settings"], entry["checksum"], job)
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self._load(), f, indent=2)
+        os.replace(temporary, self.path)
@@ -0,0 +1,176 @@
+"""Vectorized rendering of what FUNGENE_V2.ino outputs for a modulation setup.
+
+Each mode follows the firmware's symbol loop in setmod():
+
+- MFSK, M = 2: BSK() switches the output between FREQ0 (carrier) and FREQ1
+  (carrier + delta).
+- MPSK, M = 2: BSK() switches between PHASE0 (0 deg) and PHASE1 (delta deg).
+- MFSK, M > 2: FSK() steps the frequency to carrier + symbol * delta.
+- MPSK, M > 2: PSK() sets the phase to gray(symbol) * delta degrees, where
+  gray(d) = d ^ (d >> 1).
+- ASK: output on for non-zero symbols, off for zero.
+- SWEEP: M steps of delta above the carrier, one step per symbol period.
+- PWM: LEDC square wave at the carrier. The duty is a 0-100 symbol mapped
+  onto the timer resolution picked from the carrier frequency.
+- AM: carrier multiplied by a baud_rate tone on the AD633, at 100% depth.
+
+Symbols are clamped to the firmware's maxstate and replayed in a loop. The
+DDS phase accumulator is never reset, so frequency changes are phase
+continuous. Chunked synthesis carries the accumulator across calls.
+"""
+import numpy as np
+
+from cache import LRUCache, params_key
+
+# (highest frequency, timer resolution bits) from setmod()'s ledcAttach table
+PWM_RESOLUTIONS = (
+    (76, 20), (152, 19), (305, 18), (611, 17), (1223, 16), (2446, 15), (4892, 14), (9784, 13),
+    (19569, 12), (39138, 11), (78277, 10), (156555, 9), (313111, 8), (626223, 7), (1252446, 6),
+    (2504892, 5), (5009784, 4), (10019568, 3), (20039136, 2),
+)
+
+MAX_PREVIEW_SAMPLES = 4000000
+
+_render_cache = LRUCache(maxsize=16)
+
+
+def pwm_resolution(frequency):
+    """LEDC timer resolution (bits) the firmware uses for a PWM frequency"""
+    for limit, bits in PWM_RESOLUTIONS:
+        if frequency <= limit:
+            return bits
+    return 1
+
+
+def gray(symbols):
+    return symbols ^ (symbols >> 1)
+
+
+def max_state(params):
+    """Largest symbol value the firmware keeps for these parameters"""
+    mod_type, m = params["type"], int(params["m"])
+    if mod_type == "ASK" or (mod_type in ("MFSK", "MPSK") and m == 2):
+        return 1
+    if mod_type in ("MFSK", "MPSK"):
+        return m - 1
+    if mod_type == "PWM":
+        return (1 << pwm_resolution(params["frequency"])) - 1
+    return None
+
+
+def symbol_values(params):
+    """Symbols as the firmware plays them: clamped to maxstate, never empty"""
+    data = np.asarray(params.get("data") if len(params.get("data", ())) else [0], dtype=np.int64)
+    if params["type"] == "PWM":
+        top = max_state(params)
+        # Arduino map(d, 0, 100, 0, maxstate + 1), then clamped
+        return np.minimum(data * (top + 1) // 100, top)
+    top = max_state(params)
+    return np.minimum(data, top) if top is not None else data
+
+
+def symbol_index(params, sample_rate, start, count):
+    """Index of the symbol playing at each sample"""
+    n = np.arange(start, start + count, dtype=np.int64)
+    return (n * float(params["baud_rate"]) / sample_rate).astype(np.int64)
+
+
+def synthesize(params, sample_rate, start, count, phase=0.0):
+    """Render samples [start, start + count) of the output.
+
+    `phase` is the carrier accumulator (in cycles) at `start`; the
+    accumulator after the last sample is returned with the samples, so
+    consecutive chunks join without discontinuity.
+    """
+    mod_type = params["type"]
+    m = int(params["m"])
+    carrier = float(params["frequency"])
+    delta = float(params["delta_freq"])
+
+    k = symbol_index(params, sample_rate, start, count)
+    symbols = symbol_values(params)
+    current = symbols[k % len(symbols)]
+
+    amplitude = None
+    offset = 0.0  # extra phase in cycles, not accumulated
+    if mod_type == "MFSK":
+        frequency = carrier + (current != 0) * delta if m == 2 else carrier + current * delta
+    elif mod_type == "MPSK":
+        frequency = carrier
+        offset = ((current != 0) if m == 2 else gray(current)) * (delta / 360.0)
+    elif mod_type == "ASK":
+        frequency = carrier
+        amplitude = (current != 0).astype(np.float32)
+    elif mod_type == "SWEEP":
+        # SWEEP() works in whole hertz: int bufferfreq / int i
+        frequency = int(carrier) + (k % max(m, 1)) * int(delta)
+    elif mod_type == "PWM":
+        bits = pwm_resolution(carrier)
+        duty = current / float(1 << bits)
+        cycles = phase + np.arange(count) * (carrier / sample_rate)
+        samples = ((cycles % 1.0) < duty).astype(np.float32)
+        return samples, float((phase + count * carrier / sample_rate) % 1.0)
+    elif mod_type == "AM":
+        frequency = carrier
+        t = np.arange(start, start + count) / sample_rate
+        amplitude = ((1.0 + np.sin(2 * np.pi * float(params["baud_rate"]) * t)) / 2).astype(np.float32)
+    else:
+        raise ValueError(f"Unknown modulation type: {mod_type}")
+
+    # Accumulator value at each sample: phase plus the steps taken before it
+    step = np.broadcast_to(np.asarray(frequency, dtype=np.float64) / sample_rate, (count,))
+    cycles = np.cumsum(step)
+    end_phase = float((phase + cycles[-1]) % 1.0) if count else phase
+    cycles += phase - step
+    samples = np.sin(2 * np.pi * ((cycles % 1.0) + offset)).astype(np.float32)
+    if amplitude is not None:
+        samples *= amplitude
+    return samples, end_phase
+
+
+def iter_chunks(params, sample_rate, total, chunk_size=1 << 18):
+    """Yield the output in chunks of at most chunk_size samples"""
+    phase = 0.0
+    for start in range(0, total, chunk_size):
+        samples, phase = synthesize(params, sample_rate, start, min(chunk_size, total - start), phase)
+        yield samples
+
+
+def default_sample_rate(params):
+    """A sample rate that resolves both the carrier and the symbol edges"""
+    top = float(params["frequency"])
+    if params["type"] == "MFSK":
+        top += max(int(params["m"]) - 1, 1) * abs(float(params["delta_freq"]))
+    elif params["type"] == "SWEEP":
+        top += max(int(params["m"]) - 1, 0) * abs(float(params["delta_freq"]))
+    return max(20.0 * top, 50.0 * float(params["baud_rate"]), 1000.0)
+
+
+def render(params, sample_rate=None, duration=None):
+    """Render `duration` seconds (default: mod_time) as (times, samples).
+
+    Results are cached by a hash of the parameters with LRU eviction, and
+    the returned arrays are read-only.
+    """
+    sample_rate = sample_rate or default_sample_rate(params)
+    duration = float(params["mod_time"]) if duration is None else duration
+    count = int(min(round(duration * sample_rate), MAX_PREVIEW_SAMPLES))
+    key = params_key(params, sample_rate, count)
+
+    def compute():
+        samples, _ = synthesize(params, sample_rate, 0, count)
+        times = np.arange(count) / sample_rate
+        samples.setflags(write=False)
+        times.setflags(write=False)
+        return times, samples
+
+    return _render_cache.get_or_compute(key, compute)
+
+
+def minmax_decimate(samples, width):
+    """Min and max of the samples falling in each of `width` pixel columns"""
+    samples = np.asarray(samples)
+    if len(samples) <= width:
+        return samples, samples
+    edges = np.arange(width) * len(samples) // width
+    return np.minimum.reduceat(samples, edges), np.maximum.reduceat(samples, edges)
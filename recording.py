@@ -0,0 +1,410 @@
+"""Serial session recordings, and replaying them for regression and load tests.
+
+`SessionRecorder` is attached to a SerialTransport (recorder=..., or
+DeviceClient.start_recording, or "Record Session..." in the GUI) and
+appends every message in both directions to a file, as written and read:
+
+    kind       1 byte: OPEN, SENT, SENT_PART (more of the same command
+               follows, for streamed commands) or RECEIVED
+    time       8 bytes: perf_counter nanoseconds since the OPEN record
+    length     4 bytes, then the raw bytes (JSON line or binary frame)
+
+Every connection starts a new session with an OPEN record carrying JSON
+metadata (port, wall-clock start). The file is only ever appended to and
+each record is flushed, so a crash loses at most the record being written.
+
+`read_sessions` turns a file back into Sessions. Each sent command is
+paired with the reply that completed it, the same way the transport
+matches them. `replay` sends a session's commands to a device again,
+exactly as recorded but under fresh request ids, at the recorded pace
+scaled by `speed` (0 for as fast as the device answers), and diffs every
+reply against the recorded one. `load_test` replays sessions on several
+ports at once and reports the aggregate throughput.
+
+    python recording.py bench.fgs --list
+    python recording.py bench.fgs --port COM5 --speed 0
+    python recording.py bench.fgs --copies 8 --speed 0    # 8 concurrent simulators
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import framing
+from client import READY_TIMEOUT
+from instrumentation import Instruments
+from transport import RESPONSE_TIMEOUT, SerialTransport
+
+RECORD = struct.Struct("<BqI")  # kind, nanoseconds since OPEN, length
+OPEN, SENT, SENT_PART, RECEIVED = 0, 1, 2, 3
+FORMAT = "fungene-session/1"
+IGNORED_KEYS = ("board",)  # reply fields that differ between boards, not between firmware builds
+REPLAY_WINDOW = 1  # commands in flight during a replay
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulator.py")
+_TRAILING_ID = re.compile(rb'"id": ?\d+}\s*$')
+
+
+class SessionRecorder:
+    """Appends the messages of one or more connections to a session file; thread-safe"""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+        self._started = None
+
+    def open(self, **metadata):
+        """Start a new session; the transport calls this when it opens the port"""
+        metadata = dict(metadata, format=FORMAT, started=time.time())
+        with self._lock:
+            self._started = time.perf_counter_ns()
+        self._append(OPEN, json.dumps(metadata).encode())
+
+    def sent(self, data, more=False):
+        self._append(SENT_PART if more else SENT, data)
+
+    def received(self, data):
+        self._append(RECEIVED, data)
+
+    def _append(self, kind, data):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._started is None:
+                self._started = time.perf_counter_ns()
+            self._file.write(RECORD.pack(kind, time.perf_counter_ns() - self._started, len(data)))
+            self._file.write(data)
+            self._file.flush()
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def iter_records(path):
+    """Yield (kind, seconds, bytes) for every record; a truncated last record is ignored"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, nanoseconds, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, nanoseconds * 1e-9, data
+
+
+class Exchange:
+    """One recorded command and the reply that completed it (None if it got none)"""
+
+    __slots__ = ("at", "data", "request_id", "cmd", "reply")
+
+    def __init__(self, at, data, request_id, cmd):
+        self.at = at
+        self.data = data
+        self.request_id = request_id
+        self.cmd = cmd
+        self.reply = None
+
+
+class Session(collections.namedtuple("Session", "metadata exchanges events duration")):
+    """A recorded connection.
+
+    exchanges: Exchanges in the order the commands were sent
+    events:    counts of the unsolicited events by type
+    """
+
+
+def parse_command(data):
+    """(request id, cmd) of a recorded command; raises ValueError if it is neither JSON nor a frame"""
+    if data[:1] == bytes([framing.MAGIC]):
+        request_id, command = framing.decode(data)
+        return request_id, command["cmd"]
+    command = json.loads(data)
+    if not isinstance(command, dict):
+        raise ValueError("Command is not an object")
+    return command.get("id"), command.get("cmd")
+
+
+def with_request_id(data, request_id):
+    """A recorded command with its request id replaced, otherwise byte for byte"""
+    if data[:1] == bytes([framing.MAGIC]):
+        body = bytearray(data[:-framing.CRC.size])
+        struct.pack_into("<I", body, 4, request_id)
+        return bytes(body) + framing.CRC.pack(framing.crc16(body[1:]))
+    # The transport puts the id last, so only the tail has to change
+    replaced, count = _TRAILING_ID.subn(b'"id": %d}\n' % request_id, data)
+    if count:
+        return replaced
+    return (json.dumps(dict(json.loads(data), id=request_id)) + "\n").encode()
+
+
+def read_sessions(path):
+    """Every Session in a recording file"""
+    sessions = []
+    metadata, exchanges, events, pending = None, [], collections.Counter(), collections.OrderedDict()
+    partial, duration = b"", 0.0
+    echoes_ids = False
+
+    def finish():
+        if metadata is not None or exchanges:
+            sessions.append(Session(metadata or {}, exchanges, dict(events), duration))
+
+    for kind, at, data in iter_records(path):
+        if kind == OPEN:
+            finish()
+            metadata, exchanges, events = json.loads(data), [], collections.Counter()
+            pending, echoes_ids = collections.OrderedDict(), False
+            partial, duration = b"", 0.0
+            continue
+        duration = at
+        if kind == SENT_PART:
+            partial += data
+            continue
+        if kind == SENT:
+            data, partial = partial + data, b""
+            try:
+                request_id, cmd = parse_command(data)
+            except (ValueError, KeyError):
+                continue  # not a command the transport could have sent
+            exchange = Exchange(at, data, request_id, cmd)
+            exchanges.append(exchange)
+            pending[request_id] = exchange
+            continue
+        try:
+            reply = json.loads(data.decode(errors="replace").strip())
+            if not isinstance(reply, dict):
+                raise ValueError
+        except ValueError:
+            if echoes_ids or events:
+                continue  # the transport does not let these complete a request either
+            reply = {"status": "error", "error": "Invalid response format"}
+        if "event" in reply:
+            events[reply["event"]] += 1
+            continue
+        exchange = pending.pop(reply.get("id"), None)
+        if exchange is not None:
+            echoes_ids = True
+        elif "id" not in reply and pending:
+            _, exchange = pending.popitem(last=False)
+        if exchange is not None:
+            exchange.reply = reply
+    finish()
+    return sessions
+
+
+def diff_replies(expected, actual, ignore=IGNORED_KEYS, path=""):
+    """Differences between a recorded and a replayed reply as (path, recorded, replayed) tuples"""
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        differences = []
+        for key in sorted(set(expected) | set(actual)):
+            if key == "id" or key in ignore:
+                continue
+            differences += diff_replies(expected.get(key), actual.get(key), ignore, f"{path}.{key}" if path else key)
+        return differences
+    if isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        differences = []
+        for index, (left, right) in enumerate(zip(expected, actual)):
+            differences += diff_replies(left, right, ignore, f"{path}[{index}]")
+        return differences
+    if isinstance(expected, float) or isinstance(actual, float):
+        if isinstance(expected, (int, float)) and isinstance(actual, (int, float)) and \
+                math.isclose(expected, actual, rel_tol=1e-6, abs_tol=1e-9):
+            return []
+    elif expected == actual:
+        return []
+    return [(path, expected, actual)]
+
+
+ReplayResult = collections.namedtuple("ReplayResult", "index cmd reply differences")
+
+
+class ReplayReport(collections.namedtuple("ReplayReport", "port results events elapsed stats")):
+    """Outcome of replaying one session.
+
+    results: a ReplayResult per command; differences is empty when the
+             reply matched the recording
+    events:  counts of the unsolicited events seen during the replay
+    stats:   Instruments.snapshot() of the replay's link
+    """
+
+    @property
+    def mismatches(self):
+        return [result for result in self.results if result.differences]
+
+
+def replay(session, transport, speed=1.0, window=REPLAY_WINDOW, timeout=RESPONSE_TIMEOUT, ignore=IGNORED_KEYS):
+    """Send a session's commands over an open transport and diff the replies.
+
+    With speed > 0 each command waits for its recorded time divided by
+    `speed`; with speed 0 it goes as soon as fewer than `window` commands
+    are unanswered. Commands that timed out in the recording are expected
+    to time out again.
+    """
+    events = collections.Counter()
+
+    def count(message):
+        events[message["event"]] += 1
+
+    names = set(session.events) - {"ready"}  # the banner arrives before the replay starts
+    for name in names:
+        transport.subscribe(name, count)
+    exchanges = session.exchanges
+    futures = [None] * len(exchanges)
+    results = [None] * len(exchanges)
+    in_flight = collections.deque()
+
+    def collect(index):
+        exchange = exchanges[index]
+        reply = transport.wait(futures[index], timeout)
+        if exchange.reply is None and reply.get("error", "").startswith("Timeout"):
+            differences = []
+        elif exchange.reply is None:
+            differences = [("", None, reply)]
+        else:
+            differences = diff_replies(exchange.reply, reply, ignore)
+        results[index] = ReplayResult(index, exchange.cmd, reply, differences)
+
+    first = exchanges[0].at if exchanges else 0.0
+    started = time.perf_counter()
+    try:
+        for index, exchange in enumerate(exchanges):
+            while len(in_flight) >= window:
+                collect(in_flight.popleft())
+            if speed > 0:
+                delay = started + (exchange.at - first) / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            request_id = transport.new_id()
+            futures[index] = transport.send_prepared(
+                (request_id, with_request_id(exchange.data, request_id), exchange.cmd))
+            in_flight.append(index)
+        while in_flight:
+            collect(in_flight.popleft())
+    finally:
+        for name in names:
+            transport.unsubscribe(name, count)
+    elapsed = time.perf_counter() - started
+    stats = transport.instruments.snapshot() if transport.instruments is not None else None
+    return ReplayReport(transport.serial_port.port, results, dict(events), elapsed, stats)
+
+
+def replay_port(session, port, reset=True, ready_timeout=READY_TIMEOUT, **options):
+    """Open `port`, wait for the board to come up and replay `session` on it"""
+    transport = SerialTransport(port, reset=reset, instruments=Instruments())
+    try:
+        if reset:
+            transport.wait_ready(ready_timeout)
+        return replay(session, transport, **options)
+    finally:
+        transport.close()
+
+
+def load_test(sessions, ports, **options):
+    """Replay sessions[i] on ports[i], all at once; returns the ReplayReports and the wall time"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        reports = list(executor.map(lambda pair: replay_port(*pair, **options), zip(sessions, ports)))
+    return reports, time.perf_counter() - started
+
+
+def start_simulators(count, *options):
+    """Start `count` simulator processes; returns (processes, ports)"""
+    processes, ports = [], []
+    for _ in range(count):
+        process = subprocess.Popen([sys.executable, SIMULATOR, *options], stdout=subprocess.PIPE, text=True)
+        processes.append(process)
+        ports.append(process.stdout.readline().strip())
+    if not all(ports):
+        stop_simulators(processes)
+        raise RuntimeError("Simulator failed to start")
+    return processes, ports
+
+
+def stop_simulators(processes):
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def print_sessions(sessions):
+    for number, session in enumerate(sessions):
+        answered = sum(exchange.reply is not None for exchange in session.exchanges)
+        print(f"session {number}: port {session.metadata.get('port')}, {len(session.exchanges)} commands "
+              f"({answered} answered) in {session.duration:.2f} s, events {session.events}")
+        for exchange in session.exchanges:
+            status = "-" if exchange.reply is None else exchange.reply.get("status", "?")
+            print(f"  {exchange.at:10.4f}  {exchange.cmd or '?':16} {len(exchange.data):6d} B  {status}")
+
+
+def print_report(report, verbose=False):
+    mismatches = report.mismatches
+    print(f"{report.port}: {len(report.results)} commands in {report.elapsed:.2f} s, "
+          f"{len(mismatches)} mismatched, events {report.events}")
+    for result in mismatches[:None if verbose else 10]:
+        for path, recorded, replayed in result.differences[:None if verbose else 3]:
+            print(f"  #{result.index + 1} {result.cmd}: {path or 'reply'}: "
+                  f"recorded {recorded!r}, replayed {replayed!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay recorded serial sessions")
+    parser.add_argument("recording", help="session file written by a SessionRecorder")
+    parser.add_argument("--session", type=int, help="replay only this session of the file (default: the last)")
+    parser.add_argument("--list", action="store_true", help="print the recorded sessions instead of replaying")
+    parser.add_argument("--port", action="append", default=[], help="replay on this port (repeat for a load test)")
+    parser.add_argument("--copies", type=int, default=1, help="concurrent replays; simulators are started "
+                                                              "for the ones without a --port")
+    parser.add_argument("--speed", type=float, default=1.0, help="pace relative to the recording; 0 for flat out")
+    parser.add_argument("--window", type=int, default=REPLAY_WINDOW, help="commands in flight")
+    parser.add_argument("--timeout", type=float, default=RESPONSE_TIMEOUT, help="reply timeout (s)")
+    parser.add_argument("--ignore", action="append", default=list(IGNORED_KEYS), help="reply key not to diff")
+    parser.add_argument("--no-reset", action="store_true", help="open ports without resetting the boards")
+    parser.add_argument("--verbose", action="store_true", help="print every difference")
+    args = parser.parse_args()
+
+    sessions = read_sessions(args.recording)
+    if not sessions:
+        parser.error(f"{args.recording} holds no sessions")
+    if args.list:
+        print_sessions(sessions)
+        return
+    session = sessions[-1 if args.session is None else args.session]
+    count = max(args.copies, len(args.port))
+    processes, ports = start_simulators(count - len(args.port)) if count > len(args.port) else ([], [])
+    try:
+        reports, elapsed = load_test([session] * count, args.port + ports, reset=not args.no_reset,
+                                     speed=args.speed, window=args.window, timeout=args.timeout,
+                                     ignore=tuple(args.ignore))
+    finally:
+        stop_simulators(processes)
+
+    for report in reports:
+        print_report(report, args.verbose)
+    # Throughput over the replays themselves, not the port opening and boot before them
+    busy = max(report.elapsed for report in reports) or elapsed
+    commands = sum(len(report.results) for report in reports)
+    wire = sum(report.stats["bytes_sent"] + report.stats["bytes_received"] for report in reports)
+    latencies = [entry for report in reports for entry in report.stats["commands"].values()]
+    worst = max((entry["p99_ms"] for entry in latencies if entry["p99_ms"] is not None), default=None)
+    print(f"{count} replay(s): {commands} commands in {busy:.2f} s ({elapsed:.2f} s with connecting), "
+          f"{commands / busy:.0f} cmd/s, {wire / busy / 1000:.1f} kB/s on the wire"
+          + (f", worst per-command p99 {worst:.1f} ms" if worst is not None else ""))
+    sys.exit(1 if any(report.mismatches for report in reports) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Timed recipes of channel and modulation changes, run without the GUI.
+
+A recipe is a JSON file with a list of steps. Each step starts `dwell`
+seconds after the previous one, or at `at` seconds from the start of the
+run:
+
+    {"steps": [
+        {"channel": 1, "type": "Sine", "frequency": 1000, "enabled": true, "dwell": 0.5},
+        {"modulation": {"type": "MFSK", "m": 2, "enabled": false}},
+        {"sweep": {"channel": 1, "start": 100, "stop": 100000, "points": 31, "scale": "log"}, "dwell": 0.2},
+        {"sweep": {"channel": 2, "frequencies": [1000, 2500, 5000]}, "dwell": 1.0},
+        {"wait": 2.0},
+        {"at": 30.0, "channel": 1, "enabled": false}
+    ]}
+
+A sweep expands into one set_channel per point, `dwell` apart. The
+points are linear or logarithmic between start and stop, or an
+arbitrary list. The firmware's own SWEEP mode only does linear steps.
+
+Every command is built and encoded before the run starts. `Sequencer`
+then sends each one against an absolute deadline, so late steps never
+push back the ones after them. A step is written early by its expected
+one-way latency: its own wire time plus half the link overhead, learned
+from the replies as the run goes. The report compares each step's
+planned time with when the board applied it (send time plus measured
+one-way latency).
+
+    python sequencer.py recipe.json --port COM5 --csv timing.csv
+    python sequencer.py recipe.json --dry-run
+"""
+import argparse
+import collections
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+from client import DeviceClient, channel_command, modulation_command, is_ok, error_of
+from transport import RESPONSE_TIMEOUT
+
+START_LEAD = 0.2  # seconds between the end of the link probe and the first step
+LINK_PROBES = 5  # hello round trips timed before the run
+OVERHEAD_SMOOTHING = 0.2  # weight of each new round trip in the overhead estimate
+SPIN = 0.002  # seconds before a deadline to stop sleeping and spin
+CHANNEL_FIELDS = ("type", "frequency", "phase", "enabled")
+MODULATION_FIELDS = ("type", "m", "frequency", "delta_freq", "baud_rate", "mod_time", "data", "enabled")
+
+
+class Step(collections.namedtuple("Step", "at label command")):
+    """One command of a compiled recipe, due `at` seconds after the start"""
+
+
+class StepResult(collections.namedtuple("StepResult", "index label planned achieved rtt response")):
+    """Timing of one step; `achieved` and `rtt` are None if it got no reply"""
+
+    @property
+    def error(self):
+        """Achieved minus planned time, in seconds"""
+        return None if self.achieved is None else self.achieved - self.planned
+
+
+def sweep_frequencies(spec):
+    """The frequencies of a sweep step, as an array"""
+    if "frequencies" in spec:
+        frequencies = np.asarray(spec["frequencies"], dtype=np.float64)
+    else:
+        start, stop, points = float(spec["start"]), float(spec["stop"]), int(spec["points"])
+        scale = spec.get("scale", "linear")
+        if scale == "log":
+            if start <= 0 or stop <= 0:
+                raise ValueError("A log sweep needs positive start and stop frequencies")
+            frequencies = np.geomspace(start, stop, points)
+        elif scale == "linear":
+            frequencies = np.linspace(start, stop, points)
+        else:
+            raise ValueError(f"Unknown sweep scale: {scale}")
+    if frequencies.ndim != 1 or not len(frequencies):
+        raise ValueError("A sweep needs at least one frequency")
+    return frequencies
+
+
+def _step_commands(step):
+    """(label, command) pairs for the commands of one recipe step, in order"""
+    if "sweep" in step:
+        spec = step["sweep"]
+        channel = int(spec["channel"])
+        frequencies = np.round(sweep_frequencies(spec), 3)
+        # Validate once for the whole sweep rather than per point
+        channel_command(channel, frequency=float(frequencies.max()))
+        return [(f"ch{channel} {frequency:g} Hz", {"cmd": "set_channel", "channel": channel,
+                                                   "frequency": frequency})
+                for frequency in frequencies.tolist()]
+    if "channel" in step:
+        channel = int(step["channel"])
+        fields = {key: step[key] for key in CHANNEL_FIELDS if key in step}
+        command = channel_command(channel, fields.get("type"), fields.get("frequency"), fields.get("phase"),
+                                  fields.get("enabled"))
+        return [(f"ch{channel} " + " ".join(f"{key}={value}" for key, value in fields.items()), command)]
+    if "modulation" in step:
+        fields = step["modulation"]
+        unknown = set(fields) - set(MODULATION_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown modulation fields: {', '.join(sorted(unknown))}")
+        command = modulation_command(fields.get("type"), fields.get("m"), fields.get("frequency"),
+                                     fields.get("delta_freq"), fields.get("baud_rate"), fields.get("mod_time"),
+                                     fields.get("data"), fields.get("enabled"))
+        label = " ".join(f"{key}={value}" for key, value in fields.items() if key != "data")
+        return [("modulation " + label, command)]
+    if "wait" in step:
+        return []
+    raise ValueError("A step needs one of channel, modulation, sweep or wait")
+
+
+def compile_recipe(recipe):
+    """Expand a recipe (a dict, or a list of steps) into Steps ordered by time"""
+    steps = recipe["steps"] if isinstance(recipe, dict) else recipe
+    compiled = []
+    now = 0.0
+    for index, step in enumerate(steps):
+        try:
+            if "at" in step:
+                at = float(step["at"])
+                if at < now:
+                    raise ValueError(f"at={at:g} s is before the end of the previous step ({now:g} s)")
+                now = at
+            dwell = float(step.get("dwell", 0.0))
+            if dwell < 0:
+                raise ValueError("dwell must not be negative")
+            commands = _step_commands(step)
+            wait = 0.0 if commands else float(step["wait"])
+            if wait < 0:
+                raise ValueError("wait must not be negative")
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Step {index + 1}: {e}") from None
+        for label, command in commands:
+            compiled.append(Step(now, label, command))
+            now += dwell
+        now += wait
+    return compiled
+
+
+def load_recipe(path):
+    with open(path) as f:
+        return compile_recipe(json.load(f))
+
+
+def sleep_until(deadline):
+    """Sleep until perf_counter() reaches `deadline`, spinning for the last few milliseconds"""
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - SPIN if remaining > SPIN else 0)
+
+
+class Sequencer:
+    """Runs compiled Steps on a connected DeviceClient against absolute deadlines"""
+
+    def __init__(self, client, lead=START_LEAD):
+        self.client = client
+        self.lead = lead
+        self.overhead = None  # seconds of round trip beyond the wire time of both lines
+        self._lock = threading.Lock()
+
+    def wire_time(self, nbytes):
+        """Seconds `nbytes` take on the wire at the port's baud rate (8N1)"""
+        return nbytes * 10 / self.client.transport.serial_port.baudrate
+
+    def _one_way(self, sent_bytes, rtt, reply):
+        """Time from the start of a write until the board acted on it"""
+        reply_bytes = len(json.dumps(reply, separators=(",", ":"))) + 2
+        overhead = max(rtt - self.wire_time(sent_bytes) - self.wire_time(reply_bytes), 0.0)
+        with self._lock:
+            if self.overhead is None:
+                self.overhead = overhead
+            else:
+                self.overhead += OVERHEAD_SMOOTHING * (overhead - self.overhead)
+        return self.wire_time(sent_bytes) + overhead / 2
+
+    def probe_link(self, count=LINK_PROBES):
+        """Time a few short round trips to seed the latency estimate"""
+        transport = self.client.transport
+        for _ in range(count):
+            prepared = transport.prepare({"cmd": "hello"})
+            started = time.perf_counter()
+            future = transport.send_prepared(prepared)
+            response = transport.wait(future)
+            if _answered(future):
+                self._one_way(len(prepared[1]), time.perf_counter() - started, response)
+
+    def run(self, steps, timeout=RESPONSE_TIMEOUT, progress=None):
+        """Play the steps; returns a StepResult per step. `progress(index, step)` is called after each send."""
+        transport = self.client.transport
+        prepared = [transport.prepare(step.command) for step in steps]
+        self.probe_link()
+
+        sent = [None] * len(steps)
+        done = [None] * len(steps)
+        one_way = [None] * len(steps)
+
+        def finished(future, index, size):
+            # Runs on the reader thread, so later steps already use what this reply taught
+            done[index] = time.perf_counter()
+            if _answered(future):
+                one_way[index] = self._one_way(size, done[index] - sent[index], future.result())
+
+        futures = []
+        start = time.perf_counter() + self.lead
+        for index, (step, message) in enumerate(zip(steps, prepared)):
+            overhead = self.overhead or 0.0
+            sleep_until(start + step.at - (self.wire_time(len(message[1])) + overhead / 2))
+            sent[index] = time.perf_counter()
+            future = transport.send_prepared(message)
+            future.add_done_callback(lambda f, index=index, size=len(message[1]): finished(f, index, size))
+            futures.append(future)
+            if progress is not None:
+                progress(index, step)
+
+        results = []
+        for index, (step, future) in enumerate(zip(steps, futures)):
+            response = transport.wait(future, timeout)
+            achieved = rtt = None
+            if one_way[index] is not None:
+                rtt = done[index] - sent[index]
+                achieved = sent[index] + one_way[index] - start
+            results.append(StepResult(index, step.label, step.at, achieved, rtt, response))
+        # The commands bypassed the settings mirror
+        self.client.get_settings()
+        return results
+
+
+def _answered(future):
+    return future.done() and not future.cancelled() and future.exception() is None
+
+
+def summarize(results):
+    """Counts and timing error statistics of a run, errors in milliseconds"""
+    errors = np.array([abs(r.error) for r in results if r.error is not None]) * 1000
+    summary = {"steps": len(results), "failed": sum(not is_ok(r.response) for r in results),
+               "unanswered": sum(r.achieved is None for r in results)}
+    if len(errors):
+        summary.update(mean_error_ms=float(errors.mean()), p99_error_ms=float(np.percentile(errors, 99)),
+                       max_error_ms=float(errors.max()))
+    return summary
+
+
+def print_report(results):
+    print(f"{'step':>5} {'planned s':>10} {'achieved s':>11} {'error ms':>9} {'rtt ms':>8}  command")
+    for r in results:
+        achieved = f"{r.achieved:11.4f}" if r.achieved is not None else f"{'-':>11}"
+        error = f"{r.error * 1000:9.2f}" if r.error is not None else f"{'-':>9}"
+        rtt = f"{r.rtt * 1000:8.2f}" if r.rtt is not None else f"{'-':>8}"
+        status = "" if is_ok(r.response) else f"  [{error_of(r.response)}]"
+        print(f"{r.index + 1:5d} {r.planned:10.4f} {achieved} {error} {rtt}  {r.label}{status}")
+    summary = summarize(results)
+    line = f"{summary['steps']} steps, {summary['failed']} failed"
+    if "max_error_ms" in summary:
+        line += (f"; |error| mean {summary['mean_error_ms']:.2f} ms, p99 {summary['p99_error_ms']:.2f} ms, "
+                 f"max {summary['max_error_ms']:.2f} ms")
+    print(line)
+
+
+def save_report(results, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["step", "label", "planned_s", "achieved_s", "error_ms", "rtt_ms", "status"])
+        for r in results:
+            writer.writerow([r.index + 1, r.label, f"{r.planned:.6f}",
+                             "" if r.achieved is None else f"{r.achieved:.6f}",
+                             "" if r.error is None else f"{r.error * 1000:.3f}",
+                             "" if r.rtt is None else f"{r.rtt * 1000:.3f}",
+                             "ok" if is_ok(r.response) else error_of(r.response)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a timed recipe of channel and modulation changes")
+    parser.add_argument("recipe", help="recipe JSON file")
+    parser.add_argument("--port", help="serial port of the generator")
+    parser.add_argument("--dry-run", action="store_true", help="print the compiled steps without sending them")
+    parser.add_argument("--no-reset", action="store_true", help="open the port without resetting the board")
+    parser.add_argument("--json-only", action="store_true", help="do not negotiate binary frames")
+    parser.add_argument("--csv", help="write the per-step timing report to this file")
+    args = parser.parse_args()
+
+    steps = load_recipe(args.recipe)
+    if args.dry_run or not args.port:
+        if not args.dry_run:
+            parser.error("--port is required unless --dry-run is given")
+        for index, step in enumerate(steps):
+            print(f"{index + 1:5d} {step.at:10.4f}  {step.label}")
+        return
+
+    client = DeviceClient()
+    try:
+        client.connect(args.port, binary=not args.json_only, reset=not args.no_reset)
+        results = Sequencer(client).run(steps)
+    finally:
+        client.close()
+    print_report(results)
+    if args.csv:
+        save_report(results, args.csv)
+
+
+if __name__ == "__main__":
+    main()
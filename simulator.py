@@ -0,0 +1,685 @@
+"""Virtual FUNGENE board for running the host software without hardware.
+
+`VirtualDevice` opens a pseudo-terminal and answers on it the way
+FUNGENE_V2.ino's processCommand/sendSettings/sendOK/sendError do, so
+`serial.Serial` (and therefore the GUI, client and benchmark) connect to
+its `port` unchanged. Run it standalone to get a port for the GUI:
+
+    python simulator.py --baud 115200 --delay 0.002
+
+Like the real board, it reboots whenever the host opens the port (the
+pty cannot see DTR, so every open counts as a reset unless --no-reset):
+input is ignored for `boot_time`, then it sends {"event": "ready"}.
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+import framing
+
+DOC_CAPACITY = 32768  # COMMAND_DOC_CAPACITY in FUNGENE_V2.ino
+SLOT_SIZE = 16  # bytes per JSON value in an ArduinoJson 6 document on the ESP32
+MAX_BATCH_OPS = 16
+MAX_DATA_SYMBOLS = 1000
+DDS_TABLE_SIZE = 256
+MAX_PRESETS = 8
+PRESET_NAME_LENGTH = 24
+LOOP_NAMES = ("BSK", "FSK", "PSK", "ASK", "SWEEP", "PWM")
+DEFAULT_OVERHEAD = {"BSK": (39.0, 0.0), "FSK": (114.0, 0.0), "PSK": (40.0, 0.0),
+                    "ASK": (39.0, 0.0), "SWEEP": (114.0, 0.0), "PWM": (5.0, 0.0)}
+# What each simulated loop really takes per symbol (us): offset + slope * baud rate
+SIM_LOOP_OVERHEAD = {"BSK": (35.0, 0.0003), "FSK": (121.0, 0.001), "PSK": (44.0, 0.0002),
+                     "ASK": (33.0, 0.0003), "SWEEP": (104.0, 0.0008), "PWM": (7.0, 0.0)}
+SYMBOL_JITTER = 1.5  # us, standard deviation of one symbol period
+CALIBRATION_MAX_SYMBOLS = 10000
+CALIBRATION_MAX_SECONDS = 5
+BOOT_TIME = 0.5  # seconds from reset to the ready banner (ROM bootloader and setup())
+HOST_POLL = 0.05  # seconds between checks for the host opening the port
+TELEMETRY_BATCH = 32
+TELEMETRY_MAX_AGE = 0.1  # seconds before a partial batch goes out
+TELEMETRY_MAX_RATE = 10000
+STREAM_BUFFER_SIZE = 4096
+STREAM_CREDIT_BATCH = 256
+STREAM_STALL = 2.0  # seconds of starvation before playback gives up
+
+
+def _float32(value):
+    """Round a number the way storing it in a C float does"""
+    return struct.unpack("f", struct.pack("f", float(value)))[0]
+
+
+def _printed(value):
+    """ArduinoJson prints floats with about 7 significant digits"""
+    return float(f"{value:.7g}")
+
+
+def _changes_table(op):
+    """Whether a set_modulation op touches what a register table is compiled from"""
+    return any(op.get(key) is not None for key in ("type", "m", "frequency", "delta_freq", "data"))
+
+
+def document_size(value):
+    """Estimate the ArduinoJson document capacity needed to parse `value`"""
+    if isinstance(value, dict):
+        return SLOT_SIZE + sum(len(key) + 1 + document_size(item) for key, item in value.items())
+    if isinstance(value, list):
+        return SLOT_SIZE + sum(document_size(item) for item in value)
+    if isinstance(value, str):
+        return SLOT_SIZE + len(value) + 1
+    return SLOT_SIZE
+
+
+class DeviceModel:
+    """The firmware's command handling and settings, without the serial port"""
+
+    def __init__(self, doc_capacity=DOC_CAPACITY, binary=True, loop_overhead=None, seed=None, board="51A0000001"):
+        self.doc_capacity = doc_capacity
+        self.binary = binary
+        self.board = board
+        self.loop_overhead = dict(loop_overhead or SIM_LOOP_OVERHEAD)
+        self.calibration = dict(DEFAULT_OVERHEAD)  # what set_calibration last stored
+        self.pll = {"kp": 0.5, "kd": 0.0, "threshold": 0.1}
+        self.telemetry_rate = 0.0
+        self.phase_loop = None  # simulated phase-sync state while telemetry is on
+        self.random = random.Random(seed)
+        self.channel1 = {"type": "Sine", "frequency": 1000.0, "phase": 0.0, "enabled": True}
+        self.channel2 = {"type": "Sine", "frequency": 1000.0, "phase": 0.0, "enabled": True}
+        self.modulation = {"type": "MFSK", "m": 2, "frequency": 100000.0, "delta_freq": 1000.0,
+                           "baud_rate": 1000.0, "mod_time": 10.0, "enabled": False, "data": []}
+        self.stream = None  # playback state between stream_start and stream_end
+        self.table = None  # register table from load_table: id, entries, symbols
+        self.presets = {}  # slot -> stored preset, kept in "NVS" across resets
+
+    def process_line(self, line):
+        """Handle one command line and return the reply object"""
+        try:
+            doc = json.loads(line)
+            if not isinstance(doc, dict) or document_size(doc) > self.doc_capacity:
+                raise ValueError("NoMemory")
+        except ValueError:
+            return {"status": "error", "error": "Invalid JSON"}
+
+        return self._reply(doc.get("id", 0), self.process_command(doc))
+
+    def process_frame(self, frame):
+        """Handle one binary frame and return the reply object"""
+        try:
+            request_id, doc = framing.decode(frame)
+        except ValueError as e:
+            return {"status": "error", "error": "Bad CRC" if str(e) == "Bad CRC" else "Bad frame"}
+        # Frames other than stream_data are expanded into a JSON document on the device
+        if doc["cmd"] != "stream_data" and document_size(doc) > self.doc_capacity:
+            return self._reply(request_id, {"status": "error", "error": "Bad frame"})
+        return self._reply(request_id, self.process_command(doc))
+
+    def _reply(self, request_id, reply):
+        if request_id:
+            reply = dict({"status": reply.pop("status"), "id": request_id}, **reply)
+        return reply
+
+    def process_command(self, doc):
+        cmd = doc.get("cmd", "")
+        if cmd == "get_settings":
+            return self.settings()
+        if cmd == "set_channel":
+            return self._result(self._apply_channel(doc, self.channel1, self.channel2))
+        if cmd == "set_modulation":
+            error = self._apply_modulation(doc, self.modulation)
+            if not error and _changes_table(doc):
+                self.table = None
+            return self._result(error)
+        if cmd == "hello" and self.binary:
+            return {"status": "ok", "protocols": ["json", framing.PROTOCOL], "max_payload": framing.MAX_PAYLOAD}
+        if cmd == "calibrate":
+            return self._calibrate(doc)
+        if cmd == "set_telemetry":
+            rate = doc.get("rate", self.telemetry_rate)
+            if not isinstance(rate, (int, float)) or isinstance(rate, bool) or not 0 <= rate <= TELEMETRY_MAX_RATE:
+                return self._result("Invalid rate")
+            self.telemetry_rate = _float32(rate)
+            self.phase_loop = None
+            return {"status": "ok"}
+        if cmd == "set_pll":
+            return self._result(self._set_pll(doc))
+        if cmd == "set_calibration":
+            return self._result(self._set_calibration(doc))
+        if cmd == "load_table":
+            return self._result(self._load_table(doc))
+        if cmd == "store_preset":
+            return self._store_preset(doc)
+        if cmd == "recall_preset":
+            return self._recall_preset(doc)
+        if cmd == "list_presets":
+            return {"status": "ok", "slots": MAX_PRESETS,
+                    "presets": [{"slot": slot, "name": preset["name"], "checksum": preset["checksum"]}
+                                for slot, preset in sorted(self.presets.items())]}
+        if cmd == "delete_preset":
+            slot = doc.get("slot", -1)
+            if not isinstance(slot, int) or not 0 <= slot < MAX_PRESETS:
+                return self._result("Invalid slot")
+            self.presets.pop(slot, None)
+            return {"status": "ok"}
+        if cmd == "stream_start":
+            return self._stream_start(doc)
+        if cmd == "stream_data":
+            return self._stream_data(doc)
+        if cmd == "stream_stop":
+            if self.stream is not None:
+                self.stream["stopped"] = True
+            return {"status": "ok"}
+        if cmd == "batch":
+            if not isinstance(doc.get("ops"), list):
+                return {"status": "error", "error": "Missing ops"}
+            return self._batch(doc["ops"])
+        return {"status": "error", "error": "Unknown command"}
+
+    def tick(self, now):
+        """Advance stream playback and the phase loop to time `now` and return the events sent"""
+        return self._stream_tick(now) + self._telemetry_tick(now)
+
+    def _stream_tick(self, now):
+        stream = self.stream
+        if stream is None:
+            return []
+        if stream["stopped"]:
+            return self._stream_end("stopped")
+        if stream["clock"] is None:
+            if stream["written"] < stream["prefill"] and not stream["ending"]:
+                return []
+            stream["clock"] = now
+
+        # One symbol per period from the first one, like playStream()'s absolute deadlines
+        due = int((now - stream["clock"]) * stream["baud_rate"]) + 1
+        slots = due - stream["slots"]
+        stream["slots"] = max(due, stream["slots"])
+        events = []
+        if slots > 0:
+            played = min(slots, stream["written"] - stream["played"])
+            stream["played"] += played
+            if played:
+                stream["starved"] = None
+            if slots > played:
+                if stream["ending"]:
+                    return self._stream_credit() + self._stream_end("done")
+                stream["underruns"] += slots - played
+                if stream["starved"] is None:
+                    stream["starved"] = now
+                elif now - stream["starved"] > STREAM_STALL:
+                    return self._stream_credit() + self._stream_end("stalled")
+
+        uncredited = stream["played"] - stream["credited"]
+        if uncredited >= STREAM_CREDIT_BATCH or (uncredited and stream["played"] == stream["written"]):
+            events += self._stream_credit()
+        return events
+
+    def settings(self):
+        def printed(section):
+            return {key: _printed(value) if isinstance(value, float) else copy.copy(value)
+                    for key, value in section.items()}
+        modulation = dict(printed(self.modulation), table_id=self.table["id"] if self.table else 0)
+        return {"status": "ok", "channel1": printed(self.channel1), "channel2": printed(self.channel2),
+                "modulation": modulation, "board": self.board, "pll": printed(self.pll),
+                "telemetry": {"rate": _printed(self.telemetry_rate)},
+                "calibration": {loop: [_printed(offset), _printed(slope)]
+                                for loop, (offset, slope) in self.calibration.items()}}
+
+    def _result(self, error):
+        if error:
+            return {"status": "error", "error": error}
+        return {"status": "ok"}
+
+    def _batch(self, ops):
+        if len(ops) > MAX_BATCH_OPS:
+            return {"status": "error", "error": "Too many operations"}
+        staged1, staged2, staged_mod = (copy.deepcopy(self.channel1), copy.deepcopy(self.channel2),
+                                        copy.deepcopy(self.modulation))
+        results = []
+        for op in ops:
+            cmd = op.get("cmd", "") if isinstance(op, dict) else ""
+            if cmd == "set_channel":
+                error = self._apply_channel(op, staged1, staged2)
+            elif cmd == "set_modulation":
+                error = self._apply_modulation(op, staged_mod)
+            else:
+                error = "Unsupported batch command"
+            results.append(self._result(error))
+
+        if all(result["status"] == "ok" for result in results):
+            self.channel1, self.channel2, self.modulation = staged1, staged2, staged_mod
+            if any(op["cmd"] == "set_modulation" and _changes_table(op) for op in ops):
+                self.table = None
+            return {"status": "ok", "results": results}
+        return {"status": "error", "results": results, "error": "Batch rejected"}
+
+    def _calibrate(self, doc):
+        loop = doc.get("loop")
+        baud_rate = doc.get("baud_rate", self.modulation["baud_rate"])
+        symbols = doc.get("symbols", 200)
+        if loop not in LOOP_NAMES:
+            return self._result("Unknown loop")
+        if not isinstance(baud_rate, (int, float)) or baud_rate <= 0:
+            return self._result("Invalid baud rate")
+        if not isinstance(symbols, int) or not 1 <= symbols <= CALIBRATION_MAX_SYMBOLS or \
+                symbols / baud_rate > CALIBRATION_MAX_SECONDS:
+            return self._result("Invalid symbol count")
+
+        # symbolDelay(), then the loop's real overhead plus per-symbol jitter
+        offset, slope = self.calibration[loop]
+        delay = max(int(_float32(1000000 / baud_rate - (offset + slope * baud_rate))), 0)
+        true_offset, true_slope = self.loop_overhead[loop]
+        overhead = true_offset + true_slope * baud_rate
+        mean = delay + overhead + self.random.gauss(0.0, SYMBOL_JITTER / math.sqrt(symbols))
+        return {"status": "ok", "loop": loop, "baud_rate": _printed(baud_rate), "symbols": symbols,
+                "delay_us": delay, "mean_us": _printed(mean), "std_us": _printed(SYMBOL_JITTER),
+                "min_us": int(mean - 3 * SYMBOL_JITTER), "max_us": int(mean + 3 * SYMBOL_JITTER) + 1,
+                "overhead_us": _printed(mean - delay)}
+
+    def _telemetry_tick(self, now):
+        """Run the channel phase loop like loop() does and batch its samples into telemetry events"""
+        ch1, ch2 = self.channel1, self.channel2
+        if self.telemetry_rate <= 0 or not (ch1["enabled"] and ch2["enabled"]) or \
+                ch1["frequency"] != ch2["frequency"] or ch1["frequency"] <= 0:
+            return []
+        state = self.phase_loop
+        if state is None:
+            state = self.phase_loop = {"next": now, "epoch": now, "offset": self.random.uniform(-180.0, 180.0),
+                                       "current": 0.0, "previous": 0.0, "batch": []}
+        target = max(-173.0, min(173.0, (ch1["phase"] - ch2["phase"] + 180.0) % 360.0 - 180.0))
+        sign, magnitude = (1.0 if target >= 0 else -1.0), abs(target)
+        xor_period = 500000.0 / ch1["frequency"]  # us
+        iteration = (2.5 * xor_period + 60.0) * 1e-6
+        interval = 1.0 / self.telemetry_rate
+
+        events = []
+        state["next"] = max(state["next"], now - 0.5)  # after a stall, skip ahead instead of flooding
+        while state["next"] <= now:
+            for _ in range(max(1, min(int(interval / iteration), 50))):
+                difference = abs((state["offset"] + sign * state["current"] + 180.0) % 360.0 - 180.0)
+                high = max(math.floor(difference / 180.0 * xor_period + self.random.gauss(0.0, 0.05)), 0)
+                low = max(math.floor(xor_period - difference / 180.0 * xor_period + self.random.gauss(0.0, 0.05)), 0)
+                measured = high / (high + low) * 180.0 if high + low else 0.0
+                error = measured - magnitude
+                if abs(error) >= self.pll["threshold"]:
+                    state["current"] = (state["current"] - self.pll["kp"] * error
+                                        - self.pll["kd"] * (error - state["previous"])) % 360.0
+                state["previous"] = error
+            state["batch"].append((state["next"], measured, magnitude, state["current"]))
+            state["next"] += interval
+            if len(state["batch"]) == TELEMETRY_BATCH:
+                events.append(self._telemetry_event(state))
+        if state["batch"] and now - state["batch"][0][0] >= TELEMETRY_MAX_AGE:
+            events.append(self._telemetry_event(state))
+        return events
+
+    def _telemetry_event(self, state):
+        batch, state["batch"] = state["batch"], []
+        t0 = int((batch[0][0] - state["epoch"]) * 1e6)
+        return {"event": "telemetry", "t0": t0 & 0xFFFFFFFF,
+                "dt": [int((sample[0] - state["epoch"]) * 1e6) - t0 for sample in batch],
+                "measured": [round(sample[1] * 100) for sample in batch],
+                "target": [round(sample[2] * 100) for sample in batch],
+                "phase": [round(sample[3] * 100) for sample in batch], "dropped": 0}
+
+    def _set_pll(self, doc):
+        staged = dict(self.pll)
+        self._update(staged, doc, {"kp": float, "kd": float, "threshold": float})
+        if not 0 < staged["kp"] < 2 or staged["kd"] < 0 or staged["threshold"] < 0:
+            return "Invalid gains"
+        self.pll = staged
+        return ""
+
+    def _set_calibration(self, doc):
+        overhead = doc.get("overhead")
+        if not isinstance(overhead, dict):
+            return "Missing overhead"
+        for loop, fit in overhead.items():
+            if loop not in LOOP_NAMES or not isinstance(fit, list) or len(fit) != 2 or \
+                    not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in fit):
+                return "Invalid calibration"
+        for loop, (offset, slope) in overhead.items():
+            self.calibration[loop] = (_float32(offset), _float32(slope))
+        return ""
+
+    def _apply_preset(self, preset, ch1, ch2, mod):
+        if not all(isinstance(preset.get(key), dict) for key in ("channel1", "channel2", "modulation")):
+            return "Invalid preset"
+        self._apply_channel(dict(preset["channel1"], channel=1), ch1, ch2)
+        self._apply_channel(dict(preset["channel2"], channel=2), ch1, ch2)
+        return self._apply_modulation(preset["modulation"], mod)
+
+    def _store_preset(self, doc):
+        slot, name, checksum = doc.get("slot", -1), doc.get("name", ""), doc.get("checksum", "")
+        if not isinstance(slot, int) or not 0 <= slot < MAX_PRESETS:
+            return self._result("Invalid slot")
+        if not isinstance(name, str) or not 0 < len(name) <= PRESET_NAME_LENGTH or \
+                not isinstance(checksum, str) or not checksum:
+            return self._result("Invalid preset")
+        error = self._apply_preset(doc, copy.deepcopy(self.channel1), copy.deepcopy(self.channel2),
+                                   copy.deepcopy(self.modulation))
+        if error:
+            return self._result(error)
+        self.presets[slot] = copy.deepcopy({key: doc[key] for key in
+                                            ("name", "checksum", "channel1", "channel2", "modulation")})
+        return {"status": "ok", "slot": slot, "checksum": checksum,
+                "bytes": len(json.dumps(self.presets[slot], separators=(",", ":")))}
+
+    def _recall_preset(self, doc):
+        slot = doc.get("slot", -1)
+        if not isinstance(slot, int) or not 0 <= slot < MAX_PRESETS:
+            return self._result("Invalid slot")
+        preset = self.presets.get(slot)
+        if preset is None:
+            return self._result("Empty slot")
+        staged1, staged2, staged_mod = (copy.deepcopy(self.channel1), copy.deepcopy(self.channel2),
+                                        copy.deepcopy(self.modulation))
+        error = self._apply_preset(preset, staged1, staged2, staged_mod)
+        if error:
+            return self._result(error)
+        self.channel1, self.channel2, self.modulation = staged1, staged2, staged_mod
+        if _changes_table(preset["modulation"]):
+            self.table = None
+        return {"status": "ok", "slot": slot, "checksum": preset["checksum"]}
+
+    def _load_table(self, doc):
+        freq, phase, index = doc.get("freq"), doc.get("phase"), doc.get("index")
+        if not all(isinstance(value, list) for value in (freq, phase, index)):
+            return "Invalid table"
+        if not 0 < len(freq) <= DDS_TABLE_SIZE or len(phase) != len(freq):
+            return "Invalid table"
+        if len(index) != len(self.modulation["data"]) or len(index) > MAX_DATA_SYMBOLS:
+            return "Table does not match data"
+        if any(not isinstance(word, int) or not 0 <= word < 1 << 28 for word in freq) or \
+                any(not isinstance(word, int) or not 0 <= word < 4096 for word in phase) or \
+                any(not isinstance(entry, int) or not 0 <= entry < len(freq) for entry in index):
+            return "Invalid table"
+        table_id = doc.get("table_id", 1)
+        self.table = {"id": table_id if isinstance(table_id, int) and table_id > 0 else 1,
+                      "entries": len(freq), "symbols": len(index)}
+        return ""
+
+    def _stream_start(self, doc):
+        staged = copy.deepcopy(self.modulation)
+        error = self._apply_modulation(doc, staged)
+        if not error and staged["type"] not in ("MFSK", "MPSK", "ASK"):
+            error = f"Streaming not supported for {staged['type']}"
+        if not error and staged["baud_rate"] <= 0:
+            error = "Invalid baud rate"
+        if error:
+            return self._result(error)
+        self.modulation = staged
+        if _changes_table(doc):
+            self.table = None
+
+        prefill = doc.get("prefill")
+        prefill = prefill if isinstance(prefill, int) and not isinstance(prefill, bool) else STREAM_BUFFER_SIZE // 2
+        tag = doc.get("stream")
+        tag = tag if isinstance(tag, int) and not isinstance(tag, bool) and tag >= 0 else 0
+        self.stream = {"tag": tag, "baud_rate": staged["baud_rate"],
+                       "prefill": min(max(prefill, 0), STREAM_BUFFER_SIZE),
+                       "written": 0, "played": 0, "credited": 0, "underruns": 0, "slots": 0,
+                       "clock": None, "starved": None, "ending": False, "stopped": False}
+        return {"status": "ok", "stream": tag, "capacity": STREAM_BUFFER_SIZE, "credit_batch": STREAM_CREDIT_BATCH,
+                "baud_rate": _printed(staged["baud_rate"])}
+
+    def _stream_data(self, doc):
+        stream = self.stream
+        if stream is None:
+            return self._result("Not streaming")
+        symbols = doc.get("symbols")
+        symbols = symbols if isinstance(symbols, list) else []
+        if len(symbols) > STREAM_BUFFER_SIZE - (stream["written"] - stream["played"]):
+            return self._result("Stream buffer overflow")
+        m = self.modulation["m"]
+        limit = m - 1 if 2 <= m <= 256 else 255
+        if any(not isinstance(symbol, int) or isinstance(symbol, bool) or not 0 <= symbol <= limit
+               for symbol in symbols):
+            return self._result("Symbol out of range")
+        stream["written"] += len(symbols)
+        if doc.get("end") is True:
+            stream["ending"] = True
+        return {"status": "ok"}
+
+    def _stream_credit(self):
+        stream = self.stream
+        credits = stream["played"] - stream["credited"]
+        if not credits:
+            return []
+        stream["credited"] = stream["played"]
+        return [{"event": "stream_credit", "stream": stream["tag"], "credits": credits,
+                 "underruns": stream["underruns"]}]
+
+    def _stream_end(self, reason):
+        stream, self.stream = self.stream, None
+        return [{"event": "stream_end", "stream": stream["tag"], "reason": reason, "played": stream["played"],
+                 "underruns": stream["underruns"]}]
+
+    def _apply_channel(self, op, ch1, ch2):
+        ch = op.get("channel", 1)
+        if ch not in (1, 2):
+            return "Invalid channel"
+        self._update(ch1 if ch == 1 else ch2, op, {"type": str, "frequency": float, "phase": float,
+                                                  "enabled": bool})
+        return ""
+
+    def _apply_modulation(self, op, mod):
+        if isinstance(op.get("data"), list) and len(op["data"]) > MAX_DATA_SYMBOLS:
+            return "Too many symbols"
+        self._update(mod, op, {"type": str, "m": int, "frequency": float, "delta_freq": float,
+                               "baud_rate": float, "mod_time": float, "enabled": bool})
+        if "data" in op and op["data"] is not None:
+            data = op["data"]
+            mod["data"] = [int(value) for value in data if isinstance(value, (int, float))] \
+                if isinstance(data, list) else []
+        return ""
+
+    def _update(self, target, op, fields):
+        # `doc[key] | current` keeps the current value for missing or mistyped fields
+        for key, kind in fields.items():
+            value = op.get(key)
+            if kind is bool:
+                if isinstance(value, bool):
+                    target[key] = value
+            elif kind is str:
+                if isinstance(value, str):
+                    target[key] = value
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                target[key] = int(value) if kind is int else _float32(value)
+
+
+class VirtualDevice:
+    """A DeviceModel served over a pseudo-terminal.
+
+    baud_rate:   emulate the wire time of every byte in both directions
+                 (None for an infinitely fast link)
+    delay:       processing time per command, in seconds
+    drop_rate:   probability that a reply is never sent
+    garble_rate: probability that a reply is corrupted on the wire
+    boot_time:   seconds from a reset to the ready banner
+    reset_on_open: reboot (and lose all settings) whenever the host opens the port
+    """
+
+    def __init__(self, baud_rate=115200, delay=0.0, drop_rate=0.0, garble_rate=0.0,
+                 doc_capacity=DOC_CAPACITY, seed=None, binary=True, boot_time=BOOT_TIME, reset_on_open=True):
+        self._model_args = (doc_capacity, binary, None, seed)
+        self.model = DeviceModel(*self._model_args)
+        self.baud_rate = baud_rate
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.random = random.Random(seed)
+        self.boot_time = boot_time
+        self.reset_on_open = reset_on_open
+
+        self.port = None
+        self.commands = 0
+        self.resets = 0
+        self.host_open = False
+        self._booted_at = None  # when the ready banner is due after a reset
+        self._master = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # Keep only the master open, so reads fail (EIO) exactly while the host has the port closed
+        os.close(slave)
+        self.host_open = False
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._serve, name="virtual-esp32", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._master is not None:
+            os.close(self._master)
+        self._master = None
+
+    def reset(self):
+        """Reboot the board: forget its settings and announce ready after `boot_time`"""
+        presets, pll = self.model.presets, self.model.pll
+        self.model = DeviceModel(*self._model_args)
+        self.model.presets, self.model.pll = presets, pll  # NVS survives the reset
+        self.resets += 1
+        self._booted_at = time.monotonic() + self.boot_time
+
+    def write(self, data):
+        """Send raw bytes to the host, paced at the emulated baud rate"""
+        self._wire_delay(len(data))
+        os.write(self._master, data)
+
+    def _wire_delay(self, nbytes):
+        if self.baud_rate:
+            time.sleep(nbytes * 10 / self.baud_rate)  # 8N1: 10 bits per byte
+
+    def _serve(self):
+        buffer = b""
+        while not self._stopped.is_set():
+            # Poll often while a stream plays or telemetry runs, so events go out on time
+            busy = self.model.stream or self.model.telemetry_rate > 0
+            timeout = 0.002 if busy else 0.1
+            if self._booted_at is not None:
+                timeout = min(timeout, max(self._booted_at - time.monotonic(), 0.0))
+            ready, _, _ = select.select([self._master], [], [], timeout)
+            if not ready and not self.host_open:
+                # select only blocks while the slave side is open
+                buffer = b""
+                self._host_opened()
+            if self._booted_at is not None:
+                if time.monotonic() < self._booted_at:
+                    self._discard_input(ready)
+                    continue
+                self._booted_at = None
+                self._send({"event": "ready", "board": self.model.board})
+            for event in self.model.tick(time.monotonic()):
+                self._send(event)
+            if not ready:
+                continue
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                # EIO: the host closed the port
+                self.host_open = False
+                self._stopped.wait(HOST_POLL)
+                continue
+            if not self.host_open:
+                buffer = b""
+                self._host_opened()
+                if self.reset_on_open:
+                    continue  # sent while the board was still resetting
+            self._wire_delay(len(chunk))
+            buffer += chunk
+            while True:
+                if self.model.binary:
+                    message = framing.split_message(buffer)
+                elif b"\n" in buffer:
+                    message = (None,) + tuple(buffer.split(b"\n", 1))
+                else:
+                    message = None
+                if message is None:
+                    break
+                frame, line, buffer = message
+                self._handle(line, frame)
+
+    def _host_opened(self):
+        self.host_open = True
+        if self.reset_on_open:
+            self.reset()
+
+    def _discard_input(self, ready):
+        """Drop what the host sends while the board boots, as the real UART does"""
+        if ready:
+            try:
+                os.read(self._master, 4096)
+            except OSError:
+                self.host_open = False
+                self._booted_at = None
+
+    def _handle(self, line, frame=None):
+        self.commands += 1
+        if frame is not None:
+            reply = self.model.process_frame(frame)
+        else:
+            reply = self.model.process_line(line.decode(errors="replace"))
+        if self.delay:
+            time.sleep(self.delay)
+        self._send(reply)
+
+    def _send(self, reply):
+        if not self.host_open or self.random.random() < self.drop_rate:
+            return
+
+        data = (json.dumps(reply, separators=(",", ":")) + "\r\n").encode()
+        if self.random.random() < self.garble_rate:
+            data = bytearray(data)
+            data[self.random.randrange(len(data) - 2)] = self.random.randrange(256)
+            data = bytes(data)
+        self.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a virtual FUNGENE board on a pseudo-terminal")
+    parser.add_argument("--baud", type=float, default=115200, help="emulated baud rate (0 for unlimited)")
+    parser.add_argument("--delay", type=float, default=0.0, help="processing delay per command (s)")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability of dropping a reply")
+    parser.add_argument("--garble", type=float, default=0.0, help="probability of corrupting a reply")
+    parser.add_argument("--doc-capacity", type=int, default=DOC_CAPACITY, help="JSON document capacity (bytes)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--no-binary", action="store_true", help="emulate firmware without binary frames")
+    parser.add_argument("--boot-time", type=float, default=BOOT_TIME, help="seconds from reset to the ready banner")
+    parser.add_argument("--no-reset", action="store_true", help="keep running when the host opens the port")
+    args = parser.parse_args()
+
+    device = VirtualDevice(args.baud or None, args.delay, args.drop, args.garble, args.doc_capacity, args.seed,
+                           not args.no_binary, args.boot_time, not args.no_reset)
+    with device:
+        print(device.port, flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Spectral footprint of a modulation setup.
+
+The signal from preview.iter_chunks is fed through a streaming Welch
+estimator. It averages Hann-windowed periodograms of overlapping segments
+and keeps only the running sum and the partial segment between chunks, so
+memory stays fixed however long mod_time is. From the PSD it reports:
+- occupied bandwidth (99% of the power),
+- main-lobe width around the strongest peak,
+- the strongest spurs outside the main lobe, in dBc.
+"""
+import csv
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import preview
+from cache import LRUCache, params_key
+
+OCCUPIED_FRACTION = 0.99
+MAX_ANALYSIS_SAMPLES = 1 << 24
+SPUR_COUNT = 5
+
+_spectrum_cache = LRUCache(maxsize=8)
+
+
+class WelchAccumulator:
+    """Averaged-periodogram PSD estimate fed one chunk at a time"""
+
+    def __init__(self, sample_rate, nperseg=4096, overlap=0.5):
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.hop = max(1, int(nperseg * (1 - overlap)))
+        self.window = np.hanning(nperseg)
+        self.segments = 0
+        self._power = np.zeros(nperseg // 2 + 1)
+        self._carry = np.empty(0, dtype=np.float32)
+
+    def feed(self, chunk):
+        buffer = np.concatenate((self._carry, chunk)) if len(self._carry) else np.asarray(chunk)
+        if len(buffer) < self.nperseg:
+            self._carry = buffer
+            return
+        segments = sliding_window_view(buffer, self.nperseg)[::self.hop]
+        spectra = np.fft.rfft(segments * self.window, axis=1)
+        self._power += np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=0)
+        self.segments += len(segments)
+        self._carry = buffer[len(segments) * self.hop:].copy()
+
+    def result(self):
+        """(frequencies, one-sided PSD in units^2/Hz)"""
+        frequencies = np.fft.rfftfreq(self.nperseg, 1.0 / self.sample_rate)
+        if not self.segments:
+            return frequencies, np.zeros_like(frequencies)
+        psd = self._power / (self.segments * self.sample_rate * np.sum(self.window ** 2))
+        psd[1:-1] *= 2
+        return frequencies, psd
+
+
+def occupied_band(frequencies, psd, fraction=OCCUPIED_FRACTION):
+    """Lower and upper edge holding `fraction` of the total power"""
+    cumulative = np.cumsum(psd)
+    if cumulative[-1] <= 0:
+        return 0.0, 0.0
+    cumulative /= cumulative[-1]
+    tail = (1 - fraction) / 2
+    low = np.searchsorted(cumulative, tail)
+    high = min(np.searchsorted(cumulative, 1 - tail), len(frequencies) - 1)
+    return float(frequencies[low]), float(frequencies[high])
+
+
+def main_lobe(psd, peak):
+    """Bin range of the lobe around `peak`, walking down to the first minimum each side"""
+    low = peak
+    while low > 0 and psd[low - 1] < psd[low]:
+        low -= 1
+    high = peak
+    while high < len(psd) - 1 and psd[high + 1] < psd[high]:
+        high += 1
+    return low, high
+
+
+def spurs(frequencies, psd_db, lobe, count=SPUR_COUNT):
+    """Strongest local maxima outside the main lobe as (frequency, dB) pairs"""
+    interior = np.arange(1, len(psd_db) - 1)
+    peaks = interior[(psd_db[1:-1] > psd_db[:-2]) & (psd_db[1:-1] >= psd_db[2:])]
+    peaks = peaks[(peaks < lobe[0]) | (peaks > lobe[1])]
+    strongest = peaks[np.argsort(psd_db[peaks])[::-1][:count]]
+    return [(float(frequencies[i]), float(psd_db[i])) for i in strongest]
+
+
+def analyze(params, sample_rate=None, duration=None, nperseg=4096, cancelled=None):
+    """PSD and occupancy figures for a modulation setup (cached).
+
+    `duration` defaults to mod_time, capped at MAX_ANALYSIS_SAMPLES.
+    `cancelled` is an optional threading.Event checked between chunks.
+    """
+    sample_rate = sample_rate or preview.default_sample_rate(params)
+    duration = float(params["mod_time"]) if duration is None else duration
+    total = int(min(round(duration * sample_rate), MAX_ANALYSIS_SAMPLES))
+    key = params_key(params, sample_rate, total, nperseg)
+
+    result = _spectrum_cache.get(key)
+    if result is not None:
+        return result
+
+    welch = WelchAccumulator(sample_rate, nperseg)
+    for chunk in preview.iter_chunks(params, sample_rate, total):
+        if cancelled is not None and cancelled.is_set():
+            return None
+        welch.feed(chunk)
+    frequencies, psd = welch.result()
+
+    psd_db = 10 * np.log10(np.maximum(psd, 1e-20))
+    peak = int(np.argmax(psd))
+    lobe = main_lobe(psd, peak)
+    band = occupied_band(frequencies, psd)
+    result = {
+        "frequencies": frequencies,
+        "psd": psd,
+        "psd_db": psd_db,
+        "sample_rate": sample_rate,
+        "samples": total,
+        "resolution_hz": sample_rate / nperseg,
+        "peak_hz": float(frequencies[peak]),
+        "peak_db": float(psd_db[peak]),
+        "occupied_band_hz": band,
+        "occupied_bandwidth_hz": band[1] - band[0],
+        "main_lobe_hz": (float(frequencies[lobe[0]]), float(frequencies[lobe[1]])),
+        "main_lobe_width_hz": float(frequencies[lobe[1]] - frequencies[lobe[0]]),
+        "spurs_dbc": [(f, level - float(psd_db[peak])) for f, level in spurs(frequencies, psd_db, lobe)],
+    }
+    _spectrum_cache.put(key, result)
+    return result
+
+
+def export_csv(result, path):
+    """Write the PSD and the summary figures to a CSV file"""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["# occupied_bandwidth_hz", result["occupied_bandwidth_hz"]])
+        writer.writerow(["# main_lobe_width_hz", result["main_lobe_width_hz"]])
+        writer.writerow(["# peak_hz", result["peak_hz"]])
+        for frequency, level in result["spurs_dbc"]:
+            writer.writerow(["# spur_hz_dbc", frequency, level])
+        writer.writerow(["frequency_hz", "psd", "psd_db"])
+        writer.writerows(zip(result["frequencies"].tolist(), result["psd"].tolist(), result["psd_db"].tolist()))
@@ -0,0 +1,226 @@
+"""Continuous symbol streaming into the ESP32's ring buffer.
+
+In streaming mode the firmware plays symbols from a STREAM_BUFFER_SIZE ring
+buffer at the baud rate instead of looping over a fixed data array. It
+hands consumed slots back as credits in {"event": "stream_credit"}
+messages. `SymbolStream` sends stream_data chunks only while it has credits
+for them, so the buffer never overflows, and keeps it topped up from any
+iterable of symbols: a list, a generator such as `prbs`, or a
+datasource.SymbolSource.
+
+Both events carry the "stream" tag the host put in stream_start, so a
+late event from an earlier, aborted stream cannot end or feed the next one.
+
+    stream_start  {modulation fields, "prefill", "stream"} -> stream, capacity, credit_batch, baud_rate
+    stream_data   {"symbols": [...], "end": true on the last chunk}
+    stream_stop   abort playback
+    stream_end    event once playback finishes: stream, reason, played, underruns
+"""
+import collections
+import itertools
+import threading
+import time
+
+from transport import RESPONSE_TIMEOUT
+
+STREAM_CHUNK = 256  # symbols per stream_data command
+
+# Feedback taps of maximal-length LFSRs, by register length
+PRBS_TAPS = {7: (7, 6), 9: (9, 5), 11: (11, 9), 15: (15, 14), 20: (20, 3), 23: (23, 18), 31: (31, 28)}
+
+
+def prbs(order=9, m=2, seed=1):
+    """Endless PRBS-`order` sequence, packed MSB first into log2(m)-bit symbols"""
+    if order not in PRBS_TAPS:
+        raise ValueError(f"Unsupported PRBS order: {order}")
+    bits_per_symbol = int(m).bit_length() - 1
+    if m < 2 or (1 << bits_per_symbol) != m:
+        raise ValueError("M must be a power of two")
+    first, second = PRBS_TAPS[order]
+    state = seed & ((1 << order) - 1) or 1
+    while True:
+        symbol = 0
+        for _ in range(bits_per_symbol):
+            bit = ((state >> (first - 1)) ^ (state >> (second - 1))) & 1
+            state = ((state << 1) | bit) & ((1 << order) - 1)
+            symbol = (symbol << 1) | bit
+        yield symbol
+
+
+def iter_symbol_chunks(symbols, chunk_size=STREAM_CHUNK):
+    """Yield lists of at most chunk_size symbols from any symbol source"""
+    if hasattr(symbols, "iter_chunks"):
+        for chunk in symbols.iter_chunks(chunk_size):
+            yield chunk.tolist()
+        return
+    iterator = iter(symbols)
+    while True:
+        chunk = [int(symbol) for symbol in itertools.islice(iterator, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+class CreditWindow:
+    """Free slots in the device's stream buffer, as known to the host"""
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.available = capacity
+        self._condition = threading.Condition()
+
+    def release(self, credits):
+        with self._condition:
+            self.available = min(self.capacity, self.available + credits)
+            self._condition.notify_all()
+
+    def acquire(self, count, timeout):
+        """Take `count` credits, waiting up to `timeout`; False if they did not arrive"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.available >= count, timeout):
+                return False
+            self.available -= count
+            return True
+
+    @property
+    def outstanding(self):
+        return self.capacity - self.available
+
+
+class StreamError(Exception):
+    pass
+
+
+class SymbolStream:
+    """Feeds one stream to a device through a SerialTransport.
+
+    `run` blocks until the device has played every symbol (or the stream
+    fails) and returns a dict with "status", "sent", "played",
+    "underruns" and, on failure, "error". An optional `job` (see
+    DeviceClient) makes it cancellable; `progress(sent, underruns)` is
+    called after each chunk.
+    """
+
+    def __init__(self, transport, chunk_size=STREAM_CHUNK, prefill=None):
+        self.transport = transport
+        self.chunk_size = chunk_size
+        self.prefill = prefill
+        self.credits = CreditWindow()
+        self.underruns = 0
+        self._ended = threading.Event()
+        self._end = {}
+        self._tag = None
+        self._tagged = True  # until the stream_start reply shows otherwise
+        self._last_credit = time.monotonic()
+
+    def run(self, symbols, modulation=None, job=None, progress=None):
+        start = dict(modulation or {}, cmd="stream_start")
+        start.pop("data", None)
+        if self.prefill is not None:
+            start["prefill"] = self.prefill
+        self._tag = start["stream"] = self.transport.new_id()
+
+        self.transport.subscribe("stream_credit", self._on_credit)
+        self.transport.subscribe("stream_end", self._on_end)
+        try:
+            reply = self._request(start, job)
+            if not reply or reply.get("status") != "ok":
+                return reply
+            self._tagged = "stream" in reply  # older firmware sends untagged events
+            self.credits = CreditWindow(reply["capacity"])
+            self.chunk_size = min(self.chunk_size, reply["capacity"])
+            baud_rate = float(reply["baud_rate"])
+            # Credits come back every credit_batch symbols; allow for that on top of the usual timeout
+            stall_timeout = RESPONSE_TIMEOUT + reply.get("credit_batch", self.chunk_size) / baud_rate
+
+            try:
+                sent = self._feed(symbols, job, progress, stall_timeout)
+                drain_timeout = self.credits.outstanding / baud_rate + RESPONSE_TIMEOUT
+                self._wait_ended(job, drain_timeout)
+            except BaseException:
+                self.transport.request({"cmd": "stream_stop"})
+                raise
+        except StreamError as e:
+            return {"status": "error", "error": str(e), "underruns": self.underruns}
+        finally:
+            self.transport.unsubscribe("stream_credit", self._on_credit)
+            self.transport.unsubscribe("stream_end", self._on_end)
+
+        result = {"status": "ok" if self._end.get("reason") == "done" else "error", "sent": sent,
+                  "played": self._end.get("played", 0), "underruns": self._end.get("underruns", self.underruns)}
+        if result["status"] != "ok":
+            result["error"] = f"Stream {self._end.get('reason', 'failed')}"
+        return result
+
+    def _feed(self, symbols, job, progress, stall_timeout):
+        """Send every chunk as credits allow; returns the number of symbols sent"""
+        in_flight = collections.deque()
+        sent = 0
+        chunks = iter_symbol_chunks(symbols, self.chunk_size)
+        chunk = next(chunks, [])
+        while True:
+            following = next(chunks, None)
+            command = {"cmd": "stream_data", "symbols": chunk}
+            if following is None:
+                command["end"] = True
+
+            self._last_credit = time.monotonic()
+            while not self.credits.acquire(len(chunk), 0.1):
+                self._check(job)
+                if time.monotonic() - self._last_credit > stall_timeout:
+                    raise StreamError("Stream stalled: no credits from the device")
+            in_flight.append(self.transport.send(command))
+            sent += len(chunk)
+
+            # Collect the acknowledgements that have arrived without waiting for the rest
+            while in_flight and (in_flight[0].done() or len(in_flight) > 64):
+                response = self.transport.wait(in_flight.popleft())
+                if response.get("status") != "ok":
+                    raise StreamError(response.get("error", "Unknown error"))
+            if progress is not None:
+                progress(sent, self.underruns)
+            if following is None:
+                break
+            chunk = following
+
+        for future in in_flight:
+            response = self.transport.wait(future)
+            if response.get("status") != "ok":
+                raise StreamError(response.get("error", "Unknown error"))
+        return sent
+
+    def _wait_ended(self, job, timeout):
+        deadline = time.monotonic() + timeout
+        while not self._ended.wait(0.1):
+            self._check(job)
+            if time.monotonic() > deadline:
+                raise StreamError("Timeout waiting for the stream to finish")
+
+    def _check(self, job):
+        if job is not None:
+            job.check_cancelled()
+        if self._ended.is_set() and self._end.get("reason") != "done":
+            raise StreamError(f"Stream {self._end.get('reason', 'failed')} on the device")
+
+    def _request(self, command, job):
+        if job is not None:
+            return job.request(self.transport, command)
+        return self.transport.request(command)
+
+    def _ours(self, event):
+        if "stream" in event:
+            return event["stream"] == self._tag
+        return not self._tagged
+
+    def _on_credit(self, event):
+        if not self._ours(event):
+            return
+        self._last_credit = time.monotonic()
+        self.underruns = event.get("underruns", self.underruns)
+        self.credits.release(event.get("credits", 0))
+
+    def _on_end(self, event):
+        if not self._ours(event):
+            return
+        self._end = event
+        self._ended.set()
@@ -0,0 +1,142 @@
+"""Phase-loop telemetry from the ESP32.
+
+After set_telemetry {"rate": samples/s} the firmware reports its channel
+phase loop as {"event": "telemetry"} lines between command replies, one
+batch of samples per line:
+
+    t0        esp_timer microseconds of the first sample (32 bits, wraps)
+    dt        microsecond offsets of the samples from t0
+    measured  XOR-detector phase, hundredths of a degree
+    target    target phase magnitude, hundredths of a degree
+    phase     the adjusted generator's currentPhase, hundredths of a degree
+    dropped   samples lost so far because the serial buffer was full
+
+`TelemetryBuffer` keeps the newest samples in fixed-size NumPy arrays. The
+transport's reader thread appends without taking a lock. Readers copy a
+window and retry if the writer lapped them, so the reader thread never
+waits on the GUI.
+"""
+import numpy as np
+
+COLUMNS = ("time", "measured", "target", "error", "phase")
+DEFAULT_CAPACITY = 1 << 17  # samples
+LOCK_TOLERANCE = 1.0  # degrees
+
+
+class TelemetryBuffer:
+    """Ring buffer of the newest telemetry samples, one array row per column"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.written = 0  # samples appended since the last clear
+        self.dropped = 0  # as reported by the device
+        self._data = np.zeros((len(COLUMNS), capacity))
+        self._reserved = 0  # `written` once the append in progress completes
+        self._last_t0 = None
+        self._wraps = 0
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def clear(self):
+        self.written = self._reserved = 0
+        self.dropped = 0
+        self._last_t0 = None
+        self._wraps = 0
+
+    def append(self, times, measured, target, phase):
+        """Append samples (seconds and degrees); only one thread may append"""
+        columns = [np.asarray(values, dtype=np.float64) for values in (times, measured, target)]
+        columns.insert(3, columns[1] - columns[2])
+        columns.append(np.asarray(phase, dtype=np.float64))
+        total = len(columns[0])
+        if total == 0:
+            return
+        columns = [values[-self.capacity:] for values in columns]
+        count = len(columns[0])
+
+        # Announce the overwrite before doing it, so a reader can tell its copy was lapped
+        self._reserved = self.written + total
+        start = (self._reserved - count) % self.capacity
+        first = min(count, self.capacity - start)
+        for row, values in enumerate(columns):
+            self._data[row, start:start + first] = values[:first]
+            self._data[row, :count - first] = values[first:]
+        self.written = self._reserved
+
+    def append_event(self, event):
+        """Transport callback for {"event": "telemetry"} messages"""
+        try:
+            t0 = int(event["t0"])
+            offsets = np.asarray(event["dt"], dtype=np.float64)
+            measured, target, phase = (np.asarray(event[key], dtype=np.float64) / 100.0
+                                       for key in ("measured", "target", "phase"))
+        except (KeyError, TypeError, ValueError):
+            return
+        if not len(offsets) == len(measured) == len(target) == len(phase):
+            return
+        if self._last_t0 is not None and t0 < self._last_t0 - (1 << 31):
+            self._wraps += 1  # the 32-bit microsecond clock rolled over (every ~71 minutes)
+        self._last_t0 = t0
+        self.dropped = event.get("dropped", self.dropped)
+        times = ((self._wraps << 32) + t0 + offsets) * 1e-6
+        self.append(times, measured, target, phase)
+
+    def latest(self, count=None):
+        """Copy of the newest `count` samples (all kept ones by default) as a dict of arrays"""
+        for _ in range(8):
+            end = self.written
+            available = min(end, self.capacity)
+            count = available if count is None else min(count, available)
+            start = end - count
+            indices = np.arange(start, end) % self.capacity
+            copy = self._data[:, indices]
+            if self._reserved - start <= self.capacity:
+                return dict(zip(COLUMNS, copy))
+            count = count // 2  # the writer lapped the copy; take fewer, newer samples
+        return dict(zip(COLUMNS, np.zeros((len(COLUMNS), 0))))
+
+    def window(self, seconds):
+        """The samples of the last `seconds` of telemetry"""
+        count = 4096
+        while True:
+            samples = self.latest(count)
+            times = samples["time"]
+            if len(times) < count or not len(times) or times[-1] - times[0] >= seconds:
+                break
+            count *= 2
+        if len(times):
+            keep = times >= times[-1] - seconds
+            samples = {name: values[keep] for name, values in samples.items()}
+        return samples
+
+    def save(self, path):
+        """Write every kept sample to .npz, or CSV for any other extension"""
+        samples = self.latest()
+        if path.lower().endswith(".npz"):
+            np.savez_compressed(path, dropped=self.dropped, **samples)
+        else:
+            np.savetxt(path, np.column_stack([samples[name] for name in COLUMNS]), delimiter=",",
+                       fmt="%.6f", header=",".join(COLUMNS), comments="")
+
+
+def lock_quality(samples, tolerance=LOCK_TOLERANCE):
+    """Summary statistics of a window of samples, in degrees and seconds"""
+    error = samples["error"]
+    if not len(error):
+        return {"samples": 0}
+    times = samples["time"]
+    locked = np.abs(error) <= tolerance
+    duration = times[-1] - times[0]
+    # Time since the error last left the tolerance
+    outside = np.flatnonzero(~locked)
+    if not len(outside):
+        locked_for = duration
+    elif outside[-1] + 1 < len(error):
+        locked_for = times[-1] - times[outside[-1] + 1]
+    else:
+        locked_for = 0.0
+    return {"samples": len(error), "rate": float((len(error) - 1) / duration) if duration > 0 else 0.0,
+            "rms_error": float(np.sqrt(np.mean(error ** 2))), "max_error": float(np.max(np.abs(error))),
+            "p99_error": float(np.percentile(np.abs(error), 99)), "locked_fraction": float(locked.mean()),
+            "locked_for": float(locked_for), "phase_std": float(np.std(samples["phase"]))}
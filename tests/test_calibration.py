@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from calibration import (CALIBRATION_BAUDS, LOOPS, Calibration, CalibrationCache, achieved_baud, calibrate_command,
+                         fit_line)
+from simulator import DeviceModel
+
+TRUTH = {"BSK": (31.0, 0.0004), "FSK": (122.5, 0.0011), "PSK": (47.0, 0.0), "ASK": (29.0, 0.0002),
+         "SWEEP": (96.0, 0.0008), "PWM": (6.5, 0.0)}
+
+
+@pytest.fixture(scope="module")
+def model():
+    return DeviceModel(loop_overhead=TRUTH, seed=1)
+
+
+@pytest.fixture(scope="module")
+def calibration(model):
+    results = [model.process_command(calibrate_command(loop, baud)) for loop in LOOPS for baud in CALIBRATION_BAUDS]
+    assert all(result["status"] == "ok" for result in results)
+    return Calibration.from_results(model.board, results)
+
+
+def test_fit_line_is_exact_on_a_line():
+    offset, slope = fit_line([(baud, 12.0 + 0.003 * baud) for baud in CALIBRATION_BAUDS])
+    assert offset == pytest.approx(12.0)
+    assert slope == pytest.approx(0.003)
+
+
+@pytest.mark.parametrize("loop", LOOPS)
+def test_fit_recovers_the_simulated_overhead(calibration, loop):
+    offset, slope = TRUTH[loop]
+    fitted_offset, fitted_slope = calibration.overhead[loop]
+    assert abs(fitted_offset - offset) < 1.0
+    assert abs(fitted_slope - slope) < 1e-4
+
+
+@pytest.mark.parametrize("loop", LOOPS)
+def test_calibrated_loops_hit_the_baud_rate(model, calibration, loop):
+    assert model.process_command(calibration.command())["status"] == "ok"
+    _, error = achieved_baud(1000.0, loop, calibration)
+    assert abs(error) < 0.002
+    measured = model.process_command(calibrate_command(loop, 1000.0))
+    assert abs(1e6 / measured["mean_us"] - 1000.0) < 2.0
+
+
+def test_default_overheads_miss_the_real_ones(calibration):
+    _, error = achieved_baud(1000.0, "FSK", None, calibration)
+    assert abs(error) > 0.005
+
+
+def test_calibration_round_trips_through_json(calibration):
+    restored = Calibration.from_dict(json.loads(json.dumps(calibration.to_dict())))
+    assert restored.overhead == calibration.overhead
+    assert restored.command() == calibration.command()
+
+
+def test_cache_keeps_calibrations_per_board(tmp_path, calibration):
+    path = str(tmp_path / "calibration.json")
+    CalibrationCache(path).put(calibration)
+    cache = CalibrationCache(path)
+    assert cache.get(calibration.board).overhead == calibration.overhead
+    assert cache.get("another board") is None
+    assert cache.get(None) is None
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+import framing
+from framing import SYMBOL_WIDTHS, decode, encode, pack_symbols, split_message, unpack_symbols
+
+rng = random.Random(1)
+COMMANDS = [
+    {"cmd": "set_channel", "channel": 1, "type": "Square", "frequency": 1234.5, "phase": 90.0, "enabled": True},
+    {"cmd": "set_channel", "channel": 2, "frequency": 1000.0},
+    {"cmd": "set_modulation", "type": "MPSK", "m": 8, "frequency": 100000.0, "delta_freq": 45.0,
+     "baud_rate": 1000.0, "mod_time": 10.0, "data": [rng.randrange(8) for _ in range(1000)], "enabled": True},
+    {"cmd": "set_modulation", "baud_rate": 250.0},
+    {"cmd": "set_modulation", "data": []},
+    {"cmd": "set_modulation", "type": "PWM", "data": [0, 25, 50, 100, 65535]},
+    {"cmd": "stream_data", "symbols": [rng.randrange(4) for _ in range(4096)], "end": True},
+    {"cmd": "stream_data", "symbols": [1, 0, 1]},
+]
+COMMANDS.append({"cmd": "batch", "ops": COMMANDS[:4]})
+
+
+@pytest.mark.parametrize("width", SYMBOL_WIDTHS)
+def test_symbols_round_trip(width):
+    symbols = [rng.randrange(1 << width) for _ in range(rng.randrange(1, 50))]
+    assert unpack_symbols(pack_symbols(symbols, width), width, len(symbols)) == symbols
+
+
+@pytest.mark.parametrize("command", COMMANDS, ids=lambda command: command["cmd"])
+def test_encode_decode_round_trip(command):
+    frame = encode(command, 1234)
+    assert frame is not None
+    assert decode(frame) == (1234, command)
+
+
+@pytest.mark.parametrize("command", COMMANDS, ids=lambda command: command["cmd"])
+def test_split_message_takes_one_frame(command):
+    frame = encode(command, 7)
+    assert split_message(frame + b'{"cmd"') == (frame, None, b'{"cmd"')
+    assert split_message(frame[:-1]) is None
+
+
+@pytest.mark.parametrize("position", [1, 4, -3, -1])
+def test_crc_rejects_corruption(position):
+    frame = bytearray(encode(COMMANDS[0], 1))
+    frame[position] ^= 0x10
+    with pytest.raises(ValueError):
+        decode(bytes(frame))
+
+
+def test_truncated_frame_is_rejected():
+    with pytest.raises(ValueError):
+        decode(encode(COMMANDS[0], 1)[:-1])
+
+
+@pytest.mark.parametrize("command", [
+    {"cmd": "get_settings"},
+    {"cmd": "set_channel", "channel": 3},
+    {"cmd": "set_modulation", "type": "QAM"},
+    {"cmd": "set_modulation", "data": [-1]},
+    {"cmd": "set_modulation", "data": [70000]},
+], ids=str)
+def test_unencodable_commands_fall_back_to_json(command):
+    assert encode(command) is None
+
+
+def test_oversize_payload_falls_back_to_json():
+    command = {"cmd": "set_modulation", "data": [rng.randrange(1 << 16) for _ in range(1000)]}
+    payload = len(framing.encode_payload(command)[1])
+    assert encode(command, 1, max_payload=payload) is not None
+    assert encode(command, 1, max_payload=payload - 1) is None
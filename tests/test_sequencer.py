@@ -0,0 +1,14 @@
+import pytest
+
+from sequencer import compile_recipe
+
+
+def test_wait_advances_the_plan():
+    steps = compile_recipe([{"channel": 1, "frequency": 1000.0}, {"wait": 1.5}, {"channel": 1, "frequency": 2000.0}])
+    assert [step.at for step in steps] == [0.0, 1.5]
+
+
+@pytest.mark.parametrize("wait", [-1, "soon"])
+def test_bad_wait_names_the_step(wait):
+    with pytest.raises(ValueError, match=r"^Step 2: "):
+        compile_recipe([{"channel": 1, "frequency": 1000.0}, {"wait": wait}])
@@ -0,0 +1,33 @@
+import pytest
+
+from simulator import DeviceModel
+
+REJECTED = [
+    {"cmd": "batch", "ops": [{"cmd": "set_modulation", "data": [1]}, {"cmd": "set_channel", "channel": 3}]},
+    {"cmd": "stream_start", "type": "PWM", "m": 4},
+    {"cmd": "store_preset", "slot": 0, "name": "a", "checksum": "c", "channel1": {}, "channel2": {},
+     "modulation": {"m": 2}},
+]
+
+
+@pytest.fixture
+def model():
+    model = DeviceModel(seed=1)
+    assert model.process_command({"cmd": "set_modulation", "type": "MFSK", "m": 4, "data": [0, 1, 2, 3]}) == \
+        {"status": "ok"}
+    assert model.process_command({"cmd": "load_table", "freq": [1, 2, 3, 4], "phase": [0, 0, 0, 0],
+                                  "index": [0, 1, 2, 3], "table_id": 7}) == {"status": "ok"}
+    return model
+
+
+@pytest.mark.parametrize("command", REJECTED, ids=lambda command: command["cmd"])
+def test_staged_changes_keep_the_table(model, command):
+    model.process_command(command)
+    assert model.settings()["modulation"]["table_id"] == 7
+
+
+def test_committed_changes_drop_the_table(model):
+    model.process_command({"cmd": "set_modulation", "baud_rate": 100})
+    assert model.settings()["modulation"]["table_id"] == 7
+    model.process_command({"cmd": "set_modulation", "m": 4})
+    assert model.settings()["modulation"]["table_id"] == 0
@@ -0,0 +1,30 @@
+import pytest
+
+from client import DeviceClient
+from simulator import VirtualDevice
+
+STREAM = dict(mod_type="MFSK", m=4, baud_rate=2000)
+
+
+@pytest.fixture
+def client():
+    with VirtualDevice(baud_rate=None, boot_time=0.0) as device:
+        client = DeviceClient()
+        client.connect(device.port, ready_timeout=2)
+        yield client
+        client.close()
+
+
+def test_stream_plays_every_symbol(client):
+    result = client.stream([0, 1, 2, 3] * 100, **STREAM)
+    assert result["status"] == "ok"
+    assert result["played"] == 400
+
+
+def test_aborted_stream_does_not_end_the_next(client):
+    result = client.stream([0, 1, 2, 3] * 100 + [9] * 50, **STREAM)
+    assert result["status"] == "error"
+    assert result["error"] == "Symbol out of range"
+    result = client.stream([0, 1, 2, 3] * 100, **STREAM)
+    assert result["status"] == "ok"
+    assert result["played"] == 400
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from simulator import VirtualDevice
+from transport import WRITE_BUFFER, SerialTransport
+
+
+class FailingSource:
+    """A lazy data array that breaks after one write buffer's worth of symbols"""
+
+    def iter_chunks(self):
+        yield np.zeros(WRITE_BUFFER, dtype=np.uint8)
+        raise OSError("Disk read failed")
+
+
+@pytest.fixture
+def transport():
+    with VirtualDevice(baud_rate=None, delay=0.05, boot_time=0.0) as device:
+        transport = SerialTransport(device.port)
+        assert transport.wait_ready(2)
+        yield transport
+        transport.close()
+
+
+def test_failed_stream_does_not_take_the_next_reply(transport):
+    with pytest.raises(OSError):
+        transport.send({"cmd": "set_modulation", "data": FailingSource()})
+    future = transport.send({"cmd": "get_settings"})
+    response = transport.wait(future, 2)
+    assert response["status"] == "ok"
+    assert response["id"] == future.request_id
+    assert all("event" in message for message in transport.responses.queue)
@@ -0,0 +1,374 @@
+import collections
+import itertools
+import json
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future, InvalidStateError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import serial
+
+import framing
+from instrumentation import command_key
+
+BAUD_RATE = 115200
+RESPONSE_TIMEOUT = 10  # seconds
+UNMATCHED_BACKLOG = 100  # late or unsolicited replies kept on `responses`
+WRITE_BUFFER = 16384  # bytes gathered per write when streaming a command
+
+
+class _Streamed(Exception):
+    pass
+
+
+def _reject_lazy(value):
+    if hasattr(value, "iter_chunks"):
+        raise _Streamed
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_json(value):
+    """Yield the JSON text of `value` in pieces.
+
+    Objects with an `iter_chunks()` method (datasource.SymbolSource) are
+    written as arrays one chunk at a time, so a large data array is never
+    held as a single Python list or string.
+    """
+    if isinstance(value, dict):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            yield (", " if i else "") + json.dumps(key) + ": "
+            yield from iter_json(item)
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            yield from iter_json(item)
+        yield "]"
+    elif hasattr(value, "iter_chunks"):
+        yield "["
+        separator = ""
+        for chunk in value.iter_chunks():
+            if len(chunk):
+                yield separator + ",".join(map(str, chunk.tolist()))
+                separator = ","
+        yield "]"
+    else:
+        yield json.dumps(value)
+
+
+class SerialTransport:
+    """Serial link to the ESP32 with a background line reader.
+
+    Every command is tagged with an "id" that the firmware echoes back, so
+    several commands can be in flight and each reply is matched to its
+    request. Replies without an id (older firmware, garbled lines) complete
+    the oldest outstanding request, since the firmware answers in order.
+    Once a reply has shown that the firmware echoes ids, or while any
+    event subscription is active, a line that is not valid JSON may just as
+    well be a corrupted event, so it goes to `responses` instead.
+    Unsolicited messages carry an "event" key instead; they go to the
+    callbacks registered with `subscribe` and never complete a request.
+    Anything left over is put on the `responses` queue.
+
+    Set `binary` (after a successful hello, see DeviceClient.negotiate) to
+    send the commands framing.py can encode as binary frames.
+
+    Opening the port pulses DTR, which resets the ESP32; the firmware then
+    announces itself with {"event": "ready"} once setup() is done, which
+    sets `ready`. Pass reset=False to open with DTR and RTS held low so a
+    running board keeps its state (and sends no banner).
+
+    Pass an instrumentation.Instruments as `instruments` to record
+    per-command latency, wire bytes, timeouts and undecodable lines, and a
+    recording.SessionRecorder as `recorder` (or set it later) to log every
+    message in both directions for replay.
+    """
+
+    def __init__(self, port, baudrate=BAUD_RATE, timeout=1, reset=True, instruments=None, recorder=None):
+        if reset:
+            self.serial_port = serial.Serial(port, baudrate, timeout=timeout)
+        else:
+            self.serial_port = serial.Serial(None, baudrate, timeout=timeout)
+            self.serial_port.port = port
+            self.serial_port.dtr = False
+            self.serial_port.rts = False
+            self.serial_port.open()
+        self.ready = threading.Event()
+        self.banner = None  # the last {"event": "ready"} message
+        self.responses = queue.Queue(maxsize=UNMATCHED_BACKLOG)
+        self.binary = False
+        self.max_payload = framing.MAX_PAYLOAD
+        self.bytes_written = 0
+        self.echoes_ids = False  # set by the first reply matched by its id
+        self.instruments = instruments
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.open(port=port, baudrate=baudrate, reset=reset)
+
+        self._pending = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._subscribers = {}
+        self._write_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._closed = threading.Event()
+
+        self._reader = threading.Thread(target=self._read_loop, name="serial-reader", daemon=True)
+        self._reader.start()
+
+    def new_id(self):
+        """A request id no other command on this link uses"""
+        return next(self._ids)
+
+    def send(self, command):
+        """Write a command and return a Future resolved with its reply"""
+        request_id = self.new_id()
+        command = dict(command, id=request_id)
+        return self._write(request_id, self._encode(command, request_id), command)
+
+    def prepare(self, command):
+        """Assign a request id and encode `command` now; returns (request_id, line, cmd) for send_prepared.
+
+        Lets a caller pay for the encoding before a timed run. The framing
+        is fixed at this point, so prepare after negotiating.
+        """
+        request_id = self.new_id()
+        line = self._encode(dict(command, id=request_id), request_id)
+        if line is None:
+            raise ValueError("Streamed commands cannot be prepared")
+        return request_id, line, command.get("cmd")
+
+    def send_prepared(self, prepared):
+        """Write a prepared command and return a Future resolved with its reply"""
+        request_id, line, cmd = prepared
+        return self._write(request_id, line, cmd=cmd)
+
+    def _encode(self, command, request_id):
+        line = framing.encode(command, request_id, self.max_payload) if self.binary else None
+        if line is None:
+            try:
+                line = (json.dumps(command, default=_reject_lazy) + "\n").encode()
+            except _Streamed:
+                line = None
+        return line
+
+    def _write(self, request_id, line, command=None, cmd=None):
+        future = Future()
+        future.request_id = request_id
+        future.cmd = command.get("cmd") if command is not None else cmd
+        future.key = None
+        instruments = self.instruments
+        if instruments is not None and instruments.enabled and command is not None:
+            future.key = command_key(command)
+        future.sent_at = time.perf_counter()  # a reply without an id may complete it before the write lock is free
+        with self._pending_lock:
+            self._pending[request_id] = future
+        try:
+            with self._write_lock:
+                written = self.bytes_written
+                future.sent_at = time.perf_counter()
+                if line is not None:
+                    self.serial_port.write(line)
+                    self.bytes_written += len(line)
+                    if self.recorder is not None:
+                        self.recorder.sent(line)
+                else:
+                    self._write_streamed(command)
+        except Exception as e:
+            if self.bytes_written > written:
+                # Part of the line went out; the firmware rejects it with a reply that has no id,
+                # so leave the failed request pending to absorb that reply
+                future.set_exception(e)
+            else:
+                self.discard(future)
+            raise
+        if instruments is not None and instruments.enabled:
+            instruments.sent(future.cmd, self.bytes_written - written, future.key)
+        return future
+
+    def wait(self, future, timeout=RESPONSE_TIMEOUT):
+        """Block until a reply for `future` arrives, returning a response dict"""
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            return self.expire(future)
+        except CancelledError:
+            return {"status": "error", "error": "Cancelled"}
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+        finally:
+            self.discard(future)
+
+    def request(self, command, timeout=RESPONSE_TIMEOUT):
+        """Send a command and wait for its reply"""
+        try:
+            future = self.send(command)
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+        return self.wait(future, timeout)
+
+    def expire(self, future):
+        """Give up on a request that got no reply in time; returns the timeout error response"""
+        self.discard(future)
+        instruments = self.instruments
+        # asyncio.wait_for cancels the future on timeout; only a reply that just made it is not a timeout
+        if instruments is not None and instruments.enabled and (future.cancelled() or not future.done()):
+            instruments.timeout(future.cmd, future.key, time.perf_counter() - future.sent_at)
+        return {"status": "error", "error": f"Timeout waiting for response to {future.cmd}"}
+
+    def close(self):
+        """Stop the reader thread and close the port"""
+        self._closed.set()
+        try:
+            self.serial_port.close()
+        finally:
+            self._fail_pending(ConnectionError("Port closed"))
+        if self._reader is not threading.current_thread():
+            self._reader.join(timeout=2)
+
+    def wait_ready(self, timeout):
+        """Wait up to `timeout` seconds for the ready banner; True once it arrived"""
+        return self.ready.wait(timeout)
+
+    def subscribe(self, event, callback):
+        """Call `callback(message)` for every message with "event" == `event`.
+
+        Callbacks run on the reader thread and must not block.
+        """
+        with self._pending_lock:
+            self._subscribers.setdefault(event, []).append(callback)
+
+    def unsubscribe(self, event, callback):
+        with self._pending_lock:
+            callbacks = self._subscribers.get(event, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def discard(self, future):
+        """Stop tracking a request whose reply is no longer wanted"""
+        with self._pending_lock:
+            self._pending.pop(getattr(future, "request_id", None), None)
+
+    def _write_streamed(self, command):
+        started = self.bytes_written
+        buffer = bytearray()
+        try:
+            for piece in iter_json(command):
+                buffer += piece.encode()
+                if len(buffer) >= WRITE_BUFFER:
+                    self._write_buffer(buffer, more=True)
+                    buffer.clear()
+        except Exception:
+            if self.bytes_written > started:
+                # End the partial line, so a failed command cannot swallow the next one
+                self._write_buffer(b"\n")
+            raise
+        self._write_buffer(buffer + b"\n")
+
+    def _write_buffer(self, data, more=False):
+        self.serial_port.write(data)
+        self.bytes_written += len(data)
+        if self.recorder is not None:
+            self.recorder.sent(bytes(data), more=more)
+
+    def _read_loop(self):
+        while not self._closed.is_set():
+            try:
+                # Blocks in the driver until a line or the port timeout
+                line = self.serial_port.readline()
+            except Exception as e:
+                if not self._closed.is_set():
+                    self._fail_pending(e)
+                return
+            if not line:
+                continue
+            if self.recorder is not None:
+                self.recorder.received(line)
+            instruments = self.instruments
+            if instruments is not None and not instruments.enabled:
+                instruments = None
+            if instruments is not None:
+                instruments.received(len(line))
+
+            try:
+                response = json.loads(line.decode(errors="replace").strip())
+                if not isinstance(response, dict):
+                    raise ValueError("Response is not an object")
+            except ValueError:
+                if instruments is not None:
+                    instruments.decode_error(line)
+                response = {"status": "error", "error": "Invalid response format"}
+                if self.echoes_ids or self._subscribed():
+                    # Could have been an event; failing an unrelated request would be worse than a timeout
+                    self._put_unmatched(response)
+                    continue
+            self._dispatch(response, instruments, len(line))
+
+    def _subscribed(self):
+        with self._pending_lock:
+            return any(self._subscribers.values())
+
+    def _dispatch(self, response, instruments=None, size=0):
+        if "event" in response:
+            if instruments is not None:
+                instruments.event(response["event"])
+            self._publish(response)
+            return
+
+        with self._pending_lock:
+            future = self._pending.pop(response.get("id"), None)
+            if future is not None:
+                self.echoes_ids = True
+            elif "id" not in response and self._pending:
+                _, future = self._pending.popitem(last=False)
+
+        if future is None:
+            self._put_unmatched(response)
+            return
+        if future.done() and not future.cancelled():
+            return  # a partly written request that already failed; this was the firmware rejecting it
+        if instruments is not None:
+            instruments.reply(future.cmd, time.perf_counter() - future.sent_at, response, size)
+        try:
+            future.set_result(response)
+        except InvalidStateError:
+            pass  # the request was cancelled while the reply was in flight
+
+    def _publish(self, message):
+        if message["event"] == "ready":
+            self.banner = message
+            self.ready.set()
+        with self._pending_lock:
+            callbacks = list(self._subscribers.get(message["event"], ()))
+        if not callbacks:
+            self._put_unmatched(message)
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception:
+                pass  # a faulty subscriber must not stop the reader
+
+    def _put_unmatched(self, response):
+        # Drop the oldest entry rather than block the reader
+        while True:
+            try:
+                self.responses.put_nowait(response)
+                return
+            except queue.Full:
+                try:
+                    self.responses.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _fail_pending(self, exc):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            try:
+                future.set_exception(exc)
+            except InvalidStateError:
+                pass